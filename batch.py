@@ -0,0 +1,270 @@
+"""Generates the firmware files for many boards at once.
+
+    python batch.py boards/ -o out/
+    python batch.py --manifest boards.json -o out/ -j 8 --artifacts info.json,keymap.c
+
+Every `<name>.json` file in a directory is a board (a KLE json, or a VIA/L json which is converted first), files like
+`<name>.info.json` are skipped. A KiCAD netlist `<name>.net` and a VIAL layout file `<name>.vil` next to it are used as well. Options (the site's form field names)
+are given with `--option mcu-preset=RP2040` for every board, or per board in a manifest:
+
+    {"options": {"maintainer": "Zykrah"},
+     "boards": [{"name": "slime88", "kle": "slime88.json", "netlist": "slime88.net", "layout-file": "slime88.vil",
+                 "options": {"board-name": "Slime88", "mcu-preset": "RP2040"}},
+                {"name": "via-board", "via": "via-board.json"}]}
+
+(paths are relative to the manifest). The files of every board are written to `<output>/<name>/`, which is replaced as a whole,
+so a board's folder never contains a mix of old and new files. A board that fails is reported and skipped, the rest still run.
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field as dcf
+from traceback import format_exc
+from typing import Any, Dict, List, Optional
+
+from util.util import read_file, write_file
+from util.serial import serialize
+from util.converters import via_to_kbd
+from util.keycodes import KEYCODES
+from util.cache import RESULTS
+from util.pipeline import ARTIFACTS, read_options, generate_files
+from util.timing import StageTimer
+
+
+@dataclass
+class BatchBoard:
+    name: str
+    kle_path: Optional[str] = None
+    via_path: Optional[str] = None
+    netlist_path: Optional[str] = None
+    layout_path: Optional[str] = None
+    options: Dict[str, Any] = dcf(default_factory=dict) # form field names, e.g. 'mcu-preset'
+
+
+@dataclass
+class BatchResult:
+    name: str
+    ok: bool
+    seconds: float
+    error: str = ""
+    files: List[str] = dcf(default_factory=list)
+    stages: Dict[str, float] = dcf(default_factory=dict) # seconds per pipeline stage
+    warnings: List[str] = dcf(default_factory=list) # e.g. matrix nets not wired to the MCU
+
+
+def board_name(name: str) -> str:
+    """A board name that is safe as a folder name in the output directory."""
+    safe = re.sub(r'[^\w.-]', '_', str(name)).lstrip('.')
+    if not safe:
+        raise Exception(f"Invalid board name {name!r}")
+    return safe
+
+
+def boards_from_directory(directory: str, options: Dict[str, Any]) -> List[BatchBoard]:
+    boards = []
+    for entry in sorted(os.listdir(directory)):
+        stem, ext = os.path.splitext(entry)
+        # name.info.json, name.vial.json, name.kle.json... are generated files, not boards
+        if ext != '.json' or '.' in stem or not os.path.isfile(os.path.join(directory, entry)):
+            continue
+        board = BatchBoard(stem, os.path.join(directory, entry), options=dict(options))
+        netlist_path = os.path.join(directory, stem + '.net')
+        if os.path.exists(netlist_path):
+            board.netlist_path = netlist_path
+        layout_path = os.path.join(directory, stem + '.vil')
+        if os.path.exists(layout_path):
+            board.layout_path = layout_path
+        boards.append(board)
+    return boards
+
+
+def boards_from_manifest(path: str, options: Dict[str, Any]) -> List[BatchBoard]:
+    manifest = json.loads(read_file(path))
+    if isinstance(manifest, list):
+        manifest = {'boards': manifest}
+    directory = os.path.dirname(os.path.abspath(path))
+
+    def resolve(file_path):
+        return os.path.join(directory, file_path) if file_path else None
+
+    boards = []
+    for i, entry in enumerate(manifest.get('boards', [])):
+        if not entry.get('kle') and not entry.get('via'):
+            raise Exception(f"Board {i} of {path} needs a KLE json (kle) or a VIA/L json (via)")
+        name = board_name(entry.get('name') or os.path.splitext(os.path.basename(entry.get('kle') or entry['via']))[0])
+        board_options = {**options, **manifest.get('options', {}), **entry.get('options', {})}
+        boards.append(BatchBoard(name, resolve(entry.get('kle')), resolve(entry.get('via')),
+                                 resolve(entry.get('netlist')), resolve(entry.get('layout-file')), board_options))
+    return boards
+
+
+def read_kle(board: BatchBoard) -> list:
+    """The board's KLE json, converting it from a VIA/L json first if needed."""
+    if board.via_path:
+        return serialize(via_to_kbd(read_file(board.via_path)))
+
+    kle = json.loads(read_file(board.kle_path))
+    if isinstance(kle, dict) and 'layouts' in kle: # a VIA/L json in a board directory
+        return serialize(via_to_kbd(kle))
+    return kle
+
+
+def write_board(output_dir: str, name: str, files: Dict[str, str]):
+    """Writes a board's files to `output_dir/name/` atomically: they are written to a temporary folder,
+    which then replaces the old folder (if any)."""
+    target = os.path.join(output_dir, name)
+    tmp_dir = tempfile.mkdtemp(dir=output_dir, prefix=f'.{name}-')
+    try:
+        for path, content in files.items():
+            write_file(os.path.join(tmp_dir, path), content)
+        if os.path.exists(target):
+            old_dir = tempfile.mkdtemp(dir=output_dir, prefix=f'.{name}-old-')
+            os.replace(target, os.path.join(old_dir, name))
+            os.replace(tmp_dir, target)
+            shutil.rmtree(old_dir)
+        else:
+            os.replace(tmp_dir, target)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def convert_board(board: BatchBoard, output_dir: str, artifacts: List[str]) -> BatchResult:
+    """Runs the pipeline for one board and writes its files. Never raises, errors are returned in the result."""
+    start = time.perf_counter()
+    timer = StageTimer()
+    warnings = []
+    try:
+        options = dict(board.options)
+        if board.layout_path:
+            options['layout-file'] = read_file(board.layout_path)
+        netlist = None
+        if board.netlist_path:
+            netlist = open(board.netlist_path, 'rb')
+        try:
+            with timer.stage('read'):
+                kle = read_kle(board)
+            files = generate_files(kle, read_options(options), netlist, artifacts, RESULTS, timer=timer, warnings=warnings)
+        finally:
+            if netlist:
+                netlist.close()
+        with timer.stage('write'):
+            write_board(output_dir, board.name, files)
+    except Exception as e:
+        return BatchResult(board.name, False, time.perf_counter() - start, f"{e}\n{format_exc()}", stages=timer.stages)
+    return BatchResult(board.name, True, time.perf_counter() - start, files=list(files), stages=timer.stages, warnings=warnings)
+
+
+def init_worker(load_keycodes: bool):
+    # keycodes.md is refreshed (if needed) by the main process before the batch starts
+    KEYCODES.refresher = None
+    if load_keycodes:
+        # Parsed once per worker, then shared by all its boards
+        KEYCODES.keycode_dict()
+        KEYCODES.conversion_dict()
+
+
+def run_batch(boards: List[BatchBoard], output_dir: str, artifacts: List[str] = ARTIFACTS, jobs: int = None) -> List[BatchResult]:
+    """Converts `boards` in a pool of `jobs` processes (all the CPUs by default, no pool if 1) and
+    prints one line per board as it finishes. Returns the results in the order of `boards`."""
+    names = [board.name for board in boards]
+    if len(set(names)) != len(names):
+        raise Exception(f"Board names must be unique, got {sorted(name for name in set(names) if names.count(name) > 1)}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    load_keycodes = 'keymap.c' in artifacts and any(board.layout_path or board.options.get('layout-file') for board in boards)
+    if load_keycodes and KEYCODES.refresher and KEYCODES.refresher.is_stale():
+        KEYCODES.refresher.refresh()
+
+    def report(result: BatchResult):
+        status = 'ok  ' if result.ok else 'FAIL'
+        print(f"{status} {result.name:<30} {result.seconds * 1000:8.1f} ms" + ("" if result.ok else f"  {result.error.splitlines()[0]}"))
+        for warning in result.warnings:
+            print(f"     WARNING: {warning}")
+
+    results = {}
+    if jobs == 1:
+        # Converted in this process, which keeps its refresher afterwards
+        refresher = KEYCODES.refresher
+        try:
+            init_worker(load_keycodes)
+            for board in boards:
+                results[board.name] = convert_board(board, output_dir, artifacts)
+                report(results[board.name])
+        finally:
+            KEYCODES.refresher = refresher
+    else:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(load_keycodes,)) as pool:
+            futures = {pool.submit(convert_board, board, output_dir, artifacts): board for board in boards}
+            for future in as_completed(futures):
+                board = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e: # e.g. a worker crashed
+                    result = BatchResult(board.name, False, 0., f"{e}\n{format_exc()}")
+                results[board.name] = result
+                report(result)
+
+    return [results[board.name] for board in boards]
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Generates the firmware files for many boards (see batch.py).")
+    parser.add_argument('inputs', nargs='*', help="directories of boards, or KLE/VIA json files")
+    parser.add_argument('-m', '--manifest', action='append', default=[], help="json manifest of boards (can be repeated)")
+    parser.add_argument('-o', '--output', required=True, help="output directory, one folder per board")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument('-a', '--artifacts', default=','.join(ARTIFACTS), help="comma separated files to generate (default: all)")
+    parser.add_argument('--option', action='append', default=[], metavar='FIELD=VALUE', help="option for every board, e.g. mcu-preset=RP2040")
+    parser.add_argument('--report', help="write the per-board results (timings, errors) to this json file")
+    args = parser.parse_args(argv)
+
+    artifacts = [artifact.strip() for artifact in args.artifacts.split(',') if artifact.strip()]
+    unknown = [artifact for artifact in artifacts if artifact not in ARTIFACTS]
+    if unknown:
+        parser.error(f"unknown artifacts {unknown}, must be some of {ARTIFACTS}")
+
+    options = {}
+    for option in args.option:
+        if '=' not in option:
+            parser.error(f"options must be FIELD=VALUE, got {option!r}")
+        field, value = option.split('=', 1)
+        options[field] = value
+
+    boards = []
+    for path in args.inputs:
+        if os.path.isdir(path):
+            boards += boards_from_directory(path, options)
+        else:
+            boards.append(BatchBoard(os.path.splitext(os.path.basename(path))[0], path, options=dict(options)))
+    for path in args.manifest:
+        boards += boards_from_manifest(path, options)
+    if not boards:
+        parser.error("no boards given")
+
+    start = time.perf_counter()
+    results = run_batch(boards, args.output, artifacts, args.jobs)
+    total = time.perf_counter() - start
+
+    failed = [result for result in results if not result.ok]
+    print(f"{len(results) - len(failed)}/{len(results)} boards converted in {total:.1f} s")
+    for result in failed:
+        print(f"\n{result.name} failed:\n{result.error}")
+
+    if args.report:
+        write_file(args.report, json.dumps({
+            'seconds': total,
+            'boards': [{'name': r.name, 'ok': r.ok, 'seconds': r.seconds, 'error': r.error, 'files': r.files, 'stages': r.stages, 'warnings': r.warnings} for r in results],
+        }, indent=2))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
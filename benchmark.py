@@ -0,0 +1,435 @@
+"""Benchmarks for the KLE serializer/deserializer and the converters.
+
+Run with `python benchmark.py`. Every benchmark prints its throughput (ops/sec) and peak memory.
+Results can be saved as a baseline and compared against later, e.g. before and after a change:
+
+    python benchmark.py --save-baseline before.json
+    python benchmark.py --compare before.json
+
+`--kle board.json` (can be repeated) also runs the converters on real boards, and
+`--only serialize,keymap` only runs the benchmarks whose names contain one of the words.
+"""
+import io
+import os
+import sys
+import json
+import time
+import re
+import argparse
+import platform
+import tracemalloc
+from typing import Callable, Dict, List
+
+from util.serial import Key, Keyboard, KeyboardMetadata, serialize, deserialize
+from util.layouts import get_layout_all, get_specific_layout, analyze_keyboard, MultilayoutIndex
+from util.util import extract_matrix_pins
+from util.converters import kbd_to_qmk_info, kbd_to_vial, kbd_to_keymap, via_to_kbd
+from util.json_encoders import InfoJSONEncoder, KLEJSONEncoder
+from util.kle_raw import parse_kle_raw
+
+
+# SYNTHETIC BOARDS
+
+def generate_keys(num_keys: int, cols: int = 20, multilayouts: int = 0, options: int = 2,
+                  encoders: int = 0, rotation: float = 0.) -> List[Key]:
+    """Generates a grid of `num_keys` keys with matrix (row/col) labels, with some variation in
+    widths, colours and text sizes so that the KLE property dicts get exercised as well.
+
+    `multilayouts` extra multilayouts with `options` options each are added below the grid.
+    Option `n` of a multilayout is made of `n + 1` keys, so the last option is the max layout.
+    `encoders` VIAL encoders (a CCW and a CW key each) are added to the right of the grid, and
+    the right half of the grid is rotated by `rotation` degrees (like a split/ergo board).
+    """
+    keys = []
+    for i in range(num_keys):
+        row, col = divmod(i, cols)
+        labels = [""] * 12
+        labels[0] = f"K{i}"
+        labels[9] = str(row)
+        labels[11] = str(col)
+        key = Key(labels=labels, x=float(col), y=float(row))
+        if rotation and col >= cols // 2:
+            key.rotation_angle = rotation
+            key.rotation_x = float(cols // 2)
+        if col == 0 and row % 3 == 1:
+            key.color = "#aaaaaa"
+        if col == cols - 1 and row % 2:
+            key.text_size = [None] * 12
+            key.text_size[0] = 4
+        keys.append(key)
+
+    grid_rows = -(-num_keys // cols)
+    for ml_ndx in range(multilayouts):
+        y = float(grid_rows + 1 + ml_ndx)
+        for ml_val in range(options):
+            width = 2. / (ml_val + 1)
+            for i in range(ml_val + 1):
+                labels = [""] * 12
+                labels[3] = str(ml_ndx)
+                labels[5] = str(ml_val)
+                labels[9] = str(grid_rows + ml_ndx)
+                labels[11] = str(i)
+                if i == 0:
+                    labels[7] = f"Multilayout {ml_ndx}"
+                    labels[6] = f"Option {ml_val}"
+                keys.append(Key(labels=labels, x=ml_val * 3 + i * width, y=y, width=width, width2=width))
+
+    for enc in range(encoders):
+        for direction in range(2):
+            labels = [""] * 12
+            labels[4] = "e"
+            labels[9] = str(enc)
+            labels[11] = str(direction)
+            keys.append(Key(labels=labels, x=float(cols + 1 + direction), y=float(enc)))
+    return keys
+
+
+def generate_kbd(num_keys: int, cols: int = 20, multilayouts: int = 0, options: int = 2,
+                 encoders: int = 0, rotation: float = 0.) -> Keyboard:
+    keys = generate_keys(num_keys, cols, multilayouts, options, encoders, rotation)
+    return Keyboard(KeyboardMetadata(name=f"Synthetic {num_keys}"), keys)
+
+
+def generate_kle(num_keys: int, cols: int = 20, multilayouts: int = 0, options: int = 2,
+                 encoders: int = 0, rotation: float = 0.) -> list:
+    """Generates a KLE json (list of rows) for a synthetic board, see `generate_keys()`."""
+    # Round trip through json so that the rows look exactly like an uploaded file
+    return json.loads(json.dumps(serialize(generate_kbd(num_keys, cols, multilayouts, options, encoders, rotation))))
+
+
+def generate_kle_raw(num_keys: int, cols: int = 20, multilayouts: int = 0, options: int = 2,
+                     encoders: int = 0, rotation: float = 0.) -> str:
+    """Generates the KLE raw data of a synthetic board, as KLE shows it (one row per line, unquoted keys)."""
+    def raw(value):
+        if isinstance(value, dict):
+            return '{' + ','.join(f"{key}:{raw(item)}" for key, item in value.items()) + '}'
+        if isinstance(value, list):
+            return '[' + ','.join(raw(item) for item in value) + ']'
+        return json.dumps(value)
+    return ',\n'.join(raw(row) for row in generate_kle(num_keys, cols, multilayouts, options, encoders, rotation))
+
+
+def generate_via_json(num_keys: int, cols: int = 20, multilayouts: int = 0, options: int = 2) -> str:
+    """Generates a VIA json for a synthetic board (same keys as `generate_keys()`, with VIA's
+    `row,col` and `multilayout,option` labels)."""
+    keys = generate_keys(num_keys, cols, multilayouts, options)
+    for key in keys:
+        labels = [""] * 12
+        labels[0] = f"{key.labels[9]},{key.labels[11]}"
+        if key.labels[3]:
+            labels[8] = f"{key.labels[3]},{key.labels[5]}"
+        key.labels = labels
+    # A boolean multilayout if it has 2 options, otherwise a list of option names
+    ml_labels = [f"Multilayout {n}" if options == 2 else [f"Multilayout {n}"] + [f"Option {i}" for i in range(options)]
+                 for n in range(multilayouts)]
+    kle = serialize(Keyboard(KeyboardMetadata(), keys))
+    return json.dumps({"name": f"Synthetic {num_keys}", "layouts": {"labels": ml_labels, "keymap": kle}}, cls=KLEJSONEncoder)
+
+
+# Keycodes of the synthetic layout files, and small stand-ins for the keycodes.md and deprecated keycode tables
+LAYOUT_KEYCODES = ["KC_A", "KC_B", "KC_LCTRL", "KC_TRNS", "RESET", "KC_NO", "KC_SPC", "MO(1)"]
+KEYCODE_DICT = {"KC_LCTRL": "KC_LCTL", "KC_SPACE": "KC_SPC", "KC_TRANSPARENT": "KC_TRNS"}
+CONVERSION_DICT = {"RESET": "QK_BOOT", "KC_LCTRL": "KC_LEFT_CTRL"}
+
+
+def generate_layout_file(kbd: Keyboard, layers: int = 4) -> dict:
+    """Generates a VIAL layout file (.vil) dict for a board: `layers` layers of keycodes for its
+    layout_all matrix, and encoder keycodes if it has encoders."""
+    analysis = analyze_keyboard(kbd)
+    rows, cols = analysis.layout_all_size
+    layout = {"layout": [[[LAYOUT_KEYCODES[(layer + row + col) % len(LAYOUT_KEYCODES)] for col in range(cols)]
+                          for row in range(rows)] for layer in range(layers)]}
+    if analysis.encoders_num:
+        layout["encoder_layout"] = [[["KC_VOLD", "KC_VOLU"] for _ in range(analysis.encoders_num)] for _ in range(layers)]
+    return layout
+
+
+def generate_netlist(rows: int, cols: int, mcu: str = "RP2040", pins_per_mcu: int = 30) -> str:
+    """Generates a KiCAD (6+) netlist for a `rows` x `cols` diode matrix wired to an MCU,
+    including the design/libparts/libraries sections that real netlists have."""
+    out = ['(export (version "E")\n  (design\n    (source "/tmp/synthetic.kicad_sch")\n    (tool "Eeschema 7.0.0")\n'
+           '    (sheet (number "1") (name "/") (tstamps "/")\n      (title_block (title) (company) (rev) (date) (source "synthetic.kicad_sch"))))\n'
+           '  (components\n']
+    out.append(f'    (comp (ref "U1")\n      (value "{mcu}")\n      (footprint "Package_DFN_QFN:QFN-56-1EP_7x7mm")\n'
+               '      (libsource (lib "MCU") (part "MCU") (description ""))\n      (property (name "Sheetname") (value ""))\n'
+               '      (sheetpath (names "/") (tstamps "/"))\n      (tstamps "00000000-0000-0000-0000-000000000001"))\n')
+    for i in range(rows * cols):
+        for ref, value, lib in ((f"D{i}", "1N4148", "Diode:D_SOD-123"), (f"SW{i}", "MX", "Switch:SW_MX_1u")):
+            out.append(f'    (comp (ref "{ref}")\n      (value "{value}")\n      (footprint "{lib}")\n'
+                       f'      (libsource (lib "{lib.split(":")[0]}") (part "{value}") (description "A \\"{value}\\" part"))\n'
+                       '      (property (name "Sheetname") (value ""))\n      (sheetpath (names "/") (tstamps "/"))\n'
+                       f'      (tstamps "00000000-0000-0000-0000-{i:012d}"))\n')
+    out.append('  )\n  (libparts\n')
+    for part in ("1N4148", "MX", mcu):
+        out.append(f'    (libpart (lib "lib") (part "{part}")\n      (description "")\n      (fields (field (name "Reference") "X"))\n'
+                   '      (pins\n' + ''.join(f'        (pin (num "{n}") (name "P{n}") (type "passive"))\n' for n in range(pins_per_mcu)) + '      ))\n')
+    out.append('  )\n  (libraries\n    (library (logical "lib")\n      (uri "/usr/share/kicad/symbols/lib.kicad_sym")))\n  (nets\n')
+
+    code = 1
+    for name, count in (("COL", cols), ("ROW", rows)):
+        for n in range(count):
+            gpio = (code - 1) % pins_per_mcu
+            out.append(f'    (net (code "{code}") (name "{name}{n}")\n      (node (ref "U1") (pin "{gpio + 2}") (pinfunction "GPIO{gpio}") (pintype "bidirectional"))\n')
+            for i in range(n, rows * cols, cols) if name == "COL" else range(n * cols, (n + 1) * cols):
+                ref, pin = (f"SW{i}", "1") if name == "COL" else (f"D{i}", "2")
+                out.append(f'      (node (ref "{ref}") (pin "{pin}") (pintype "passive"))\n')
+            out[-1] = out[-1][:-1] + ')\n'
+            code += 1
+    for i in range(rows * cols):
+        out.append(f'    (net (code "{code}") (name "Net-(D{i}-Pad1)")\n      (node (ref "D{i}") (pin "1") (pintype "passive"))\n'
+                   f'      (node (ref "SW{i}") (pin "2") (pintype "passive")))\n')
+        code += 1
+    out.append('  ))\n')
+    return ''.join(out)
+
+
+# TIMING
+
+def time_call(fn: Callable, min_time: float = 1.0, repeat: int = 3) -> float:
+    """Returns the best time per call (in seconds) of `fn` over `repeat` runs of at least `min_time` seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            fn()
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time / repeat:
+                break
+        best = min(best, elapsed / calls)
+    return best
+
+
+def peak_memory(fn: Callable) -> int:
+    """Returns the peak memory (in bytes) allocated during one call of `fn`."""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# Filled in by measure(): {benchmark name: {'ops_per_sec', 'peak_kib'}}
+RESULTS: Dict[str, Dict[str, float]] = {}
+MIN_TIME = 1.0
+
+
+def measure(name: str, size: float, fn: Callable, unit: str = "keys"):
+    """Times `fn` (and measures its peak memory in a separate call, since tracing slows it down),
+    prints the results and records them in RESULTS as `"<name> <size> <unit>"`."""
+    secs = time_call(fn, MIN_TIME)
+    peak = peak_memory(fn)
+    size_str = f"{size:g}"
+    RESULTS[f"{name} {size_str} {unit}"] = {'ops_per_sec': 1 / secs, 'peak_kib': peak / 1024}
+    print(f"{name:<32} {size_str:>6} {unit:<4}: {1 / secs:10.1f} ops/sec {size / secs:12.1f} {unit}/sec {peak / 1024:10.0f} KiB peak")
+
+
+def save_baseline(path: str):
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump({'python': platform.python_version(), 'min_time': MIN_TIME, 'results': RESULTS}, file, indent=2)
+    print(f"Saved {len(RESULTS)} results to {path}")
+
+
+def compare_baseline(path: str, threshold: float = 0.1) -> List[str]:
+    """Prints the change of every result against a baseline saved with `save_baseline()`,
+    and returns the benchmarks that are slower (or use more memory) by more than `threshold`."""
+    with open(path, encoding='utf-8') as file:
+        baseline = json.load(file)['results']
+
+    regressions = []
+    print(f"\n{'Compared to ' + path:<45} {'speed':>8} {'memory':>8}")
+    for name, result in RESULTS.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        speed = result['ops_per_sec'] / old['ops_per_sec']
+        memory = result['peak_kib'] / old['peak_kib'] if old['peak_kib'] else 1.
+        flag = ""
+        if speed < 1 - threshold or memory > 1 + threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<45} {speed:7.2f}x {memory:7.2f}x{flag}")
+    return regressions
+
+
+# BENCHMARKS
+
+def bench_deserialize(sizes=(100, 1000, 10000)):
+    for num_keys in sizes:
+        rows = generate_kle(num_keys)
+        measure("deserialize", num_keys, lambda: deserialize(rows))
+    rows = generate_kle(1000, encoders=4, rotation=15.)
+    measure("deserialize rotated+encoders", 1008, lambda: deserialize(rows))
+
+
+def bench_serialize(sizes=(100, 1000, 10000)):
+    for num_keys in sizes:
+        kbd = deserialize(generate_kle(num_keys))
+        measure("serialize", num_keys, lambda: serialize(kbd))
+    kbd = deserialize(generate_kle(1000, encoders=4, rotation=15.))
+    measure("serialize rotated+encoders", 1008, lambda: serialize(kbd))
+
+
+def bench_parse_kle_raw(sizes=(100, 1000, 10000)):
+    """Against the old regex rewrite to json, which gives the same rows for these (no `:` in the labels)."""
+    for num_keys in sizes:
+        raw = generate_kle_raw(num_keys, multilayouts=num_keys // 100, options=3, encoders=4, rotation=10.)
+        old = lambda: json.loads('[' + re.sub(r"(\w+):", r'"\1":', raw) + ']')
+        assert parse_kle_raw(raw) == old(), "parse_kle_raw differs from the regex rewrite"
+        measure("parse_kle_raw", num_keys, lambda: parse_kle_raw(raw))
+        measure("regex + json.loads", num_keys, old)
+
+
+def bench_json_encoders(sizes=(100, 1000, 5000)):
+    """Also checks that the fast encoding paths give the same text as the reference ones.
+    The exact output for real boards is tested against fixtures in tests/test_json_encoders.py."""
+    for num_keys in sizes:
+        kbd = deserialize(generate_kle(num_keys, multilayouts=num_keys // 100, options=3))
+        info = kbd_to_qmk_info(kbd, "Synthetic", "", "", "0xFEED", "0x0001", "0x0001", "RP2040", "rp2040", None, {}, "COL2ROW", "")
+        vial, _ = kbd_to_vial(kbd, "", "0xFEED", "0x0001", "none", "Synthetic")
+
+        info_json = json.dumps(info, indent=4, separators=(', ', ': '), sort_keys=False, cls=InfoJSONEncoder)
+        assert json.loads(info_json) == json.loads(json.dumps(info)), "info.json doesn't round trip"
+        vial_json = json.dumps(vial, ensure_ascii=False, indent=2, cls=KLEJSONEncoder)
+        reference = io.StringIO()  # json.dump() goes through the stock iterencode() generators
+        json.dump(vial, reference, ensure_ascii=False, indent=2, cls=KLEJSONEncoder)
+        assert vial_json == reference.getvalue(), "vial.json differs from the reference encoder"
+
+        measure("InfoJSONEncoder", num_keys, lambda: json.dumps(info, indent=4, separators=(', ', ': '), sort_keys=False, cls=InfoJSONEncoder))
+        measure("KLEJSONEncoder", num_keys, lambda: json.dumps(vial, ensure_ascii=False, indent=2, cls=KLEJSONEncoder))
+
+
+def bench_get_layout_all(boards=((100, 5, 3), (1000, 50, 4), (1000, 200, 4))):
+    for num_keys, multilayouts, options in boards:
+        kbd = deserialize(generate_kle(num_keys, multilayouts=multilayouts, options=options))
+        measure(f"get_layout_all {multilayouts}x{options}", len(kbd.keys), lambda: get_layout_all(kbd))
+
+
+def bench_get_specific_layout(boards=((100, 5, 3), (1000, 50, 4))):
+    for num_keys, multilayouts, options in boards:
+        kbd = deserialize(generate_kle(num_keys, multilayouts=multilayouts, options=options))
+        layout_idx = [n % options for n in range(multilayouts)]
+        measure(f"get_specific_layout {multilayouts}x{options}", len(kbd.keys), lambda: get_specific_layout(kbd, layout_idx))
+        ml_index = MultilayoutIndex(kbd)
+        measure(f"MultilayoutIndex.layout {multilayouts}x{options}", len(kbd.keys), lambda: ml_index.layout(layout_idx))
+
+
+def bench_every_layout(boards=((100, 4, 3), (500, 6, 3))):
+    """All the combinations of options (e.g. 3^6 = 729 layouts), like when every LAYOUT_* variant is published."""
+    for num_keys, multilayouts, options in boards:
+        kbd = deserialize(generate_kle(num_keys, multilayouts=multilayouts, options=options))
+        measure(f"every layout {options}^{multilayouts}", len(kbd.keys),
+                lambda: sum(1 for _ in MultilayoutIndex(kbd).layouts()))
+
+
+def bench_kbd_to_qmk_info(boards=((100, 5, 3, 2), (1000, 50, 4, 4), (5000, 100, 4, 4))):
+    """Includes the layout analysis, as when it's called without one."""
+    for num_keys, multilayouts, options, encoders in boards:
+        kbd = deserialize(generate_kle(num_keys, multilayouts=multilayouts, options=options, encoders=encoders))
+        alt_layouts = {"Alternate": [options - 1] * multilayouts}
+        measure("kbd_to_qmk_info", len(kbd.keys), lambda: kbd_to_qmk_info(
+            kbd, "Synthetic", "", "", "0xFEED", "0x0001", "0x0001", "RP2040", "rp2040", None, {}, "COL2ROW", "", alt_layouts))
+
+
+def bench_kbd_to_vial(boards=((100, 5, 3, 2), (1000, 50, 4, 4), (5000, 100, 4, 4))):
+    for num_keys, multilayouts, options, encoders in boards:
+        kbd = deserialize(generate_kle(num_keys, multilayouts=multilayouts, options=options, encoders=encoders))
+        measure("kbd_to_vial", len(kbd.keys), lambda: kbd_to_vial(kbd, "", "0xFEED", "0x0001", "none", "Synthetic"))
+
+
+def bench_via_to_kbd(boards=((100, 5, 3), (1000, 50, 4))):
+    for num_keys, multilayouts, options in boards:
+        via_json = generate_via_json(num_keys, multilayouts=multilayouts, options=options)
+        num_keys = len(via_to_kbd(via_json).keys)
+        measure("via_to_kbd", num_keys, lambda: via_to_kbd(via_json))
+        via = json.loads(via_json)
+        measure("via_to_kbd parsed", num_keys, lambda: via_to_kbd(via))
+
+
+def bench_kbd_to_keymap(boards=((100, 5, 3, 2, 4), (1000, 50, 4, 4, 4), (1000, 50, 4, 4, 32))):
+    """keymap.c from the labels, and from a VIAL layout file with `layers` layers."""
+    for num_keys, multilayouts, options, encoders, layers in boards:
+        kbd = deserialize(generate_kle(num_keys, multilayouts=multilayouts, options=options, encoders=encoders))
+        layout = generate_layout_file(kbd, layers)
+        measure(f"kbd_to_keymap labels {layers}L", len(kbd.keys), lambda: kbd_to_keymap(kbd, layers, 1))
+        measure(f"kbd_to_keymap .vil {layers}L", len(kbd.keys), lambda: kbd_to_keymap(kbd, layers, 1, layout, KEYCODE_DICT, CONVERSION_DICT))
+
+
+def bench_extract_matrix_pins(boards=((6, 20), (64, 64), (128, 128))):
+    for rows, cols in boards:
+        netlist = generate_netlist(rows, cols)
+        measure("extract_matrix_pins", round(len(netlist) / 1e6, 1), lambda: extract_matrix_pins(netlist), unit="MB")
+
+
+def bench_kle_file(path: str):
+    """Runs the converters on a real board (a KLE json following the guide)."""
+    rows = json.loads(open(path, encoding='utf-8').read())
+    name = os.path.basename(path)
+    kbd = deserialize(rows)
+    num_keys = len(kbd.keys)
+    benchmarks = [
+        ("deserialize", lambda: deserialize(rows)),
+        ("serialize", lambda: serialize(kbd)),
+        ("get_layout_all", lambda: get_layout_all(kbd)),
+        ("kbd_to_qmk_info", lambda: kbd_to_qmk_info(kbd, "Board", "", "", "0xFEED", "0x0001", "0x0001", "RP2040", "rp2040", None, {}, "COL2ROW", "")),
+        ("kbd_to_vial", lambda: kbd_to_vial(kbd, "", "0xFEED", "0x0001", "none", "Board")),
+        ("kbd_to_keymap", lambda: kbd_to_keymap(kbd, 4, 1)),
+    ]
+    for bench_name, fn in benchmarks:
+        try:
+            fn()
+        except Exception as e:
+            print(f"{name + ' ' + bench_name:<32} skipped: {e}")
+            continue
+        measure(f"{name} {bench_name}", num_keys, fn)
+
+
+BENCHMARKS = [
+    bench_deserialize,
+    bench_serialize,
+    bench_parse_kle_raw,
+    bench_json_encoders,
+    bench_get_layout_all,
+    bench_get_specific_layout,
+    bench_every_layout,
+    bench_kbd_to_qmk_info,
+    bench_kbd_to_vial,
+    bench_via_to_kbd,
+    bench_kbd_to_keymap,
+    bench_extract_matrix_pins,
+]
+
+
+def main(argv: List[str] = None) -> int:
+    global MIN_TIME
+    parser = argparse.ArgumentParser(description="Benchmarks for the serializer and the converters (see benchmark.py).")
+    parser.add_argument('--only', help="comma separated words, only run the benchmarks whose names contain one of them")
+    parser.add_argument('--kle', action='append', default=[], help="also benchmark a real board (KLE json), can be repeated")
+    parser.add_argument('--min-time', type=float, default=MIN_TIME, help="seconds to time each benchmark for (default: %(default)s)")
+    parser.add_argument('--save-baseline', metavar='PATH', help="save the results as a json baseline")
+    parser.add_argument('--compare', metavar='PATH', help="compare the results to a saved baseline, fails on regressions")
+    parser.add_argument('--threshold', type=float, default=0.1, help="relative slowdown/memory increase counted as a regression (default: %(default)s)")
+    args = parser.parse_args(argv)
+    MIN_TIME = args.min_time
+
+    only = [word.strip() for word in args.only.split(',')] if args.only else None
+    for bench in BENCHMARKS:
+        if only is None or any(word in bench.__name__ for word in only):
+            bench()
+    for path in args.kle:
+        bench_kle_file(path)
+
+    if args.save_baseline:
+        save_baseline(args.save_baseline)
+    if args.compare:
+        regressions = compare_baseline(args.compare, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regressions")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
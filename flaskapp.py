@@ -1,14 +1,21 @@
 #Package import
-from flask import Flask, render_template, send_file, make_response, url_for, Response, redirect, request, jsonify
-from util.serial import serialize, deserialize
-from util.util import read_file, write_file, gen_uid, MCU_PRESETS, MCU_DICT
-from util.converters import kbd_to_keymap, kbd_to_qmk_info, kbd_to_vial, kbd_to_layout_macro, kbd_to_main_config, layout_str_to_layout_dict, keycodes_md_to_keycode_dict, generate_keycode_conversion_dict, extract_matrix_pins, via_to_kbd
+from flask import Flask, render_template, send_file, make_response, Response, request, jsonify, g
+from util.serial import serialize, deserialize, verify_roundtrip
+from util.util import MCU_PRESETS
+from util.converters import via_to_kbd
+from util.cache import RESULTS
+from util.keycodes import KEYCODES
+from util.kle_raw import parse_kle_raw
+from util.pipeline import ARTIFACTS, read_options, generate_files
+from util.timing import StageTimer, STAGE_STATS, save_profile
+import cProfile
+import io
 import json
-import re
+import logging
+import zipfile
 import os
-import datetime
-import requests
 from traceback import format_exc
+from typing import Any, Dict, List, Optional
 
 from util.json_encoders import * # from qmk_firmware/lib/python/qmk/json_encoders.py, for generating info.json
 
@@ -16,6 +23,63 @@ from util.json_encoders import * # from qmk_firmware/lib/python/qmk/json_encoder
 #initialise app
 app = Flask(__name__)
 app.config['JSON_SORT_KEYS'] = False
+# Re-serialize every uploaded KLE to check the de/serialization (always on in debug mode)
+app.config['VERIFY_ROUNDTRIP'] = os.environ.get('VERIFY_ROUNDTRIP', '') not in ('', '0')
+# Profile every request and keep the profiles of the ones slower than this (in ms), disabled when not set
+app.config['PROFILE_SLOW_MS'] = float(os.environ['PROFILE_SLOW_MS']) if os.environ.get('PROFILE_SLOW_MS') else None
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', 'profiles')
+# Log the timings of every request as a json line (always on in debug mode, e.g. FLASK_DEBUG=1)
+app.config['LOG_REQUESTS'] = os.environ.get('LOG_REQUESTS', '') not in ('', '0')
+if app.config['LOG_REQUESTS']:
+    app.logger.setLevel(logging.INFO)
+
+
+# Per-stage timing of every request (see util/timing.py): the stages are timed with `g.timer.stage(name)`
+# (the pipeline times its own stages), and sent back in a Server-Timing header and logged as a json line (see LOG_REQUESTS).
+@app.before_request
+def start_timer():
+    g.timer = StageTimer()
+    g.profile = None
+    if app.config['PROFILE_SLOW_MS'] is not None and request.endpoint != 'static':
+        g.profile = cProfile.Profile()
+        g.profile.enable()
+
+@app.teardown_request
+def stop_profile(exc):
+    # after_request doesn't run if a view raises (and isn't handled), don't leave the profiler enabled on this thread
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.disable()
+
+@app.after_request
+def report_timings(response: Response) -> Response:
+    timer = g.get('timer')
+    if timer is None or request.endpoint == 'static':
+        return response
+    total = timer.total()
+
+    profile_path = None
+    if g.profile is not None:
+        g.profile.disable()
+        if total * 1000 >= app.config['PROFILE_SLOW_MS']:
+            profile_path = save_profile(g.profile, app.config['PROFILE_DIR'], f"{request.endpoint}-{total * 1000:.0f}ms")
+
+    response.headers['Server-Timing'] = timer.server_timing(total)
+    STAGE_STATS.record({**timer.stages, 'total': total})
+    if not (app.debug or app.config['LOG_REQUESTS']):
+        return response
+    log = {
+        'event': 'request',
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+        'total_ms': round(total * 1000, 2),
+        'stages_ms': {name: round(seconds * 1000, 2) for name, seconds in timer.stages.items()},
+    }
+    if profile_path:
+        log['profile'] = profile_path
+    app.logger.info(json.dumps(log))
+    return response
 
 
 #decorator for homepage 
@@ -26,175 +90,110 @@ def index():
                            mcu_presets=MCU_PRESETS)
 
 
+def generate_artifacts(kle: list, options: Dict[str, Any], netlist = None, artifacts: List[str] = ARTIFACTS,
+                       warnings: Optional[List[str]] = None) -> Dict[str, str]:
+    """Generates the requested `artifacts` (see util/pipeline.py), only running the generators they need.
+    Warnings for the user (e.g. about the netlist) are appended to `warnings`."""
+    # To test de/serialization, only in debug/verify mode. See also /verify
+    verify = app.debug or app.config['VERIFY_ROUNDTRIP']
+    return generate_files(kle, options, netlist, artifacts, RESULTS, verify_roundtrip=verify, timer=g.timer, warnings=warnings)
+
+
 #These functions will run when POST method is used.
 @app.route('/', methods = ["POST", "GET"] )
 def run_script():
     form_data = request.form
 
-
     kle_raw = form_data['kle-raw']
-    board_name = form_data['board-name']
-    if not board_name:
-        board_name = "Keyboard"
-    maintainer = form_data['maintainer']
-    url = form_data['url']
-    lighting = form_data['lighting']
-    vendor_id = form_data['vendor-id']
-    product_id = form_data['product-id']
-    device_ver = form_data['device-ver']
-    manufacturer = form_data['manufacturer']
     mcu_choice = form_data.get('mcu-preset')
-    alternate_layouts = form_data.get("layouts")
-    try:
-        layers = int(form_data.get('layers'))
-    except ValueError as e:
-        raise Exception(f'Number of Layers needs to be an integer, {e}')
-    layout_file = form_data.get('layout-file')
 
     uploaded_file = request.files.get('file')
 
     uploaded_netlist = request.files.get('netlist')
 
     if uploaded_netlist:
-        netlist = str(uploaded_netlist.read(), 'utf-8')
+        # Parsed straight from the upload stream, see util/netlist.py
+        netlist = uploaded_netlist.stream
     else:
         netlist = None
 
     if uploaded_file or kle_raw:
-        if uploaded_file:
-            content = uploaded_file.read()
-            text = str(content, 'utf-8')
-        elif kle_raw:
-            text = '[' + re.sub("(\w+):", r'"\1":',  kle_raw) + ']'
-
         try:
             # print(text)
             # write_file('test-text.json', text)
 
-            # Deserialize json
-            deserialized_path = 'deserialized.json'
-            keyboard = deserialize(json.loads(text))
-
-            # To test de/serialization. Should generate same kle json as provided
-            serialized_path = 'serialized.json'
-            srlzd = serialize(keyboard)
-            # write_file(serialized_path, json.dumps(srlzd, ensure_ascii=False, indent=2, cls=KLEJSONEncoder))
-
-            # MCU PRESET
-
-            mcu_dict = MCU_DICT[mcu_choice]
-            mcu = mcu_dict['mcu']
-            board = mcu_dict['board']
-            bootloader = mcu_dict['bootloader']
-            if netlist:
-                output_pin_pref = mcu_dict['output_pin_pref']
-                schem_pin_pref = mcu_dict['schem_pin_pref']
-
-            diode_dir = "COL2ROW"
-            if mcu_choice != 'None' and netlist:
-                try:
-                    pin_dict = extract_matrix_pins(netlist, mcu, output_pin_pref, schem_pin_pref)
-                except Exception as e:
-                    raise Exception(f"Invalid netlist provided!, {e}")
-            elif mcu_choice == 'None' and netlist:
-                raise Exception("You need to choose a MCU preset to utilise the netlist function!")
-            else:
-                pin_dict = {}
-
-            # Parse alt layouts
-            if alternate_layouts:
-                alt_layouts = json.loads(alternate_layouts)
-            else:
-                alt_layouts = {}
-
-            # Generate a QMK info.json file used for QMK Configurator
-            qmk_info_path = 'info.json'
-            qmk_info_json = kbd_to_qmk_info(keyboard, board_name, maintainer, url, vendor_id, product_id, device_ver, mcu, bootloader, board, pin_dict, diode_dir, manufacturer, alt_layouts)
-            qmk_info_content = json.dumps(qmk_info_json, indent=4, separators=(', ', ': '), sort_keys=False, cls=InfoJSONEncoder)
-            # write_file(qmk_info_path, qmk_info_content)
-
-
-            # Generate a VIAL json file used to identify a keyboard in VIAL. Same as via but with encoders and no required product/vendor ID
-            # Also generate a config.h file with a randomly generated UID and unlocking combo (if included)
-            vial_vendor_id = vendor_id
-            vial_product_id = product_id
-            vial_uid = gen_uid()
-            vial_json, vial_config_h = kbd_to_vial(keyboard, vial_uid, vial_vendor_id, vial_product_id, lighting, board_name)
-
-            vial_json_path = 'vial.json'
-            vial_json_content = json.dumps(vial_json, ensure_ascii=False, indent=2, cls=KLEJSONEncoder)
-            # write_file(vial_json_path, vial_json_content)
-
-            vial_config_h_path = 'config.h'
-            # write_file(vial_config_h_path, vial_config_h)
-
-            keyboard_h_content = kbd_to_layout_macro(keyboard)
-
-            if layout_file:
-                layout_dict = layout_str_to_layout_dict(layout_file)
-
-                def retrieve_keycodes_md(link=None):
-                    print('retrieving keycodes.md from github')
-                    if not link:
-                        link = "https://raw.githubusercontent.com/qmk/qmk_firmware/master/docs/keycodes.md"
-                    return requests.get(link).text
-
-                keycodes_md_path = 'keycodes.md'
-
-                if not os.path.exists(keycodes_md_path):
-                    write_file(keycodes_md_path, retrieve_keycodes_md())
-
-                timestamp = os.path.getmtime(keycodes_md_path)
-                datestamp = datetime.datetime.fromtimestamp(timestamp)
-
-                # Update keycodes.md if it's old
-                if datestamp < datetime.datetime.now() - datetime.timedelta(weeks=104):
-                    content = retrieve_keycodes_md()
-                    keycodes_dict = keycodes_md_to_keycode_dict(content)
-                    write_file(keycodes_md_path, content)
-                else: # Otherwise just use the cached version
-                    keycodes_dict = keycodes_md_to_keycode_dict(read_file(keycodes_md_path))
-
-                conversion_dict = generate_keycode_conversion_dict(read_file('deprecated_keycodes.txt'))
-
-                keymap_content = kbd_to_keymap(keyboard, layers, 1, layout_dict, keycodes_dict, conversion_dict)
-            else:
-                keymap_content = kbd_to_keymap(keyboard, layers, 1)
-
-            main_config_h_content = kbd_to_main_config(keyboard, layers)
+            options = read_options(form_data)
+            with g.timer.stage('parse'):
+                if uploaded_file:
+                    content = uploaded_file.read()
+                    text = str(content, 'utf-8')
+                    kle = json.loads(text)
+                else:
+                    kle = parse_kle_raw(kle_raw)
+            warnings = []
+            files = generate_artifacts(kle, options, netlist, warnings=warnings)
+            # for path, content in files.items():
+            #     write_file(path, content)
 
             print("Successfully completed compilation of a board!")
 
 
         except Exception as e:
             error_message = "ERROR: \n\n" + format_exc() + "\n\nREAD THE DOCUMENTATION IF YOU HAVE NOT ALREADY.\nSEE https://github.com/zykrah/firmware-scripts.\n\nIf there isn't a specific error, please contact me."
+            with g.timer.stage('render'):
+                return render_template('index.html',
+                                       qmk_info_json = error_message,
+                                       vial_json = error_message,
+                                       vial_config_h = error_message,
+                                       main_config_h = error_message,
+                                       keyboard_h = error_message,
+                                       keymap = error_message,
+                                       mcu_presets=MCU_PRESETS,
+                                       mcu_choice=mcu_choice
+                                       )
+
+        with g.timer.stage('render'):
             return render_template('index.html',
-                                   qmk_info_json = error_message,
-                                   vial_json = error_message,
-                                   vial_config_h = error_message,
-                                   main_config_h = error_message,
-                                   keyboard_h = error_message,
-                                   keymap = error_message,
-                                   mcu_presets=MCU_PRESETS,
-                                   mcu_choice=mcu_choice
-                                   )
-
-        return render_template('index.html',
-                                qmk_info_json = qmk_info_content,
-                                vial_json = vial_json_content,
-                                vial_config_h = vial_config_h,
-                                main_config_h = main_config_h_content,
-                                keyboard_h = keyboard_h_content,
-                                keymap = keymap_content,
-                                mcu_presets=MCU_PRESETS,
-                                mcu_choice=mcu_choice
-                                )
+                                    qmk_info_json = files['info.json'],
+                                    vial_json = files['vial.json'],
+                                    vial_config_h = files['vial_config.h'],
+                                    main_config_h = files['config.h'],
+                                    keyboard_h = files['keyboard.h'],
+                                    keymap = files['keymap.c'],
+                                    warnings = warnings,
+                                    mcu_presets=MCU_PRESETS,
+                                    mcu_choice=mcu_choice
+                                    )
     
     else:
         return index()
         #This just reloads the page if no file is selected and the user tries to POST. 
 
 
+# Checks the de/serialization of a KLE on demand (same inputs as the main page)
+@app.route('/verify', methods = ["POST"] )
+def verify():
+    kle_raw = request.form.get('kle-raw')
+    uploaded_file = request.files.get('file')
+
+    if uploaded_file:
+        text = str(uploaded_file.read(), 'utf-8')
+        load = lambda: json.loads(text)
+    elif kle_raw:
+        load = lambda: parse_kle_raw(kle_raw)
+    else:
+        return jsonify({'error': 'No KLE provided'}), 400
+
+    try:
+        with g.timer.stage('verify'):
+            keyboard = deserialize(load())
+            result = verify_roundtrip(keyboard, load())
+    except Exception:
+        return jsonify({'error': format_exc()}), 400
+
+    return jsonify(result)
+
+
 VIA_TEMPLATE = """{
   "name": "Keyboard",
   "layouts": {
@@ -203,6 +202,17 @@ VIA_TEMPLATE = """{
   }
 }"""
 
+def via_to_kle_json(via_json: str | Dict[str, Any] = None, raw_kle: str = None) -> str:
+    """Converts a VIA/L json (or just KLE raw data) to a Firmware Script KLE json."""
+    if raw_kle:
+        # Just the keymap, the same as VIA_TEMPLATE with the raw data in it
+        via_json = {'name': 'Keyboard', 'layouts': {'labels': [], 'keymap': parse_kle_raw(raw_kle)}}
+    elif not via_json:
+        via_json = VIA_TEMPLATE
+
+    # TO-DO: Create a proper KLE raw data JSON encoder
+    return json.dumps(serialize(via_to_kbd(via_json)), ensure_ascii=False, indent=2, cls=KLEJSONEncoder)
+
 #These functions will run when POST method is used.
 @app.route('/from-via', methods = ["POST", "GET"] )
 def run_script_():
@@ -212,16 +222,8 @@ def run_script_():
 
     if via_json or raw_kle:
         try:
-            if not via_json:
-                via_json = VIA_TEMPLATE
-            if raw_kle:
-                keymap = json.loads('[' + re.sub("(\w+):", r'"\1":',  raw_kle) + ']')
-                obj = json.loads(VIA_TEMPLATE)
-                obj['layouts']['keymap'] = keymap
-                via_json = json.dumps(obj)
-
-            # TO-DO: Create a proper KLE raw data JSON encoder
-            kle_ouput = json.dumps(serialize(via_to_kbd(via_json)), ensure_ascii=False, indent=2, cls=KLEJSONEncoder)
+            with g.timer.stage('convert'):
+                kle_ouput = via_to_kle_json(via_json, raw_kle)
             
             print("Successfully completed a conversion of a via json!")
 
@@ -236,6 +238,118 @@ def run_script_():
       #This just reloads the page if no file is selected and the user tries to POST. 
 
 
+# JSON API
+# Same inputs as the pages (form field names), either as a json body or as a multipart form.
+# Returns {file name: content}, or a zip of the files with `format=zip`.
+
+def api_data() -> Dict[str, Any]:
+    """The request's json body, or its form fields."""
+    if request.is_json:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            raise ValueError("The request body must be a json object")
+        return data
+    return request.form
+
+def api_error(message: str, status: int = 400) -> Response:
+    return make_response(jsonify({'error': message}), status)
+
+def api_response(files: Dict[str, str], data: Dict[str, Any], warnings: List[str] = None) -> Response:
+    """The files as a json object or a zip. `warnings` (if any) are added as a `warnings` list, or a warnings.txt in the zip."""
+    file_format = request.args.get('format') or data.get('format') or 'json'
+    if file_format == 'zip':
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            for path, content in files.items():
+                zip_file.writestr(path, content)
+            if warnings:
+                zip_file.writestr('warnings.txt', '\n'.join(warnings) + '\n')
+        buffer.seek(0)
+        return send_file(buffer, mimetype='application/zip', as_attachment=True, download_name='firmware.zip')
+    elif file_format == 'json':
+        return jsonify({**files, 'warnings': warnings} if warnings else files)
+    raise ValueError(f"Unknown format {file_format!r}, must be 'json' or 'zip'")
+
+def requested_artifacts(data: Dict[str, Any]) -> List[str]:
+    """`artifacts` can be given as a list or a comma separated string, all files are generated by default."""
+    artifacts = request.args.get('artifacts') or data.get('artifacts')
+    if not artifacts:
+        return ARTIFACTS
+    if isinstance(artifacts, str):
+        artifacts = [artifact.strip() for artifact in artifacts.split(',') if artifact.strip()]
+    elif not isinstance(artifacts, list):
+        raise ValueError(f"artifacts must be a list or a comma separated string of {ARTIFACTS}")
+    unknown = [artifact for artifact in artifacts if artifact not in ARTIFACTS]
+    if unknown:
+        raise ValueError(f"Unknown artifacts {unknown}, must be some of {ARTIFACTS}")
+    return artifacts
+
+@app.route('/api/convert', methods = ["POST"] )
+def api_convert():
+    try:
+        data = api_data()
+        artifacts = requested_artifacts(data)
+        options = read_options(data)
+
+        # KLE json (`kle`, a list or a json string), KLE raw data (`kle-raw`) or an uploaded KLE json (`file`)
+        with g.timer.stage('parse'):
+            kle = data.get('kle')
+            uploaded_file = request.files.get('file')
+            if isinstance(kle, str):
+                kle = json.loads(kle)
+            elif kle is None and uploaded_file:
+                kle = json.loads(str(uploaded_file.read(), 'utf-8'))
+            elif kle is None and data.get('kle-raw'):
+                kle = parse_kle_raw(data['kle-raw'])
+        if not isinstance(kle, list):
+            return api_error("No KLE provided (kle, kle-raw or file)")
+
+        # KiCAD netlist, as text (`netlist`) or an uploaded file
+        uploaded_netlist = request.files.get('netlist')
+        netlist = uploaded_netlist.stream if uploaded_netlist else data.get('netlist')
+
+        warnings = []
+        files = generate_artifacts(kle, options, netlist, artifacts, warnings)
+        with g.timer.stage('response'):
+            return api_response(files, data, warnings)
+
+    except ValueError as e: # invalid input
+        return api_error(str(e))
+    except Exception as e:
+        app.logger.exception("%s failed", request.path)
+        return api_error(str(e), 500)
+
+@app.route('/api/from-via', methods = ["POST"] )
+def api_from_via():
+    try:
+        data = api_data()
+        # `via-json` can be a json string or (in a json body) an object, via_to_kbd() takes both
+        via_json = data.get('via-json')
+        raw_kle = data.get('raw-kle')
+        if not via_json and not raw_kle:
+            return api_error("No VIA/L json or KLE raw data provided (via-json or raw-kle)")
+
+        with g.timer.stage('convert'):
+            files = {'kle.json': via_to_kle_json(via_json, raw_kle)}
+        with g.timer.stage('response'):
+            return api_response(files, data)
+
+    except ValueError as e: # invalid input
+        return api_error(str(e))
+    except Exception as e:
+        app.logger.exception("%s failed", request.path)
+        return api_error(str(e), 500)
+
+@app.route('/api/stats', methods = ["GET"] )
+def api_stats():
+    """Rolling percentiles (in ms) of every stage over the last requests, and the cache hit counts."""
+    return jsonify({
+        'stages': STAGE_STATS.percentiles(),
+        'results_cache': RESULTS.stats(),
+        'keycodes': KEYCODES.stats(),
+    })
+
+
 if __name__ == '__main__':
     app.run(debug = True)
 
@@ -1,10 +1,9 @@
-from util.serial import serialize, deserialize
+from util.serial import serialize, deserialize, sort_keys
 from util.util import read_file, write_file, gen_uid, MCU_DICT
-from util.converters import kbd_to_qmk_info, kbd_to_vial, kbd_to_keymap, layout_str_to_layout_dict, keycodes_md_to_keycode_dict, generate_keycode_conversion_dict, kbd_to_main_config, extract_matrix_pins
+from util.converters import kbd_to_qmk_info, kbd_to_vial, kbd_to_keymap, layout_str_to_layout_dict, kbd_to_main_config, extract_matrix_pins
+from util.keycodes import KEYCODES
+from util.layouts import analyze_keyboard
 import json
-import requests
-import os
-import datetime
 
 from util.json_encoders import * # from qmk_firmware/lib/python/qmk/json_encoders.py, for generating info.json
 
@@ -16,6 +15,8 @@ read_content = read_file(input_kle_json_path)
 # Deserialize json
 deserialized_path = 'deserialized.json'
 keyboard = deserialize(json.loads(read_content))
+# The generators expect the keys in KLE order
+sort_keys(keyboard.keys)
 
 # To test de/serialization. Should generate same kle json as provided
 serialized_path = 'serialized.json'
@@ -53,16 +54,22 @@ if netlist:
 diode_dir = "COL2ROW" # default
 if mcu_choice != 'None' and netlist:
     try:
-        pin_dict = extract_matrix_pins(netlist, mcu, output_pin_pref, schem_pin_pref)
+        warnings = []
+        pin_dict = extract_matrix_pins(netlist, mcu, output_pin_pref, schem_pin_pref, warnings=warnings)
     except Exception as e:
         raise Exception(f"Invalid netlist provided!, {e}")
+    for warning in warnings:
+        print(f"WARNING: {warning}")
 elif mcu_choice == 'None' and netlist:
     raise Exception("You need to choose a MCU preset to utilise the netlist function!")
 else:
     pin_dict = {}
 
+# Layout analysis, shared by all the generators
+analysis = analyze_keyboard(keyboard)
+
 qmk_info_path = 'info.json'
-qmk_info_content = kbd_to_qmk_info(keyboard, name, maintainer, url, vid, pid, ver, mcu, bootloader, board, pin_dict, diode_dir, manufacturer)
+qmk_info_content = kbd_to_qmk_info(keyboard, name, maintainer, url, vid, pid, ver, mcu, bootloader, board, pin_dict, diode_dir, manufacturer, analysis=analysis)
 write_file(qmk_info_path, json.dumps(qmk_info_content, indent=4, separators=(', ', ': '), sort_keys=False, cls=InfoJSONEncoder))
 
 
@@ -73,7 +80,7 @@ vial_product_id = '0x0000'
 vial_uid = gen_uid()
 vial_json_path = 'vial.json'
 vial_config_h_path = 'config.h'
-vial_json_content, vial_config_h = kbd_to_vial(keyboard, vial_uid, vial_vendor_id, vial_product_id)
+vial_json_content, vial_config_h = kbd_to_vial(keyboard, vial_uid, vial_vendor_id, vial_product_id, analysis=analysis)
 write_file(vial_json_path, json.dumps(vial_json_content, ensure_ascii=False, indent=2, cls=KLEJSONEncoder))
 write_file(vial_config_h_path, vial_config_h)
 
@@ -83,32 +90,14 @@ write_file(vial_config_h_path, vial_config_h)
 keymap_c_path = 'keymap.c'
 layout_dict = layout_str_to_layout_dict(read_file('vil.json'))
 
-def retrieve_keycodes_md(link=None):
-    print('retrieving keycodes.md from github')
-    if not link:
-        link = "https://raw.githubusercontent.com/qmk/qmk_firmware/master/docs/keycodes.md"
-    return requests.get(link).text
-
-keycodes_md_path = 'keycodes.md'
-
-if not os.path.exists(keycodes_md_path):
-    write_file(keycodes_md_path, retrieve_keycodes_md())
-
-timestamp = os.path.getmtime(keycodes_md_path)
-datestamp = datetime.datetime.fromtimestamp(timestamp)
-
-# Update keycodes.md if it's old (HAVE TEMPORARILY SET TO 2 YEARS)
-if datestamp < datetime.datetime.now() - datetime.timedelta(weeks=104):
-    content = retrieve_keycodes_md()
-    keycodes_dict = keycodes_md_to_keycode_dict(content)
-    write_file(keycodes_md_path, content)
-else: # Otherwise just use the cached version
-    keycodes_dict = keycodes_md_to_keycode_dict(read_file(keycodes_md_path))
-
+# Fetch keycodes.md if it's missing or old (HAVE TEMPORARILY SET TO 2 YEARS)
+if KEYCODES.refresher.is_stale():
+    KEYCODES.refresher.refresh()
 
-conversion_dict = generate_keycode_conversion_dict(read_file('deprecated_keycodes.txt'))
+keycodes_dict = KEYCODES.keycode_dict()
+conversion_dict = KEYCODES.conversion_dict()
 
-keymap_c_content = kbd_to_keymap(keyboard, layers, 1, layout_dict, keycodes_dict, conversion_dict)
+keymap_c_content = kbd_to_keymap(keyboard, layers, 1, layout_dict, keycodes_dict, conversion_dict, analysis=analysis)
 write_file(keymap_c_path, keymap_c_content)
 
 main_config_h_content = kbd_to_main_config(keyboard, layers)
@@ -0,0 +1,38 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from batch import BatchBoard, boards_from_directory, boards_from_manifest, run_batch
+from util.keycodes import KEYCODES
+
+BOARDS = Path(__file__).parent / 'fixtures' / 'boards'
+
+
+def test_run_batch_in_process_keeps_refresher(tmp_path):
+    refresher = KEYCODES.refresher
+    results = run_batch([BatchBoard('small', kle_path=str(BOARDS / 'small.json'))], str(tmp_path), ['info.json'], jobs=1)
+    assert [(result.name, result.ok) for result in results] == [('small', True)]
+    assert (tmp_path / 'small' / 'info.json').exists()
+    assert KEYCODES.refresher is refresher
+
+
+def test_boards_from_directory_skips_generated_files(tmp_path):
+    # The fixtures have <board>.info.json, <board>.vial.json... next to each board
+    assert [board.name for board in boards_from_directory(str(BOARDS), {})] == ['medium', 'nomix', 'small']
+
+    # A second run over an output directory
+    run_batch([BatchBoard('small', kle_path=str(BOARDS / 'small.json'))], str(tmp_path), ['info.json'], jobs=1)
+    (tmp_path / 'small.json').write_text((BOARDS / 'small.json').read_text())
+    (tmp_path / 'small.vial.json').write_text('{}')
+    assert [board.name for board in boards_from_directory(str(tmp_path), {})] == ['small']
+
+
+def test_boards_from_manifest_names(tmp_path):
+    manifest = tmp_path / 'boards.json'
+    manifest.write_text(json.dumps([{'name': '../../evil', 'kle': 'a.json'}, {'name': 'my board/v2', 'kle': 'b.json'}, {'kle': 'dir/c.json'}]))
+    assert [board.name for board in boards_from_manifest(str(manifest), {})] == ['_.._evil', 'my_board_v2', 'c']
+
+    manifest.write_text(json.dumps([{'name': '..', 'kle': 'a.json'}]))
+    with pytest.raises(Exception, match="Invalid board name '..'"):
+        boards_from_manifest(str(manifest), {})
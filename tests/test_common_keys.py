@@ -0,0 +1,56 @@
+import pytest
+
+from util.common_keys import COMMON_KEYS, COMMON_MODS_BY_WIDTH, normalize_labels, get_common_keycode
+
+
+def labels(*pairs) -> list:
+    """12 labels, with the given (index, label) pairs set"""
+    lbls = [""] * 12
+    for ndx, label in pairs:
+        lbls[ndx] = label
+    return lbls
+
+
+def test_normalize_labels():
+    # The multilayout (3, 5, 7) and matrix (9, 11) labels are ignored
+    lbls = labels((0, "!"), (3, "1"), (5, "0"), (6, "1"), (7, "Option"), (9, "2"), (11, "4"))
+    assert normalize_labels(lbls) == tuple(labels((0, "!"), (6, "1")))
+    # Short label lists are fine too, and the input isn't modified
+    assert normalize_labels(["Q", "", "", "", ""]) == ("Q", "", "", "", "")
+    assert lbls[9] == "2"
+
+
+def test_common_keycode_by_labels():
+    assert get_common_keycode(labels((0, "Q"))) == "KC_Q"
+    assert get_common_keycode(labels((0, "!"), (6, "1"), (9, "1"), (11, "1"))) == "KC_1"
+    assert get_common_keycode(labels((0, "Q"), (3, "0"), (5, "1"))) == "KC_Q"
+    assert get_common_keycode(labels((0, "Nope"))) is None
+    # Every COMMON_KEYS entry (other than modifier placeholders) resolves to itself at 1u
+    for keycode, lbls in COMMON_KEYS.items():
+        if keycode.startswith('KC_'):
+            assert get_common_keycode(lbls) == keycode
+
+
+def test_common_mods_by_width():
+    assert COMMON_MODS_BY_WIDTH == {
+        ("SFT", 2.25): "KC_LSFT",
+        ("SFT", 2.75): "KC_RSFT",
+        ("SFT", 1.75): "KC_RSFT",
+        ("", 6.25): "KC_SPC",
+        ("", 7): "KC_SPC",
+    }
+
+
+@pytest.mark.parametrize("lbls, width, keycode", [
+    (labels((0, "Shift")), 2.25, "KC_LSFT"),
+    (labels((0, "Shift")), 2.75, "KC_RSFT"),
+    (labels((0, "Shift"), (9, "4"), (11, "12")), 1.75, "KC_RSFT"),
+    (labels((0, "Shift")), 1, "SFT"), # no width match, the placeholder as before
+    (labels(), 6.25, "KC_SPC"),
+    (labels(), 7, "KC_SPC"),
+    (labels((9, "4"), (11, "5")), 6.25, "KC_SPC"),
+    (labels(), 1, None),
+    (labels((0, "Q")), 6.25, "KC_Q"), # keys with a keycode ignore the width
+])
+def test_common_keycode_by_width(lbls, width, keycode):
+    assert get_common_keycode(lbls, width) == keycode
@@ -0,0 +1,12 @@
+import copy
+
+from util.converters import via_to_kbd
+
+VIA_JSON = {'name': 'test', 'layouts': {'labels': [], 'keymap': [[{'fa': [0, 2]}, '0,0', {'f2': 4}, '0,1']]}}
+
+
+def test_via_to_kbd_leaves_input_unchanged():
+    via_json = copy.deepcopy(VIA_JSON)
+    kbd = via_to_kbd(via_json)
+    assert via_json == VIA_JSON
+    assert [(key.labels[9], key.labels[11]) for key in kbd.keys] == [('0', '0'), ('0', '1')]
@@ -0,0 +1,110 @@
+import io
+import json
+import logging
+import sys
+
+import pytest
+
+import flaskapp
+from flaskapp import app
+from test_converters import VIA_JSON
+from test_pipeline import MATRIX_KLE, NETLISTS, SPLIT_WARNINGS
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+def test_api_from_via_object(client):
+    # An object in a json body and the same object as a string give the same KLE
+    response = client.post('/api/from-via', json={'via-json': VIA_JSON})
+    assert response.status_code == 200
+    assert response.get_json() == client.post('/api/from-via', json={'via-json': json.dumps(VIA_JSON)}).get_json()
+    assert json.loads(response.get_json()['kle.json'])[0][1:] == ['\n\n\n\n0\n0', '\n\n\n\n0\n1']
+
+
+def test_api_from_via_missing_input(client):
+    response = client.post('/api/from-via', json={})
+    assert response.status_code == 400
+    assert response.get_json() == {'error': "No VIA/L json or KLE raw data provided (via-json or raw-kle)"}
+
+
+@pytest.mark.parametrize('body, error', [
+    ({'artifacts': 5}, "artifacts must be a list or a comma separated string of ['info.json', 'vial.json', 'vial_config.h', 'config.h', 'keyboard.h', 'keymap.c']"),
+    ({'artifacts': 'info.json,bogus'}, "Unknown artifacts ['bogus'], must be some of ['info.json', 'vial.json', 'vial_config.h', 'config.h', 'keyboard.h', 'keymap.c']"),
+    ({'mcu-preset': 'Bogus'}, "Unknown MCU preset 'Bogus', must be one of ['None', 'RP2040', '32U4', 'STM32']"),
+    ({'layers': 'four'}, "Number of Layers needs to be an integer, invalid literal for int() with base 10: 'four'"),
+    ({'layouts': [1]}, "Alternate layouts must be an object of layout names to multilayout options, got list"),
+    ({'kle': None, 'kle-raw': '["A" "B"]'}, "Invalid KLE raw data at line 1, column 6: missing ',' before '\"B\"'"),
+])
+def test_api_convert_invalid_options(client, body, error):
+    response = client.post('/api/convert', json={'kle': [['0,0']], **body})
+    assert response.status_code == 400
+    assert response.get_json() == {'error': error}
+
+
+def test_api_convert_internal_error(client, monkeypatch, caplog):
+    # Bugs aren't the client's fault, they are logged and return a 500
+    def broken(*args, **kwargs):
+        raise TypeError("broken generator")
+    monkeypatch.setattr(flaskapp, 'generate_artifacts', broken)
+    response = client.post('/api/convert', json={'kle': [['0,0']]})
+    assert response.status_code == 500
+    assert response.get_json() == {'error': "broken generator"}
+    assert caplog.records[-1].levelno == logging.ERROR and caplog.records[-1].exc_info
+
+
+@pytest.mark.parametrize('form, error', [
+    ({'mcu-preset': 'Bogus'}, "Unknown MCU preset &#39;Bogus&#39;"),
+    ({'layers': ''}, "Number of Layers needs to be an integer"),
+])
+def test_run_script_invalid_options(client, form, error):
+    # Shown on the page like any other error
+    response = client.post('/', data={'kle-raw': '["0,0"]', **form})
+    assert response.status_code == 200
+    assert error in response.get_data(as_text=True)
+
+
+def test_api_convert_warnings(client):
+    netlist = (NETLISTS / 'split.net').read_text()
+    body = {'kle': MATRIX_KLE, 'netlist': netlist, 'mcu-preset': 'RP2040', 'artifacts': ['info.json']}
+    response = client.post('/api/convert', json=body)
+    assert response.status_code == 200
+    assert response.get_json()['warnings'] == SPLIT_WARNINGS
+    # No warnings, no field
+    assert 'warnings' not in client.post('/api/convert', json={**body, 'netlist': None}).get_json()
+
+
+def test_run_script_warnings(client):
+    form = {'kle-raw': json.dumps(MATRIX_KLE)[1:-1], 'mcu-preset': 'RP2040', 'netlist': (io.BytesIO((NETLISTS / 'split.net').read_bytes()), 'split.net')}
+    page = client.post('/', data=form, content_type='multipart/form-data').get_data(as_text=True)
+    assert 'Warnings:' in page
+    assert 'cols 3 not wired to U1 (IO expander?), left as X' in page
+
+
+def test_request_log(client, caplog, capsys, monkeypatch):
+    monkeypatch.setitem(app.config, 'LOG_REQUESTS', True)
+    with caplog.at_level(logging.INFO, logger=app.logger.name):
+        response = client.post('/api/from-via', json={'via-json': VIA_JSON})
+    assert 'convert;dur=' in response.headers['Server-Timing']
+    assert capsys.readouterr().out == ''
+    log = json.loads(caplog.records[-1].getMessage())
+    assert (log['event'], log['path'], log['status']) == ('request', '/api/from-via', 200)
+    assert set(log['stages_ms']) == {'convert', 'response'}
+
+
+def test_request_log_disabled(client, caplog, monkeypatch):
+    monkeypatch.setitem(app.config, 'LOG_REQUESTS', False)
+    with caplog.at_level(logging.INFO, logger=app.logger.name):
+        client.post('/api/from-via', json={'via-json': VIA_JSON})
+    assert not caplog.records
+
+
+def test_profiler_disabled_when_a_view_raises(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'PROFILE_SLOW_MS', 1e9)
+    monkeypatch.setitem(app.config, 'PROPAGATE_EXCEPTIONS', True)
+    # Not utf-8, /verify decodes the upload outside its error handling
+    with pytest.raises(UnicodeDecodeError):
+        client.post('/verify', data={'file': (io.BytesIO(b'\xff\xfe'), 'kle.json')}, content_type='multipart/form-data')
+    assert sys.getprofile() is None
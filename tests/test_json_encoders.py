@@ -0,0 +1,69 @@
+import io
+import json
+from pathlib import Path
+
+import pytest
+
+from util.serial import serialize, deserialize
+from util.converters import kbd_to_qmk_info, kbd_to_vial
+from util.json_encoders import InfoJSONEncoder, KLEJSONEncoder
+
+# <board>.json are KLE exports, the other files were written by the original (generator based) encoders
+BOARDS = Path(__file__).parent / 'fixtures' / 'boards'
+BOARD_NAMES = ['small', 'medium', 'nomix']
+
+
+def read_fixture(name: str) -> str:
+    with open(BOARDS / name, newline='') as f:
+        return f.read()
+
+
+def load_board(name: str):
+    return deserialize(json.loads(read_fixture(f'{name}.json')))
+
+
+@pytest.mark.parametrize('board', BOARD_NAMES)
+def test_info_json(board):
+    kbd = load_board(board)
+    info = kbd_to_qmk_info(kbd, 'board', 'maintainer', '', '0xFEED', '0x0001', '0.0.1', 'RP2040', 'rp2040', None, {}, 'COL2ROW', 'manufacturer')
+    assert json.dumps(info, indent=4, separators=(', ', ': '), sort_keys=False, cls=InfoJSONEncoder) == read_fixture(f'{board}.info.json')
+
+
+@pytest.mark.parametrize('board', BOARD_NAMES)
+def test_vial_json(board):
+    kbd = load_board(board)
+    vial, _ = kbd_to_vial(kbd, '#define VIAL_KEYBOARD_UID {0x00}', '0x7A79', '0x0000')
+    assert json.dumps(vial, ensure_ascii=False, indent=2, cls=KLEJSONEncoder) == read_fixture(f'{board}.vial.json')
+
+
+@pytest.mark.parametrize('board', BOARD_NAMES)
+def test_kle_json(board):
+    rows = serialize(load_board(board))
+    expected = read_fixture(f'{board}.kle.json')
+    assert json.dumps(rows, ensure_ascii=False, indent=2, cls=KLEJSONEncoder) == expected
+
+    # json.dump() goes through iterencode() without _one_shot
+    out = io.StringIO()
+    json.dump(rows, out, ensure_ascii=False, indent=2, cls=KLEJSONEncoder)
+    assert out.getvalue() == expected
+
+
+@pytest.mark.parametrize('board', BOARD_NAMES)
+def test_kle_json_compact(board):
+    rows = serialize(load_board(board))
+    assert json.dumps(rows, cls=KLEJSONEncoder) == read_fixture(f'{board}.kle.min.json')
+
+
+def test_kle_json_whole_floats():
+    # Whole floats are only written as ints when indenting, compact output keeps the stock formatting
+    obj = {'x': 1.0, 'w': 1.25, 'rows': [2.0, -3.0, 0.5], 1.0: 'key'}
+    assert json.dumps(obj, indent=2, cls=KLEJSONEncoder) == \
+        '{\n  "x": 1,\n  "w": 1.25,\n  "rows": [\n    2,\n    -3,\n    0.5\n  ],\n  "1": "key"\n}'
+    assert json.dumps(obj, cls=KLEJSONEncoder) == '{"x": 1.0, "w": 1.25, "rows": [2.0, -3.0, 0.5], "1.0": "key"}'
+    assert json.dumps(obj, cls=KLEJSONEncoder) == json.dumps(obj)
+
+
+def test_kle_json_out_of_range_floats():
+    assert json.dumps([float('nan'), float('inf')], indent=2, cls=KLEJSONEncoder) == '[\n  NaN,\n  Infinity\n]'
+    with pytest.raises(ValueError):
+        json.dumps([float('inf')], indent=2, allow_nan=False, cls=KLEJSONEncoder)
@@ -0,0 +1,97 @@
+import os
+
+from util.keycodes import KeycodesMdRefresher, KeycodeRegistry
+
+KEYCODES_MD = "|Key|Aliases|Description|\n|---|---|---|\n|`KC_ENTER`|`KC_ENT`|Return (Enter)|\n"
+
+
+def test_refresh_replaces_file(tmp_path):
+    path = str(tmp_path / 'keycodes.md')
+    refresher = KeycodesMdRefresher(path, source='test', fetch=lambda source: KEYCODES_MD)
+    assert refresher.is_stale()
+    assert refresher.refresh()
+    assert open(path, encoding='utf-8').read() == KEYCODES_MD
+    assert not os.path.exists(refresher.lock_path)
+    assert not refresher.is_stale()
+
+
+def test_refresh_lock_already_removed(tmp_path):
+    # e.g. another worker took the lock over as a leftover while this one was fetching
+    path = str(tmp_path / 'keycodes.md')
+    def fetch(source):
+        os.remove(path + '.lock')
+        return KEYCODES_MD
+    refresher = KeycodesMdRefresher(path, source='test', fetch=fetch)
+    assert refresher.refresh()
+    assert open(path, encoding='utf-8').read() == KEYCODES_MD
+
+
+def test_refresh_failure_keeps_file(tmp_path):
+    path = tmp_path / 'keycodes.md'
+    path.write_text(KEYCODES_MD, encoding='utf-8')
+    refresher = KeycodesMdRefresher(str(path), source='test', fetch=lambda source: "nothing here")
+    assert not refresher.refresh()
+    assert path.read_text(encoding='utf-8') == KEYCODES_MD
+    assert not os.path.exists(refresher.lock_path)
+
+
+def make_registry(tmp_path):
+    keycodes_md = tmp_path / 'keycodes.md'
+    keycodes_md.write_text(KEYCODES_MD, encoding='utf-8')
+    deprecated = tmp_path / 'deprecated_keycodes.txt'
+    deprecated.write_text("KC_BSPACE         KC_BACKSPACE\n", encoding='utf-8')
+    return KeycodeRegistry(str(keycodes_md), str(deprecated)), keycodes_md, deprecated
+
+
+def test_registry_cache_hit(tmp_path):
+    registry, _, _ = make_registry(tmp_path)
+    keycodes = registry.keycode_dict()
+    assert keycodes == {'KC_ENTER': 'KC_ENT'}
+    assert registry.conversion_dict() == {'KC_BSPACE': 'KC_BACKSPACE'}
+    assert registry.stats() == {'hits': 0, 'misses': 2, 'reloads': 0}
+
+    # Unchanged files aren't parsed again, the same dicts are returned
+    assert registry.keycode_dict() is keycodes
+    registry.conversion_dict()
+    assert registry.stats() == {'hits': 2, 'misses': 2, 'reloads': 0}
+
+
+def test_registry_reload_on_mtime_change(tmp_path):
+    registry, keycodes_md, _ = make_registry(tmp_path)
+    registry.keycode_dict()
+    # Same size, different contents and mtime
+    keycodes_md.write_text(KEYCODES_MD.replace('KC_ENT`', 'KC_ETR`'), encoding='utf-8')
+    st = os.stat(keycodes_md)
+    os.utime(keycodes_md, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    assert registry.keycode_dict() == {'KC_ENTER': 'KC_ETR'}
+    assert registry.stats()['reloads'] == 1
+
+
+def test_registry_reload_on_size_change(tmp_path):
+    registry, keycodes_md, _ = make_registry(tmp_path)
+    registry.keycode_dict()
+    # Same mtime, different size
+    st = os.stat(keycodes_md)
+    keycodes_md.write_text(KEYCODES_MD + "|`KC_ESCAPE`|`KC_ESC`|Escape|\n", encoding='utf-8')
+    os.utime(keycodes_md, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert registry.keycode_dict() == {'KC_ENTER': 'KC_ENT', 'KC_ESCAPE': 'KC_ESC'}
+    assert registry.stats()['reloads'] == 1
+
+
+def test_registry_signature(tmp_path):
+    registry, keycodes_md, deprecated = make_registry(tmp_path)
+    assert registry.signature() == (None, None)
+    registry.keycode_dict()
+    registry.conversion_dict()
+    signature = registry.signature()
+    st_md, st_deprecated = os.stat(keycodes_md), os.stat(deprecated)
+    assert signature == ((st_md.st_mtime_ns, st_md.st_size), (st_deprecated.st_mtime_ns, st_deprecated.st_size))
+
+    # Unchanged until a changed file is read again
+    registry.keycode_dict()
+    assert registry.signature() == signature
+    deprecated.write_text("KC_BSPACE         KC_BACKSPACE\nKC_LBRACKET       KC_LEFT_BRACKET\n", encoding='utf-8')
+    assert registry.signature() == signature
+    registry.conversion_dict()
+    assert registry.signature() != signature
+    assert registry.signature()[0] == signature[0]
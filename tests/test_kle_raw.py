@@ -0,0 +1,90 @@
+import json
+
+import pytest
+
+from util.kle_raw import parse_kle_raw
+
+
+def test_parse_kle_raw():
+    raw = '{name:"Test",author:"me"},\n["Q","W"],\n[{w:2,a:7,f:3.5,d:true,g:false,sm:null},"A\\nB"]'
+    assert parse_kle_raw(raw) == [
+        {'name': 'Test', 'author': 'me'},
+        ['Q', 'W'],
+        [{'w': 2, 'a': 7, 'f': 3.5, 'd': True, 'g': False, 'sm': None}, 'A\nB'],
+    ]
+
+
+def test_parse_kle_raw_numbers():
+    assert parse_kle_raw('[{x:-0.25,y:1e1,w:0x10,h:.5}]') == [[{'x': -0.25, 'y': 10.0, 'w': 16, 'h': 0.5}]]
+    assert type(parse_kle_raw('[{x:1}]')[0][0]['x']) is int
+
+
+def test_parse_kle_raw_quoted_keys():
+    assert parse_kle_raw('[{"w":2,\'h\':2},"A"]') == [[{'w': 2, 'h': 2}, 'A']]
+
+
+def test_parse_kle_raw_comments():
+    raw = '// exported from KLE\n["Q", /* the W key */ "W"], // first row\n/* multi\nline */["A"]'
+    assert parse_kle_raw(raw) == [['Q', 'W'], ['A']]
+
+
+def test_parse_kle_raw_single_quotes():
+    assert parse_kle_raw("['Q','\"W\"','it\\'s','\\x41\\u0042']") == [['Q', '"W"', "it's", 'AB']]
+
+
+def test_parse_kle_raw_escapes():
+    assert parse_kle_raw('["a\\nb\\tc\\\\d\\"e", "\\ud83d\\ude00", "\\u00e9"]') == [['a\nb\tc\\d"e', '\U0001F600', 'é']]
+
+
+def test_parse_kle_raw_trailing_commas():
+    assert parse_kle_raw('["Q","W",],\n[{w:2,},"A",],') == [['Q', 'W'], [{'w': 2}, 'A']]
+    assert parse_kle_raw('[],[{}]') == [[], [{}]]
+
+
+def test_parse_kle_raw_whole_json():
+    # A whole KLE json (e.g. a downloaded file) pasted as raw data is unwrapped
+    kle = [{'name': 'Test'}, ['Q', 'W'], [{'w': 2}, 'A']]
+    assert parse_kle_raw(json.dumps(kle, indent=2)) == kle
+    assert parse_kle_raw(json.dumps(kle[1:])) == kle[1:]
+    # A single row is raw data, not a whole json
+    assert parse_kle_raw('["Q","W"]') == [['Q', 'W']]
+
+
+def test_parse_kle_raw_empty():
+    assert parse_kle_raw('') == []
+    assert parse_kle_raw(' // nothing\n') == []
+
+
+@pytest.mark.parametrize('raw, error', [
+    ('{w:2 y:1}', "at line 1, column 6: missing ',' before 'y'"),
+    ('["A" "B"]', "at line 1, column 6: missing ',' before '\"B\"'"),
+    ('["A"]["B"]', "at line 1, column 6: missing ',' before '['"),
+    ('[1 2]', "at line 1, column 4: missing ',' before '2'"),
+    ('["A",\n  "B"\n  "C"]', "at line 3, column 3: missing ',' before '\"C\"'"),
+    ('[Q]', "at line 1, column 2: unexpected 'Q' (strings need quotes)"),
+    ('["Q', "at line 1, column 2: unterminated string"),
+    ("['Q", "at line 1, column 2: unterminated string"),
+    ('[,]', "at line 1, column 2: expected a value, got ','"),
+    ('["a":1]', "at line 1, column 5: expected ',' or a closing bracket, got ':'"),
+    ('{w 2}', "at line 1, column 4: expected ':', got '2'"),
+    ('{w {}}', "at line 1, column 4: expected ':', got '{'"),
+    ('{,}', "at line 1, column 2: expected a key or '}', got ','"),
+    ('{w:}', "at line 1, column 4: expected a value, got '}'"),
+    ('[}', "at line 1, column 2: expected a value, got '}'"),
+    (']', "at line 1, column 1: expected a value, got ']'"),
+    ('[/]', "at line 1, column 2: unexpected '/'"),
+])
+def test_parse_kle_raw_errors(raw, error):
+    with pytest.raises(ValueError) as e:
+        parse_kle_raw(raw)
+    assert str(e.value) == f"Invalid KLE raw data {error}"
+
+
+@pytest.mark.parametrize('raw, error', [
+    ('["Q"', "missing ] at the end"),
+    ('[{w:1', "missing } at the end"),
+])
+def test_parse_kle_raw_incomplete(raw, error):
+    with pytest.raises(ValueError) as e:
+        parse_kle_raw(raw)
+    assert str(e.value) == f"Invalid KLE raw data: {error}"
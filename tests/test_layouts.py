@@ -0,0 +1,113 @@
+import copy
+import json
+from pathlib import Path
+
+import pytest
+
+from util.serial import Key, Keyboard, deserialize
+from util.layouts import (MultilayoutIndex, generate_ml_dict, get_layout_all, get_alternate_layouts, get_specific_layout, analyze_keyboard,
+                           extract_row_col, extract_ml_val_ndx, count_encoders)
+
+BOARDS = Path(__file__).parent / 'fixtures' / 'boards'
+
+
+def ml_key(x: float, y: float, ml_ndx: int, ml_val: int, row: int = 0, col: int = 0) -> Key:
+    labels = [''] * 12
+    labels[3], labels[5] = str(ml_ndx), str(ml_val)
+    labels[9], labels[11] = str(row), str(col)
+    return Key(labels=labels, x=x, y=y)
+
+
+def test_generate_ml_dict():
+    keys = [ml_key(0, 0, 0, 0), ml_key(1, 0, 0, 0, col=1), ml_key(0, 1, 0, 1), ml_key(5, 0, 1, 0), ml_key(5, 1, 1, 1)]
+    ml_dict = generate_ml_dict(keys)
+    assert ml_dict == {0: {0: keys[:2], 1: [keys[2]]}, 1: {0: [keys[3]], 1: [keys[4]]}}
+
+
+def test_generate_ml_dict_equal_keys():
+    # Equal keys (e.g. a key duplicated in the KLE) are only added once, even if they are different objects
+    key, duplicate = ml_key(0, 0, 0, 0), ml_key(0, 0, 0, 0)
+    assert key is not duplicate and key == duplicate
+    other = ml_key(0, 1, 0, 1)
+    ml_dict = generate_ml_dict([key, duplicate, other])
+    assert len(ml_dict[0][0]) == 1 and ml_dict[0][0][0] is key
+
+
+def test_generate_ml_dict_keys_in_other_places():
+    # Keys with the same labels in different places aren't equal
+    keys = [ml_key(0, 0, 0, 0), ml_key(1, 0, 0, 0), ml_key(0, 1, 0, 1)]
+    assert generate_ml_dict(keys)[0][0] == keys[:2]
+
+
+def test_generate_ml_dict_incomplete():
+    with pytest.raises(Exception, match="Multilayout index 0 is not a valid/complete multilayout"):
+        generate_ml_dict([ml_key(0, 0, 0, 0), ml_key(0, 1, 0, 2)])
+
+
+@pytest.mark.parametrize('board', ['small', 'medium', 'nomix'])
+def test_get_layout_all_leaves_keyboard_unchanged(board):
+    kbd = deserialize(json.loads((BOARDS / f'{board}.json').read_text()))
+    before = copy.deepcopy(kbd)
+    layout_all = get_layout_all(kbd)
+    assert kbd == before
+    assert len(layout_all.keys) <= len(kbd.keys)
+
+
+def rows_cols(keys):
+    rows = cols = 0
+    for key in keys:
+        row, col = extract_row_col(key)
+        rows, cols = max(rows, row + 1), max(cols, col + 1)
+    return rows, cols
+
+
+@pytest.mark.parametrize('board', ['small', 'medium', 'nomix'])
+def test_keyboard_analysis(board):
+    # Same results as calling the helpers for every generator
+    kbd = deserialize(json.loads((BOARDS / f'{board}.json').read_text()))
+    analysis = analyze_keyboard(kbd)
+
+    assert analysis.matrix == [extract_row_col(key) for key in kbd.keys]
+    assert (analysis.rows, analysis.cols) == rows_cols(kbd.keys)
+    assert analysis.ml_vals == [extract_ml_val_ndx(key) if key.labels[3] and key.labels[5] else None for key in kbd.keys]
+    assert analysis.encoders_num == count_encoders(kbd.keys)
+
+    layout_all = get_layout_all(kbd)
+    assert analysis.layout_all == layout_all
+    assert analysis.layout_all is analysis.layout_all
+    assert analysis.layout_all_matrix == [extract_row_col(key) for key in layout_all.keys]
+    assert (analysis.layout_all_rows, analysis.layout_all_cols) == rows_cols(layout_all.keys)
+
+    num_options = len(analysis.ml_index.ml_dict)
+    layout_info = {'All Zero': [0] * num_options, 'All One': [1] * num_options}
+    assert get_alternate_layouts(kbd, layout_info, analysis.ml_index) == get_alternate_layouts(kbd, layout_info)
+
+
+def fixed_key(x: float, y: float) -> Key:
+    return Key(labels=[''] * 12, x=x, y=y)
+
+
+@pytest.mark.parametrize('option_counts, expected', [
+    ([], [[]]),
+    ([3], [[0], [1], [2]]),
+    ([2, 3], [[0, 0], [0, 1], [0, 2], [1, 0], [1, 1], [1, 2]]),
+    ([3, 2, 4], [[a, b, c] for a in range(3) for b in range(2) for c in range(4)]),
+])
+def test_multilayout_index_combinations(option_counts, expected):
+    # Each option of a multilayout is a key in its own row below the keyboard, the option with the same index in every group
+    keys = [fixed_key(0, 0), fixed_key(1, 0)]
+    for ml_ndx, count in enumerate(option_counts):
+        keys += [ml_key(2 + ml_ndx, 1 + ml_val, ml_ndx, ml_val) for ml_val in range(count)]
+    kbd = Keyboard(keys=keys)
+    ml_index = MultilayoutIndex(kbd)
+
+    assert list(ml_index.combinations()) == expected
+    layouts = list(ml_index.layouts())
+    assert [layout_idx for layout_idx, _ in layouts] == expected
+    for layout_idx, layout_keys in layouts:
+        assert layout_keys == get_specific_layout(kbd, layout_idx)
+        assert len(layout_keys) == 2 + len(option_counts)
+        # The selected option of each multilayout, moved in place of its 0th option
+        ml_keys = [key for key in layout_keys if key.labels[3]]
+        assert [(key.labels[3], key.labels[5]) for key in ml_keys] == [(str(ml_ndx), str(ml_val)) for ml_ndx, ml_val in enumerate(layout_idx)]
+        assert [(key.x, key.y) for key in ml_keys] == [(2 + ml_ndx, 1) for ml_ndx in range(len(option_counts))]
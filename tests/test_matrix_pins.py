@@ -0,0 +1,90 @@
+import os
+
+import pytest
+
+from util.netlist import Netlist, NetlistComponent, NetlistNode
+from util.util import extract_matrix_pins
+
+NETLISTS = os.path.join(os.path.dirname(__file__), 'fixtures', 'netlists')
+
+
+def read_netlist(name: str) -> str:
+    with open(os.path.join(NETLISTS, name), encoding='utf-8') as file:
+        return file.read()
+
+
+def netlist(nets: dict, mcus=('U1', )) -> Netlist:
+    """A Netlist with RP2040 `mcus` and {net name: [(ref, pinfunction), ...]} nets"""
+    return Netlist({ref: NetlistComponent(ref, 'RP2040') for ref in mcus},
+                   {name: [NetlistNode(ref, '1', pinfunction) for ref, pinfunction in nodes] for name, nodes in nets.items()})
+
+
+def test_net_numbers():
+    # Pins are ordered by the number in the net name, not by the order of the nets
+    nets = {f'COL{n}': [('U1', f'GPIO{n}')] for n in (0, 1, 10, 11, 2, 3, 4, 5, 6, 7, 8, 9)}
+    nets['row0'] = [('U1', 'GPIO20')]
+    nets['Row_1'] = [('U1', 'GPIO21')]
+    warnings = []
+    assert extract_matrix_pins(netlist(nets), warnings=warnings) == {
+        'cols': [f'GP{n}' for n in range(12)],
+        'rows': ['GP20', 'GP21'],
+    }
+    assert warnings == []
+
+
+def test_hierarchical_net_names():
+    # The number is taken from the last part of the net name (the sheet path is ignored)
+    nets = {
+        '/Matrix/COL0': [('U1', 'GPIO0')],
+        '/Row 7 sheet/COL1': [('U1', 'GPIO1')],
+        '/Matrix/ROW0': [('U1', 'GPIO2')],
+        '/COL9/LED': [('U1', 'GPIO3')], # not a matrix net
+        'Net-(D1-A)': [('U1', 'GPIO4')],
+    }
+    assert extract_matrix_pins(netlist(nets)) == {'cols': ['GP0', 'GP1'], 'rows': ['GP2']}
+
+
+def test_most_wired_mcu():
+    warnings = []
+    pins = extract_matrix_pins(read_netlist('split.net'), warnings=warnings)
+    # U1 is wired to 4 matrix nets, U2 to 2. COL3 is on the IO expander and ROW1 on U2 only.
+    assert pins == {'cols': ['GP0', 'GP1', 'GP2', 'X'], 'rows': ['GP10', 'X']}
+    assert warnings == [
+        "Multiple RP2040 MCUs in netlist (U1, U2), using U1",
+        "cols 3 not wired to U1 (IO expander?), left as X",
+        "rows 1 not wired to U1 (IO expander?), left as X",
+    ]
+
+
+def test_most_wired_mcu_tie():
+    # The first one in the netlist on ties
+    nets = {'COL0': [('U2', 'GPIO0'), ('U1', 'GPIO5')], 'ROW0': [('U2', 'GPIO1'), ('U1', 'GPIO6')]}
+    assert extract_matrix_pins(netlist(nets, ('U1', 'U2'))) == {'cols': ['GP5'], 'rows': ['GP6']}
+    assert extract_matrix_pins(netlist(nets, ('U2', 'U1'))) == {'cols': ['GP0'], 'rows': ['GP1']}
+
+
+def test_mcu_ref():
+    warnings = []
+    pins = extract_matrix_pins(read_netlist('split.net'), mcu_ref='U2', warnings=warnings)
+    assert pins == {'cols': ['X', 'X', 'X', 'X'], 'rows': ['GP5', 'GP6']}
+    assert warnings == ["cols 0, 1, 2, 3 not wired to U2 (IO expander?), left as X"]
+
+    with pytest.raises(Exception, match="MCU Reference U9 not found in netlist!"):
+        extract_matrix_pins(read_netlist('split.net'), mcu_ref='U9')
+
+
+def test_unwired_nets():
+    # Gaps in the numbering are left as X as well
+    nets = {'COL0': [('U1', 'GPIO0')], 'COL2': [('U1', 'GPIO2')], 'ROW1': [('U1', 'GPIO3')]}
+    warnings = []
+    assert extract_matrix_pins(netlist(nets), warnings=warnings) == {'cols': ['GP0', 'X', 'GP2'], 'rows': ['X', 'GP3']}
+    assert warnings == ["cols 1 not wired to U1 (IO expander?), left as X", "rows 0 not wired to U1 (IO expander?), left as X"]
+    # Without a warnings list, nothing is reported
+    assert extract_matrix_pins(netlist(nets)) == {'cols': ['GP0', 'X', 'GP2'], 'rows': ['X', 'GP3']}
+
+
+def test_errors():
+    with pytest.raises(Exception, match="STM32 MCU not found in netlist!"):
+        extract_matrix_pins(read_netlist('split.net'), 'STM32')
+    with pytest.raises(Exception, match="does not look like a GPIO<n> pin"):
+        extract_matrix_pins(netlist({'COL0': [('U1', 'VBUS')]}))
@@ -0,0 +1,99 @@
+import io
+import os
+
+import pytest
+
+from util.netlist import Netlist, NetlistComponent, NetlistNode, read_netlist_chunks, tokenize_netlist, parse_sexpr, parse_netlist
+
+NETLISTS = os.path.join(os.path.dirname(__file__), 'fixtures', 'netlists')
+
+
+def read_netlist(name: str) -> str:
+    with open(os.path.join(NETLISTS, name), encoding='utf-8') as file:
+        return file.read()
+
+
+def parse(text: str, chunk_size: int = 1 << 16, **kwargs) -> list:
+    return parse_sexpr(tokenize_netlist(read_netlist_chunks(text, chunk_size)), **kwargs)
+
+
+def test_quoted_strings():
+    text = r'(export (description "A \"quoted\" (value) \\ with escapes") (name "") (path "/a b/(c)"))'
+    assert parse(text) == ['export', ['description', 'A "quoted" (value) \\ with escapes'], ['name', ''], ['path', '/a b/(c)']]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64])
+def test_tokens_split_across_chunks(chunk_size):
+    # Strings, escapes and atoms cut at any point give the same tree
+    text = read_netlist('split.net')
+    assert parse(text, chunk_size) == parse(text)
+    assert parse(text.encode('utf-8'), chunk_size) == parse(text)
+
+
+def test_file_objects():
+    text = read_netlist('split.net')
+    # Multi-byte characters split between binary chunks are decoded correctly
+    text = text.replace('Right half', 'Right half – rechte Hälfte')
+    expected = parse(text)
+    assert parse_sexpr(tokenize_netlist(read_netlist_chunks(io.BytesIO(text.encode('utf-8')), 5))) == expected
+    assert parse_sexpr(tokenize_netlist(read_netlist_chunks(io.StringIO(text), 5))) == expected
+
+
+def test_deeply_nested():
+    # Iterative, so nesting deeper than the recursion limit is fine
+    depth = 20000
+    tree = parse('(a ' * depth + '"x"' + ')' * depth)
+    for _ in range(depth - 1):
+        assert tree[0] == 'a'
+        tree = tree[1]
+    assert tree == ['a', 'x']
+
+
+def test_keep():
+    text = '(export (design (tool "x")) (nets (net (name "/COL0") (extra (deep (er)))) (node "x")))'
+    assert parse(text, keep={'nets', 'net', 'name'}) == ['export', ['nets', ['net', ['name', '/COL0']]]]
+
+
+def test_on_item():
+    items = []
+    tree = parse('(export (components (comp (ref "U1")) (comp (ref "U2"))) (nets (net (name "a"))))',
+                 on_item=lambda section, item: items.append((section, item)))
+    assert items == [('components', ['comp', ['ref', 'U1']]), ('components', ['comp', ['ref', 'U2']]), ('nets', ['net', ['name', 'a']])]
+    # The items are dropped from the tree
+    assert tree == ['export', ['components'], ['nets']]
+
+
+@pytest.mark.parametrize("text, message", [
+    ('(export (nets (net (name "/COL0"))', "Netlist is incomplete"),
+    ('(export (nets', "Netlist is incomplete"),
+    ('', "Netlist is incomplete"),
+    (') (export)', "Netlist has an unmatched ')'"),
+    ('(export (name "/COL0', "Netlist has an unterminated string"),
+    ('(export (name "abc\\"))', "Netlist has an unterminated string"),
+])
+def test_invalid(text, message):
+    with pytest.raises(Exception, match=message.replace('(', r'\(').replace(')', r'\)')):
+        parse(text)
+    # The same with the input cut into small chunks
+    with pytest.raises(Exception, match=message.replace('(', r'\(').replace(')', r'\)')):
+        parse(text, 3)
+
+
+def test_parse_netlist():
+    netlist = parse_netlist(read_netlist('split.net'))
+    assert isinstance(netlist, Netlist)
+    # Components by ref and nets by name, in netlist order
+    assert list(netlist.components) == ['U1', 'U2', 'U3', 'D1']
+    assert netlist.components['U3'] == NetlistComponent('U3', 'MCP23017', 'Package_SO:SOIC-28W_7.5x17.9mm_P1.27mm')
+    assert list(netlist.nets) == ['/COL0', '/COL1', '/Matrix/COL2', '/COL3', '/ROW0', '/Right/ROW1', '/Row1 Sheet/LED', 'Net-(D1-A)']
+    assert netlist.nets['/COL0'] == [NetlistNode('U1', '2', 'GPIO0', 'bidirectional'), NetlistNode('D1', '1', 'K', 'passive')]
+    assert netlist.nets['/ROW0'][1] == NetlistNode('U2', '7', 'GPIO5', 'bidirectional')
+    assert 'U4' not in netlist.components and '/COL4' not in netlist.nets
+
+
+def test_parse_netlist_sources():
+    text = read_netlist('split.net')
+    expected = parse_netlist(text)
+    assert parse_netlist(text.encode('utf-8')) == expected
+    assert parse_netlist(io.BytesIO(text.encode('utf-8'))) == expected
+    assert parse_netlist(io.StringIO(text)) == expected
@@ -0,0 +1,77 @@
+import json
+import re
+from pathlib import Path
+
+import pytest
+
+from util import pipeline
+from util.cache import ResultCache
+from util.pipeline import ARTIFACTS, generate_files, read_options
+
+NETLISTS = Path(__file__).parent / 'fixtures' / 'netlists'
+BOARDS = Path(__file__).parent / 'fixtures' / 'boards'
+UID_RE = re.compile(r'#define VIAL_KEYBOARD_UID \{(0x[0-9A-F]{2}, ){7}0x[0-9A-F]{2}\}')
+
+# 2x4 matrix, the same size as split.net, where COL3 and ROW1 aren't wired to U1
+MATRIX_KLE = [[{'a': 0}] + [f"\n\n\n\n{row}\n{col}" for col in range(4)] for row in range(2)]
+SPLIT_WARNINGS = [
+    "Netlist: Multiple RP2040 MCUs in netlist (U1, U2), using U1",
+    "Netlist: cols 3 not wired to U1 (IO expander?), left as X",
+    "Netlist: rows 1 not wired to U1 (IO expander?), left as X",
+]
+
+
+def test_netlist_warnings():
+    netlist = (NETLISTS / 'split.net').read_text()
+    cache = ResultCache(directory=None)
+    for _ in range(2): # the second run is a cache hit, which still has the warnings
+        warnings = []
+        files = generate_files(MATRIX_KLE, read_options({'mcu-preset': 'RP2040'}), netlist, ['info.json'], cache, warnings=warnings)
+        assert warnings == SPLIT_WARNINGS
+        assert json.loads(files['info.json'])['matrix_pins'] == {'rows': ['GP10', 'X'], 'cols': ['GP0', 'GP1', 'GP2', 'X']}
+    assert cache.stats()['hits'] == 2
+
+
+def test_netlist_warnings_only_for_files_using_the_netlist():
+    netlist = (NETLISTS / 'split.net').read_text()
+    warnings = []
+    files = generate_files(MATRIX_KLE, read_options({'mcu-preset': 'RP2040'}), netlist, ['keyboard.h'], None, warnings=warnings)
+    assert list(files) == ['keyboard.h']
+    assert warnings == []
+
+
+def test_verify_roundtrip_mismatch_logged(monkeypatch, caplog):
+    monkeypatch.setattr(pipeline, 'verify_roundtrip', lambda keyboard: {'equivalent': False})
+    generate_files(MATRIX_KLE, read_options({}), None, ['keyboard.h'], None, verify_roundtrip=True)
+    assert [record.getMessage() for record in caplog.records] == ["KLE de/serialization round trip does not give the same keyboard back!"]
+
+
+@pytest.mark.parametrize('on_disk', [False, True])
+def test_cached_run_same_files(tmp_path, on_disk):
+    kle = json.loads((BOARDS / 'medium.json').read_text())
+    options = read_options({'board-name': 'Cached', 'mcu-preset': 'RP2040', 'layers': '3'})
+    uncached = generate_files(kle, options, None, ARTIFACTS, None)
+
+    cache = ResultCache(directory=str(tmp_path) if on_disk else None)
+    generate_files(kle, options, None, ARTIFACTS, cache)
+    if on_disk:
+        cache.clear() # only the files on disk are left
+    cached = generate_files(kle, options, None, ARTIFACTS, cache)
+    assert cache.stats()['hits' if not on_disk else 'disk_hits'] > 0
+
+    assert list(cached) == list(uncached)
+    for name in ARTIFACTS:
+        assert UID_RE.sub('UID', cached[name]) == UID_RE.sub('UID', uncached[name]), name
+
+
+def test_vial_uid_new_on_every_run():
+    kle = json.loads((BOARDS / 'small.json').read_text())
+    cache = ResultCache(directory=None)
+    uids = []
+    for _ in range(3):
+        files = generate_files(kle, read_options({}), None, ['vial.json', 'vial_config.h'], cache)
+        uid = UID_RE.search(files['vial_config.h'])
+        assert uid
+        uids.append(uid.group())
+    assert cache.stats()['hits'] == 2 # the vial stage, which vial.json and vial_config.h share
+    assert len(set(uids)) == 3
@@ -0,0 +1,52 @@
+import copy
+import json
+from pathlib import Path
+
+import pytest
+
+from util.serial import serialize, deserialize, verify_roundtrip
+
+BOARDS = Path(__file__).parent / 'fixtures' / 'boards'
+
+
+def test_deserialize_text_sizes():
+    rows = [[{'a': 0, 'fa': [0, 2]}, 'A\nB', {'f2': 4}, 'C\nD']]
+    kbd = deserialize(rows)
+    # With 'a': 0 the second label is the bottom left one
+    assert kbd.keys[0].text_size[6] == 2
+    assert kbd.keys[1].text_size[6] == 4
+
+
+def test_deserialize_leaves_rows_unchanged():
+    # 'f2' changes the current text sizes in place, which must not be the 'fa' list of the input
+    rows = [{'name': 'test'}, [{'fa': [0, 2]}, '0,0', {'f2': 4}, '0,1'], [{'fa': [3, 3], 't': '#111111\n#222222'}, 'A\nB', {'f2': 5}, 'C']]
+    before = copy.deepcopy(rows)
+    deserialize(rows)
+    assert rows == before
+
+
+@pytest.mark.parametrize('board', ['small', 'medium', 'nomix'])
+def test_inputs_unchanged(board):
+    rows = json.loads((BOARDS / f'{board}.json').read_text())
+    before = copy.deepcopy(rows)
+    kbd = deserialize(rows)
+    assert rows == before
+
+    kbd_before = copy.deepcopy(kbd)
+    serialize(kbd)
+    assert kbd == kbd_before
+
+
+@pytest.mark.parametrize('board', ['small', 'medium', 'nomix'])
+def test_verify_roundtrip(board):
+    rows = json.loads((BOARDS / f'{board}.json').read_text())
+    kbd = deserialize(rows)
+    result = verify_roundtrip(kbd, rows)
+    assert result['equivalent']
+    assert result['serialized'] == json.loads(json.dumps(serialize(kbd)))
+    # The sample boards aren't written the way KLE writes them
+    assert result['identical'] is False
+    assert verify_roundtrip(kbd)['identical'] is None
+
+    serialized = result['serialized']
+    assert verify_roundtrip(deserialize(serialized), serialized)['identical']
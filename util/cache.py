@@ -0,0 +1,150 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, IO, Optional
+
+# Part of every cache key, bump this whenever a generator's output changes
+# so that results from older versions (e.g. in an on-disk cache) aren't served.
+RESULT_CACHE_VERSION = 1
+
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 512))
+# Optional on-disk cache (shared by workers and kept across restarts), disabled when not set
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR') or None
+RESULT_CACHE_DISK_SIZE = int(os.environ.get('RESULT_CACHE_DISK_SIZE', 10000))
+
+
+def content_hash(obj: Any) -> str:
+    """Hash of a JSON-able object that doesn't depend on formatting or dict key order,
+    e.g. the same KLE pasted as raw data or uploaded as a file hashes the same."""
+    data = json.dumps(obj, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def stream_hash(stream: IO, chunk_size: int = 1 << 16) -> str:
+    """Hash of the contents of a (binary) file object, which is rewound afterwards so it can still be read."""
+    hasher = hashlib.sha256()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        hasher.update(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+    stream.seek(0)
+    return hasher.hexdigest()
+
+
+def cache_key(artifact: str, *inputs: Any) -> str:
+    """Key of one generated artifact (e.g. `'info.json'`), given everything it is generated from."""
+    return content_hash([RESULT_CACHE_VERSION, artifact, inputs])
+
+
+class ResultCache:
+    """Bounded LRU cache of generated files (strings), keyed by `cache_key()`.
+
+    Entries are kept in memory, and also written to `directory` if one is given, so that
+    other workers (and restarts) can reuse them. The on-disk cache is bounded as well,
+    the least recently used files are removed first.
+    Only what is passed to `put()` is cached, the pipeline puts a stage's result once the stage has run,
+    so failed generations are never cached.
+    """
+    def __init__(self,
+                 max_entries: int = RESULT_CACHE_SIZE,
+                 directory: Optional[str] = RESULT_CACHE_DIR,
+                 max_disk_entries: int = RESULT_CACHE_DISK_SIZE):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._writes = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.txt')
+
+    def _remember(self, key: str, value: str):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+        if self.directory:
+            try:
+                with open(self._path(key), encoding='utf-8') as file:
+                    value = file.read()
+                os.utime(self._path(key))  # for the LRU eviction
+            except FileNotFoundError:
+                value = None
+            if value is not None:
+                self._remember(key, value)
+                with self._lock:
+                    self.disk_hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, value: str):
+        self._remember(key, value)
+        if self.directory:
+            self._write(key, value)
+
+    def _write(self, key: str, value: str):
+        # Written to a temporary file and renamed, so that other workers never read a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-', suffix='.txt')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                file.write(value)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        # Listing the directory isn't free, so only check the size every now and then
+        with self._lock:
+            self._writes += 1
+            writes = self._writes
+        if writes % 100:
+            return
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.txt') and not entry.name.startswith('.'):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass # removed by another worker
+        if len(entries) > self.max_disk_entries:
+            entries.sort()
+            for _, path in entries[:len(entries) - self.max_disk_entries]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses}
+
+
+# Shared by every request handled by this worker
+RESULTS = ResultCache()
@@ -1,3 +1,5 @@
+from typing import Optional
+
 
 COMMON_KEYS = {
     "KC_ESC": ["Esc", "", "", "", "", "", "", "", "", "", "", ""],
@@ -113,3 +115,53 @@ COMMON_MODS = {
 
     "KC_SPC": [6.25, 7],
 }
+
+
+def normalize_labels(labels: list) -> tuple:
+    """Returns the labels of a key as a (hashable) tuple, with the multilayout (3, 5, 7)
+    and matrix (9, 11) labels blanked out, for looking up COMMON_KEYS."""
+    lbls = list(labels)
+    for i in (3, 5, 7, 9, 11):
+        if i < len(lbls):
+            lbls[i] = ""
+    return tuple(lbls)
+
+
+def _mod_placeholder(keycode: str) -> str:
+    """The COMMON_KEYS entry shared by both sides of a modifier (e.g. KC_LSFT/KC_RSFT -> SFT).
+    Other COMMON_MODS (e.g. KC_SPC) have no label and are matched on blank keys."""
+    if keycode.startswith('KC_L') or keycode.startswith('KC_R'):
+        return keycode[4:]
+    return ""
+
+
+# Reverse index of COMMON_KEYS (normalized labels -> keycode).
+# If several keycodes have the same labels, the first one wins.
+COMMON_KEYS_BY_LABELS = {}
+for _keycode, _labels in COMMON_KEYS.items():
+    COMMON_KEYS_BY_LABELS.setdefault(normalize_labels(_labels), _keycode)
+
+# Index of COMMON_MODS ((placeholder, width) -> keycode), see _mod_placeholder()
+COMMON_MODS_BY_WIDTH = {}
+for _keycode, _widths in COMMON_MODS.items():
+    for _width in _widths:
+        COMMON_MODS_BY_WIDTH.setdefault((_mod_placeholder(_keycode), _width), _keycode)
+
+_BLANK_LABELS = ("", ) * 12
+
+
+def get_common_keycode(labels: list, width: float = 1) -> Optional[str]:
+    """Guesses the keycode of a key from its labels using COMMON_KEYS.
+    Modifiers (e.g. "Shift") and blank keys (e.g. the spacebar) are resolved using
+    the widths in COMMON_MODS. Returns None if nothing matches."""
+    lbls = normalize_labels(labels)
+    keycode = COMMON_KEYS_BY_LABELS.get(lbls)
+
+    if keycode and not keycode.startswith('KC_'):
+        placeholder = keycode
+    elif not keycode and lbls == _BLANK_LABELS:
+        placeholder = ""
+    else:
+        return keycode
+
+    return COMMON_MODS_BY_WIDTH.get((placeholder, width), keycode)
@@ -1,13 +1,12 @@
 from collections import OrderedDict
-from copy import deepcopy
 import json
 from json import JSONDecodeError
-from typing import Any, List, Dict, Tuple, Literal
+from typing import Any, List, Dict, Tuple, Literal, Optional
 
-from util.common_keys import COMMON_KEYS, COMMON_MODS
+from util.common_keys import COMMON_MODS, get_common_keycode
 from util.serial import Keyboard, KeyboardMetadata, serialize, deserialize
 from util.util import gen_uid, max_x_y, min_x_y, write_file, replace_chars, extract_matrix_pins
-from util.layouts import convert_key_list_to_layout, extract_row_col, get_layout_all, extract_ml_val_ndx, get_alternate_layouts
+from util.layouts import convert_key_list_to_layout, get_alternate_layouts, analyze_keyboard, KeyboardAnalysis
 
 # GENERATE INFO.JSON
 # TO-DO:
@@ -32,20 +31,16 @@ def kbd_to_qmk_info(kbd: Keyboard,
                     pin_dict: dict = None,
                     diode_dir: Literal['COL2ROW', 'ROW2COL'] = "COL2ROW",
                     manufacturer: str = None,
-                    alt_layouts: Dict[str, List[int]] = None
+                    alt_layouts: Dict[str, List[int]] = None,
+                    analysis: KeyboardAnalysis = None
                     ) -> Dict[str, Any]: # Change to a TypedDict for qmk info dict
-    """Converts a Keyboard into a QMK info.json (dict)"""
-    # Check for encoder keys (Both VIA and VIAL)
-    encoders_num = 0
-    for key in kbd.keys:
-        # Toggle encoders if a key with encoders detected
-        if key.labels[4].startswith('e'):
-            if key.labels[4] == 'e': # VIAL
-                enc_val = int(key.labels[9])
+    """Converts a Keyboard into a QMK info.json (dict).
+    `analysis` can be passed in to reuse the analysis of `kbd` done for the other generators."""
+    if not analysis:
+        analysis = analyze_keyboard(kbd)
 
-            if len(key.labels[4]) > 1 and key.labels[4][1].isnumeric(): # VIA
-                enc_val = int(key.labels[4][1])
-            encoders_num = max(encoders_num, enc_val+1)
+    # Check for encoder keys (Both VIA and VIAL)
+    encoders_num = analysis.encoders_num
 
     # Before we figure out the all layout, generate the alternate layouts
     if alt_layouts:
@@ -54,21 +49,15 @@ def kbd_to_qmk_info(kbd: Keyboard,
             # Format nicely
             _alt_layouts['_'.join(alt_name.lower().split())] = alt_layouts[alt_name]
             
-        alternate_layout_key_map = get_alternate_layouts(kbd, _alt_layouts)
+        alternate_layout_key_map = get_alternate_layouts(kbd, _alt_layouts, analysis.ml_index)
     else:
         alternate_layout_key_map = None
 
-    rows = 0
-    cols = 0
-
-    for key in kbd.keys:
-        row, col = extract_row_col(key)
-
-        rows = max(rows, row + 1)
-        cols = max(cols, col + 1)
+    rows = analysis.rows
+    cols = analysis.cols
 
     # Removes all multilayout options except max layouts.
-    kbd = get_layout_all(kbd)
+    kbd = analysis.layout_all
 
     # The final list that will actually be used in the info.json
     qmk_layout_all = convert_key_list_to_layout(kbd.keys)
@@ -171,9 +160,14 @@ def kbd_to_vial(kbd: Keyboard,
                 vendor_id: str = None,
                 product_id: str = None,
                 lighting: str = None,
-                name: str = None
+                name: str = None,
+                analysis: KeyboardAnalysis = None
                 ) -> Tuple[Dict[str, Any], str]: # Change to a TypedDict for via/l json dict
-    """Converts a Keyboard into a VIA/L JSON file and VIAL config.h"""
+    """Converts a Keyboard into a VIA/L JSON file and VIAL config.h.
+    `analysis` can be passed in to reuse the analysis of `kbd` done for the other generators."""
+    if not analysis:
+        analysis = analyze_keyboard(kbd)
+
     if not lighting:
         lighting = 'none'
     if not name:
@@ -183,35 +177,34 @@ def kbd_to_vial(kbd: Keyboard,
 
     rows = 0
     cols = 0
-    ml_keys = [] # list of multilayout keys
+    ml_keys = [] # (ml index, ml value, primary name, secondary name) of the multilayout keys
     ml_dict = {}
     ml_count = 0 # amount of multilayouts
 
-    vial_kbd = deepcopy(kbd)
+    # The VIA keys are new keys sharing everything but their labels with the board's keys (which
+    # aren't modified), serialize() only reads them
+    vial_keys = []
 
     vial_unlock_rows = []
     vial_unlock_cols = []
     
-    for key in vial_kbd.keys:
-        og_key = deepcopy(key)
-        # key colour whitelist
-        if not og_key.color in ["#cccccc", "#aaaaaa", "#777777"]:
-            key.color = "#cccccc"
-        key.color = og_key.color
-        key.labels = [None] * 12 # Empty labels
-        key.textSize = [None] * 12 # Reset text size
+    for i, key in enumerate(kbd.keys):
+        og_labels = key.labels
+        labels = [None] * 12 # Empty labels
+        vial_keys.append(key.with_labels(labels))
+        # TO-DO: key colour whitelist ("#cccccc", "#aaaaaa", "#777777"), the colours are kept as is for now
 
-        if og_key.labels[4] == "e": # encoder; VIAL ONLY
-            key.labels[4] = og_key.labels[4]
+        if og_labels[4] == "e": # encoder; VIAL ONLY
+            labels[4] = og_labels[4]
 
-        elif og_key.labels[4].startswith("e"): # encoder; VIA (I know this is included in the VIAL converter, will have to change later)
-            key.labels[4] = og_key.labels[4]
+        elif og_labels[4].startswith("e"): # encoder; VIA (I know this is included in the VIAL converter, will have to change later)
+            labels[4] = og_labels[4]
 
         # Matrix coords
-        row, col = extract_row_col(og_key)
+        row, col = analysis.matrix[i]
 
         # Add if unlock key
-        if og_key.labels[2] == "u": 
+        if og_labels[2] == "u": 
             vial_unlock_rows.append(row)
             vial_unlock_cols.append(col)
 
@@ -219,42 +212,37 @@ def kbd_to_vial(kbd: Keyboard,
         rows = max(rows, row + 1)
         cols = max(cols, col + 1)
             
-        key.labels[0] = f"{row},{col}"
+        labels[0] = f"{row},{col}"
 
-        if (not og_key.labels[3] or not og_key.labels[5]):
+        if (not og_labels[3] or not og_labels[5]):
             continue # Skip non multilayout keys
 
         # Multi-layout
-        ml_ndx, ml_val = extract_ml_val_ndx(og_key)
+        ml_ndx, ml_val = analysis.ml_vals[i]
 
         ml_count = max(ml_count, ml_ndx + 1) # sets ml_count to highest ml index
 
-        key.labels[7] = og_key.labels[7] # Name of multilayout (Primary multilayout name)
-        key.labels[6] = og_key.labels[6] # Name of multi-multilayout (Secondary multilayout name)
-        key.labels[8] = f"{ml_ndx},{ml_val}"
+        labels[8] = f"{ml_ndx},{ml_val}"
+        # The multilayout names are only put in the labels below
+        labels[7] = labels[6] = ''
 
         if not ml_ndx in ml_dict.keys():
             ml_dict[ml_ndx] = {}
         ml_dict[ml_ndx][ml_val] = True
-        ml_keys.append(key)
+        # Name of multilayout (Primary multilayout name), and of multi-multilayout (Secondary multilayout name)
+        ml_keys.append((ml_ndx, ml_val, og_labels[7], og_labels[6]))
 
     vial_ml = [None] * ml_count # final list used in via json file
-    for key in ml_keys:
-        ml_ndx, ml_val = map(int, key.labels[8].split(','))
-        ml_name = key.labels[7]
-        key.labels[7] = '' # Remove primary multilayout
-
+    for ml_ndx, ml_val, ml_name, ml_secondary in ml_keys:
         # Update multilayouts
         if len(ml_dict[ml_ndx]) == 2 and ml_name and not vial_ml[ml_ndx]:
             vial_ml[ml_ndx] = ml_name
-        if len(ml_dict[ml_ndx]) > 2 and (ml_name or key.labels[6]): # More than 2 multilayouts
+        if len(ml_dict[ml_ndx]) > 2 and (ml_name or ml_secondary): # More than 2 multilayouts
             if not vial_ml[ml_ndx]:
                 vial_ml[ml_ndx] = [""] * (len(ml_dict[ml_ndx]) + 1)
             if not vial_ml[ml_ndx][0]: # multilayout name
                 vial_ml[ml_ndx][0] = ml_name
-            vial_ml[ml_ndx][ml_val+1] = key.labels[6]
-    
-        key.labels[6] = '' # Remove secondary multilayout
+            vial_ml[ml_ndx][ml_val+1] = ml_secondary
 
     # Error messages
     for ml_ndx in range(len(vial_ml)):
@@ -269,10 +257,8 @@ def kbd_to_vial(kbd: Keyboard,
             if not vial_ml[ml_ndx]:
                 raise Exception(f"Multilayout index ({ml_ndx}) is missing a multilayout name.")
 
-    # Remove metadata
-    vial_kbd.meta = KeyboardMetadata()
-
-    keymap_all = serialize(vial_kbd)
+    # No metadata
+    keymap_all = serialize(Keyboard(KeyboardMetadata(), vial_keys))
     
     # DEBUG
     # write_file("test-vial.json", json.dumps(keymap_all, ensure_ascii=False, indent=2))
@@ -318,18 +304,15 @@ def kbd_to_vial(kbd: Keyboard,
 
 # CONVERT VIA KLE JSON TO SIMPLIZED KLE
 
-def via_to_kbd(via_json: str) -> Keyboard:
-    obj = json.loads(via_json)
-    text = json.dumps(obj['layouts']['keymap'])
-    if 'labels' in obj['layouts'].keys():
-        via_ml = obj['layouts']['labels']
-    else:
-        via_ml = []
+def via_to_kbd(via_json: str | Dict[str, Any]) -> Keyboard:
+    """Converts a VIA/L json (a string, or already parsed) to a Firmware Scripts keyboard."""
+    obj = json.loads(via_json) if isinstance(via_json, str) else via_json
+    via_ml = obj['layouts'].get('labels', [])
 
-    kbd = deserialize(json.loads(text))
-    output_kbd = deepcopy(kbd)
+    # The keys are freshly deserialized, so they're relabeled in place
+    kbd = deserialize(obj['layouts']['keymap'])
     ml_dict = {}
-    ml_length_dict = {}
+    ml_max_width = {}
 
     # complete ml_dict: keeps track of if ml label has been assigned to a key yet
     for _, obj in enumerate(via_ml):
@@ -338,21 +321,16 @@ def via_to_kbd(via_json: str) -> Keyboard:
         if isinstance(obj, str): # boolean multilayout
             ml_dict[_] = True
 
-    # complete ml_length_dict: gets length of all keys in a given multilayout
-    for key in output_kbd.keys:
+    # complete ml_max_width: width of the widest key in a given multilayout (the primary label goes on it)
+    for key in kbd.keys:
         ml = key.labels[8]
         split_ml = ml.split(",")
 
         if len(split_ml) == 2:
             ndx = int(split_ml[0]) # need to catch errors here
-            val = int(split_ml[1])
+            ml_max_width[ndx] = max(ml_max_width.get(ndx, key.width), key.width)
 
-            if ml_length_dict.get(ndx):
-                ml_length_dict[ndx].append(key.width)
-            else:
-                ml_length_dict[ndx] = [key.width]
-
-    for key in output_kbd.keys:
+    for key in kbd.keys:
         row_col = key.labels[0]
         split_row_col = row_col.split(",")
         
@@ -375,18 +353,18 @@ def via_to_kbd(via_json: str) -> Keyboard:
             key.labels[5] = str(val)
 
             if isinstance(via_ml[ndx], list): # list multilayout
-                if ml_dict[ndx][0] and key.width == max(ml_length_dict[ndx]): # primary label
+                if ml_dict[ndx][0] and key.width == ml_max_width[ndx]: # primary label
                     key.labels[7] = via_ml[ndx][0] 
                     ml_dict[ndx][0] = False
                 if ml_dict[ndx][val+1]: # secondary label
                     key.labels[6] = via_ml[ndx][val+1]
                     ml_dict[ndx][val+1] = False
             else: # boolean multilayout
-                if ml_dict[ndx] and key.width == max(ml_length_dict[ndx]):
+                if ml_dict[ndx] and key.width == ml_max_width[ndx]:
                     key.labels[7] = via_ml[ndx]
                     ml_dict[ndx] = False
     
-    return output_kbd
+    return kbd
 
 
 # GENERATE KEYBOARD.H (LAYOUT MACRO)
@@ -398,22 +376,20 @@ def via_to_kbd(via_json: str) -> Keyboard:
 COL_LETTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijilmnopqrstuvwxyz'
 ROW_LETTERS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnop'
 
-def kbd_to_layout_macro(kbd: Keyboard) -> str:
+def kbd_to_layout_macro(kbd: Keyboard, analysis: KeyboardAnalysis = None) -> str:
     """Generates a LAYOUT macro (for use in a kb.h file).
-    Works as per QMK's info.json -> kb.h code."""
+    Works as per QMK's info.json -> kb.h code.
+    `analysis` can be passed in to reuse the analysis of `kbd` done for the other generators."""
+    if not analysis:
+        analysis = analyze_keyboard(kbd)
+
     # Removes all multilayout options except max layouts.
     # For parity with info.json.
-    kbd = get_layout_all(kbd)
+    kbd = analysis.layout_all
 
-    rows = 0
-    cols = 0
-
-    # Calculates total rows and cols
-    for key in kbd.keys:
-        row, col = extract_row_col(key)
-
-        rows = max(rows, row + 1)
-        cols = max(cols, col + 1)
+    # Total rows and cols
+    rows = analysis.layout_all_rows
+    cols = analysis.layout_all_cols
 
     # This following code is based off qmk's generation.
     layouts_h_lines = []
@@ -426,7 +402,7 @@ def kbd_to_layout_macro(kbd: Keyboard) -> str:
     layout_matrix = [['XXX' for i in range(col_num)] for i in range(row_num)]
 
     for i, key in enumerate(kbd.keys):
-        row, col = extract_row_col(key)
+        row, col = analysis.layout_all_matrix[i]
         identifier = 'k%s%s' % (ROW_LETTERS[row], COL_LETTERS[col])
 
         try:
@@ -508,24 +484,20 @@ def kbd_to_keymap(kbd: Keyboard,
                   lbl_ndx: int = 1,
                   layout_dict: dict = None,
                   keycode_dict: dict = None,
-                  conversion_dict: dict = None
+                  conversion_dict: dict = None,
+                  analysis: KeyboardAnalysis = None
                   ) -> str:
-    """Generates a keymap.c file"""
-    # Check for encoder keys (Both VIA and VIAL)
-    encoders_num = 0
-    for key in kbd.keys:
-        # Toggle encoders if a key with encoders detected
-        if key.labels[4].startswith('e'):
-            if key.labels[4] == 'e': # VIAL
-                enc_val = int(key.labels[9])
+    """Generates a keymap.c file.
+    `analysis` can be passed in to reuse the analysis of `kbd` done for the other generators."""
+    if not analysis:
+        analysis = analyze_keyboard(kbd)
 
-            if len(key.labels[4]) > 1 and key.labels[4][1].isnumeric(): # VIA
-                enc_val = int(key.labels[4][1])
-            encoders_num = max(encoders_num, enc_val+1)
+    # Check for encoder keys (Both VIA and VIAL)
+    encoders_num = analysis.encoders_num
 
     # Removes all multilayout options except max layouts.
     # For parity with info.json and keymap.c
-    kbd = get_layout_all(kbd)
+    kbd = analysis.layout_all
 
     # Which key label index to read keycodes off
     keycode_label_no = lbl_ndx
@@ -536,98 +508,93 @@ def kbd_to_keymap(kbd: Keyboard,
     layout_name = "LAYOUT"
     max_kc_len = 9
 
-    keymap_keys = [[] for i in range(layers)]
-    
-    # Calculates total rows and cols
-    rows = 0
-    cols = 0
-    for key in kbd.keys:
-        row, col = extract_row_col(key)
-
-        rows = max(rows, row + 1)
-        cols = max(cols, col + 1)
-
-    for i, layer_keys in enumerate(keymap_keys):
-
-        # Used to indicate when to newline
-        current_y = 0
+    # Total cols
+    cols = analysis.layout_all_cols
+
+    # Matrix position of each key
+    matrix = analysis.layout_all_matrix
+
+    # Newline if the y value changes, just to make things neater.
+    # Precomputed as (start, end) key indices of each line, the same for every layer.
+    key_lines = []
+    line_start = 0
+    current_y = 0
+    for n, key in enumerate(kbd.keys):
+        if key.y != current_y:
+            current_y = key.y
+            key_lines.append((line_start, n))
+            line_start = n
+    key_lines.append((line_start, len(kbd.keys)))
+
+    def convert_keycodes(kcs: List[Any]) -> List[Any]:
+        # Convert (VIALs) deprecated keycodes into updated ones if required
+        if conversion_dict:
+            kcs = [conversion_dict.get(kc, kc) for kc in kcs]
+
+        # Convert lengthened keycodes into shortened aliases if required
+        if keycode_dict:
+            kcs = [keycode_dict.get(kc, kc) for kc in kcs]
+        return kcs
+
+    def layer_keycodes(i: int) -> Optional[List[Any]]:
+        """Returns the keycodes of layer `i` (in the order of kbd.keys), or None if it's an empty (KC_TRNS) layer"""
+        if layout_dict: # Check for layout_dict
+            if "layout" in layout_dict:  # VIAL layout file
+                vial_layout_dict = layout_dict["layout"]
+                if i+1 > len(vial_layout_dict):
+                    return None
+                try:
+                    layer = vial_layout_dict[i]
+                    return [layer[row][col] for row, col in matrix]
+                except IndexError:
+                    raise Exception('Invalid .vil file/layout dictionary provided')
+
+            elif "layers" in layout_dict:  # VIA layout file
+                via_layout_dict = layout_dict["layers"]
+                if i+1 > len(via_layout_dict):
+                    return None
+                try:
+                    layer = via_layout_dict[i]
+                    return [layer[col + row*cols] for row, col in matrix]
+                except IndexError:
+                    raise Exception('Invalid VIA layout file provided')
+
+            raise Exception('Invalid VIAL/VIA layout file provided')
+
+        # Default to label, only for the first layer
+        if i > 0:
+            return None
+
+        kcs = []
+        for key in kbd.keys:
+            kc = key.labels[keycode_label_no] # Keycode
+            if not kc:
+                # Guess the keycode from the other labels (and width, for modifiers)
+                kc = get_common_keycode(key.labels, key.width) or 'KC_TRNS'
+            kcs.append(kc)
+        return kcs
+
+    def format_layer(kcs: List[Any]) -> str:
+        cells = [f'{kc},'.ljust(max_kc_len) for kc in kcs]
+        cells[-1] = cells[-1].strip().rstrip(',')
+        return '\n'.join(('\t\t' + ''.join(cells[start:end])).rstrip() for start, end in key_lines)
+
+    empty_layer = None  # Formatted only once, since it's the same for every empty layer
+    for i in range(layers):
+        kcs = layer_keycodes(i)
+        if kcs is None:
+            if empty_layer is None:
+                empty_layer = format_layer(convert_keycodes(['KC_TRNS'] * len(kbd.keys)))
+            layer_body = empty_layer
+        else:
+            layer_body = format_layer(convert_keycodes(kcs))
 
-        for _, key in enumerate(kbd.keys):
-            
-            if layout_dict: # Check for layout_dict
-                if "layout" in layout_dict.keys():  # VIAL layout file
-                    vial_layout_dict = layout_dict["layout"]
-                    if i+1 > len(vial_layout_dict):
-                        kc = 'KC_TRNS'
-                    else:
-                        try:
-                            row, col = extract_row_col(key)
-                            kc = vial_layout_dict[i][row][col]
-                        except IndexError:
-                            raise Exception('Invalid .vil file/layout dictionary provided')
-
-                elif "layers" in layout_dict.keys():  # VIA layout file
-                    via_layout_dict = layout_dict["layers"]
-                    if i+1 > len(via_layout_dict):
-                        kc = 'KC_TRNS'
-                    else:
-                        try:
-                            row, col = extract_row_col(key)
-                            kc = via_layout_dict[i][col + row*cols]
-                        except IndexError:
-                            raise Exception('Invalid VIA layout file provided')
-
-            else: # Default to label
-                kc = key.labels[keycode_label_no] # Keycode
-                
-                if i > 0:
-                    kc = 'KC_TRNS'
-
-                elif not kc:
-                    def get_key_by_value(dict, search):
-                        for key, value in dict.items():
-                            if value == search:
-                                return key
-                        return None
-                    
-                    lbls = deepcopy(key.labels)
-                    lbls[3] = ""
-                    lbls[5] = ""
-                    lbls[7] = ""
-                    lbls[9] = ""
-                    lbls[11] = ""
-
-                    kc = get_key_by_value(COMMON_KEYS, lbls)
-
-                    if not kc or i > 0:
-                        kc = 'KC_TRNS'
-
-            # Convert (VIALs) deprecated keycodes into updated ones if required
-            if conversion_dict:
-                if kc in conversion_dict.keys():
-                    kc = conversion_dict[kc]
-
-            # Convert lengthened keycodes into shortened aliases if required
-            if keycode_dict:
-                if kc in keycode_dict.keys():
-                    kc = keycode_dict[kc]
-
-            # Newline if the y value changes, just to make things neater
-            if key.y != current_y:
-                current_y = key.y
-                layer_keys.append('\n\t\t')
-            layer_keys.append(f'{kc},'.ljust(max_kc_len))
-
-        layer_keys[-1] = layer_keys[-1].strip().rstrip(',')
-        #keymap_lines.append(f'#define ')
-        #keymap_lines.append(f'\t[{i}] = {layout_name}(\n\t\t{"".join(layer_keys)}\n\t),\n\n')
-        keymap_lines.append('\t[{}] = {}(\n\t\t{}\n\t),\n\n'.format(i, layout_name, ''.join(layer_keys)))
+        keymap_lines.append('\t[{}] = {}(\n{}\n\t),\n\n'.format(i, layout_name, layer_body))
 
     keymap_lines.append('};\n')
 
     keymap_all = "/* SPDX-License-Identifier: GPL-2.0-or-later */\n\n#include QMK_KEYBOARD_H\n\nconst uint16_t PROGMEM keymaps[][MATRIX_ROWS][MATRIX_COLS] = {\n\n"
-    for line in keymap_lines:
-        keymap_all += line
+    keymap_all += ''.join(keymap_lines)
 
     if encoders_num:
         encoder_kc = {}
@@ -683,7 +650,7 @@ def kbd_to_keymap(kbd: Keyboard,
             keymap_all += f"\t[{i}] = {{ {cont} }}\n"
         keymap_all += "};\n#endif\n"
 
-    return "\n".join([x.rstrip() for x in keymap_all.split("\n")])
+    return keymap_all
 
 
 # GENERATE MAIN CONFIG.H
@@ -2,6 +2,7 @@
 """
 import json
 from decimal import Decimal
+from json.encoder import encode_basestring_ascii, encode_basestring, INFINITY, c_make_encoder, _make_iterencode
 
 newline = '\n'
 
@@ -43,7 +44,10 @@ class QMKJSONEncoder(json.JSONEncoder):
     def encode(self, obj):
         """Encode keymap.json objects for QMK.
         """
-        if isinstance(obj, Decimal):
+        if isinstance(obj, str):
+            return self.encode_str(obj)
+
+        elif isinstance(obj, Decimal):
             return self.encode_decimal(obj)
 
         elif isinstance(obj, (list, tuple)):
@@ -52,9 +56,33 @@ class QMKJSONEncoder(json.JSONEncoder):
         elif isinstance(obj, dict):
             return self.encode_dict(obj)
 
+        # Same as what the stock encoder outputs, without setting up an iterencode() for every number
+        elif obj is None:
+            return 'null'
+
+        elif obj is True:
+            return 'true'
+
+        elif obj is False:
+            return 'false'
+
+        elif isinstance(obj, int):
+            return int.__repr__(obj)
+
+        elif isinstance(obj, float) and obj - obj == 0:  # finite
+            return float.__repr__(obj)
+
         else:
             return super().encode(obj)
 
+    def encode_str(self, obj):
+        return encode_basestring_ascii(obj) if self.ensure_ascii else encode_basestring(obj)
+
+    def encode_key(self, key):
+        """Encode a dictionary key the way `json.dumps(key)` does.
+        """
+        return encode_basestring_ascii(key) if isinstance(key, str) else json.dumps(key)
+
     def primitives_only(self, obj):
         """Returns true if the object doesn't have any container type objects (list, tuple, dict).
         """
@@ -81,73 +109,46 @@ class InfoJSONEncoder(QMKJSONEncoder):
 
             else:
                 self.indentation_level += 1
-                output = [self.indent_str + f"{json.dumps(key)}: {self.encode(value)}" for key, value in sorted(obj.items(), key=self.sort_dict)]
+                output = [self.indent_str + f"{self.encode_key(key)}: {self.encode(value)}" for key, value in sorted(obj.items(), key=self.sort_dict)]
                 self.indentation_level -= 1
                 return "{\n" + ",\n".join(output) + "\n" + self.indent_str + "}"
         else:
             return "{}"
 
+    # Sort keys of the top level and of the second level (usb, matrix_size) dicts
+    top_level_order = {
+        'manufacturer': '10keyboard_name',
+        'keyboard_name': '11keyboard_name',
+        'maintainer': '12maintainer',
+        'processor': '13processor',
+        'bootloader': '14bootloader',
+        'board': '15board',
+        'usb': '16usb',
+        'features': '17features',
+        'encoder': '18encoder',
+        'community_layouts': '97community_layouts',
+        'layout_aliases': '98layout_aliases',
+        'layouts': '99layouts',
+    }
+    second_level_order = {
+        'vid': '10vid',
+        'pid': '11pid',
+        'device_ver': '12device_ver',
+        'rows': '1rows',
+        'cols': '2col',
+    }
+
     def sort_dict(self, key):
         """Forces layout to the back of the sort order.
         """
         key = key[0]
 
         if self.indentation_level == 1:
-            if key == 'manufacturer':
-                return '10keyboard_name'
-
-            elif key == 'keyboard_name':
-                return '11keyboard_name'
-
-            elif key == 'maintainer':
-                return '12maintainer'
-
-            elif key == 'processor':
-                return '13processor'
-
-            elif key == 'bootloader':
-                return '14bootloader'
-
-            elif key == 'board':
-                return '15board'
-
-            elif key == 'usb':
-                return '16usb'
-
-            elif key == 'features':
-                return '17features'
-
-            elif key == 'encoder':
-                return '18encoder'
-
-            elif key == 'community_layouts':
-                return '97community_layouts'
-
-            elif key == 'layout_aliases':
-                return '98layout_aliases'
-
-            elif key == 'layouts':
-                return '99layouts'
-
-            else:
-                return '50' + str(key)
+            return self.top_level_order.get(key) or '50' + str(key)
 
         # Sorting USB
         elif self.indentation_level == 2:
-            if key == 'vid':
-                return '10vid'
-
-            elif key == 'pid':
-                return '11pid'
-
-            elif key == 'device_ver':
-                return '12device_ver'
-
-            elif key == 'rows':
-                return '1rows'
-                
-            elif key == 'cols':
-                return '2col'
+            return self.second_level_order.get(key, key)
 
         return key
 
@@ -160,7 +161,7 @@ class KeymapJSONEncoder(QMKJSONEncoder):
         """
         if obj:
             self.indentation_level += 1
-            output_lines = [f"{self.indent_str}{json.dumps(key)}: {self.encode(value)}" for key, value in sorted(obj.items(), key=self.sort_dict)]
+            output_lines = [f"{self.indent_str}{self.encode_key(key)}: {self.encode(value)}" for key, value in sorted(obj.items(), key=self.sort_dict)]
             output = ',\n'.join(output_lines)
             self.indentation_level -= 1
 
@@ -229,10 +230,158 @@ class KeymapJSONEncoder(QMKJSONEncoder):
 
         return key
 
-from json.encoder import encode_basestring_ascii, encode_basestring, INFINITY, c_make_encoder, _make_iterencode
+def kle_floatstr(o, allow_nan=True, _repr=float.__repr__, _inf=INFINITY, _neginf=-INFINITY):
+    """The stock encoder's `floatstr()`, but whole numbers are written as integers. E.g. 1.0 -> 1
+    """
+    if o != o:
+        text = 'NaN'
+    elif o == _inf:
+        text = 'Infinity'
+    elif o == _neginf:
+        text = '-Infinity'
+    # 2 below lines are the only lines changed from original function
+    elif o == int(o):
+        return int(o).__repr__()
+    else:
+        return _repr(o)
+
+    if not allow_nan:
+        raise ValueError(
+            "Out of range float values are not JSON compliant: " +
+            repr(o))
+
+    return text
+
+
+def make_buffered_encode(markers, _default, _encoder, _indent, _floatstr,
+        _key_separator, _item_separator, _sort_keys, _skipkeys):
+    """Same output as `json.encoder._make_iterencode()`, but written into a single list
+    instead of going through a chain of generators. Returns a function `encode(o) -> List[str]`.
+    """
+    if _indent is not None and not isinstance(_indent, str):
+        _indent = ' ' * _indent
+    _intstr = int.__repr__
+
+    def _encode_list(lst, level, out):
+        if not lst:
+            out.append('[]')
+            return
+        if markers is not None:
+            markerid = id(lst)
+            if markerid in markers:
+                raise ValueError("Circular reference detected")
+            markers[markerid] = lst
+        if _indent is not None:
+            level += 1
+            newline_indent = '\n' + _indent * level
+            separator = _item_separator + newline_indent
+            out.append('[' + newline_indent)
+        else:
+            newline_indent = None
+            separator = _item_separator
+            out.append('[')
+        first = True
+        for value in lst:
+            if first:
+                first = False
+            else:
+                out.append(separator)
+            _encode_value(value, level, out)
+        if newline_indent is not None:
+            out.append('\n' + _indent * (level - 1))
+        out.append(']')
+        if markers is not None:
+            del markers[markerid]
+
+    def _encode_dict(dct, level, out):
+        if not dct:
+            out.append('{}')
+            return
+        if markers is not None:
+            markerid = id(dct)
+            if markerid in markers:
+                raise ValueError("Circular reference detected")
+            markers[markerid] = dct
+        if _indent is not None:
+            level += 1
+            newline_indent = '\n' + _indent * level
+            item_separator = _item_separator + newline_indent
+            out.append('{' + newline_indent)
+        else:
+            newline_indent = None
+            item_separator = _item_separator
+            out.append('{')
+        first = True
+        items = sorted(dct.items()) if _sort_keys else dct.items()
+        for key, value in items:
+            if isinstance(key, str):
+                pass
+            elif isinstance(key, float):
+                key = _floatstr(key)
+            elif key is True:
+                key = 'true'
+            elif key is False:
+                key = 'false'
+            elif key is None:
+                key = 'null'
+            elif isinstance(key, int):
+                key = _intstr(key)
+            elif _skipkeys:
+                continue
+            else:
+                raise TypeError(f'keys must be str, int, float, bool or None, '
+                                f'not {key.__class__.__name__}')
+            if first:
+                first = False
+            else:
+                out.append(item_separator)
+            out.append(_encoder(key))
+            out.append(_key_separator)
+            _encode_value(value, level, out)
+        if newline_indent is not None:
+            out.append('\n' + _indent * (level - 1))
+        out.append('}')
+        if markers is not None:
+            del markers[markerid]
+
+    def _encode_value(o, level, out):
+        if isinstance(o, str):
+            out.append(_encoder(o))
+        elif o is None:
+            out.append('null')
+        elif o is True:
+            out.append('true')
+        elif o is False:
+            out.append('false')
+        elif isinstance(o, int):
+            out.append(_intstr(o))
+        elif isinstance(o, float):
+            out.append(_floatstr(o))
+        elif isinstance(o, (list, tuple)):
+            _encode_list(o, level, out)
+        elif isinstance(o, dict):
+            _encode_dict(o, level, out)
+        else:
+            if markers is not None:
+                markerid = id(o)
+                if markerid in markers:
+                    raise ValueError("Circular reference detected")
+                markers[markerid] = o
+            _encode_value(_default(o), level, out)
+            if markers is not None:
+                del markers[markerid]
+
+    def encode(o):
+        out = []
+        _encode_value(o, 0, out)
+        return out
+
+    return encode
+
 
 class KLEJSONEncoder(json.JSONEncoder):
     """Modified the stock encoder to just turn float values that are whole numbers into integers. E.g. 1.0 -> 1
+    Only done when indenting, `json.dumps()` without an indent goes through the C encoder and writes 1.0 as before.
     """
     def iterencode(self, o, _one_shot=False):
         if self.check_circular:
@@ -244,38 +393,25 @@ class KLEJSONEncoder(json.JSONEncoder):
         else:
             _encoder = encode_basestring
 
-        def floatstr(o, allow_nan=self.allow_nan,
-                _repr=float.__repr__, _inf=INFINITY, _neginf=-INFINITY):
-
-            if o != o:
-                text = 'NaN'
-            elif o == _inf:
-                text = 'Infinity'
-            elif o == _neginf:
-                text = '-Infinity'
-            # 2 below lines are the only lines changed from original function
-            elif o == int(o):
-                return int(o).__repr__()
-            else:
-                return _repr(o)
-
-            if not allow_nan:
-                raise ValueError(
-                    "Out of range float values are not JSON compliant: " +
-                    repr(o))
-
-            return text
-
+        def floatstr(o, allow_nan=self.allow_nan):
+            return kle_floatstr(o, allow_nan)
 
         if (_one_shot and c_make_encoder is not None
                 and self.indent is None):
+            # The C encoder can't be given floatstr(), so compact output keeps the stock float formatting (1.0)
             _iterencode = c_make_encoder(
                 markers, self.default, _encoder, self.indent,
                 self.key_separator, self.item_separator, self.sort_keys,
                 self.skipkeys, self.allow_nan)
+        elif _one_shot:
+            # The whole output is wanted at once (json.dumps()), so skip the generators
+            return make_buffered_encode(
+                markers, self.default, _encoder, self.indent, floatstr,
+                self.key_separator, self.item_separator, self.sort_keys,
+                self.skipkeys)(o)
         else:
             _iterencode = _make_iterencode(
                 markers, self.default, _encoder, self.indent, floatstr,
                 self.key_separator, self.item_separator, self.sort_keys,
                 self.skipkeys, _one_shot)
-        return _iterencode(o, 0)
\ No newline at end of file
+        return _iterencode(o, 0)
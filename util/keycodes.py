@@ -0,0 +1,221 @@
+import os
+import time
+import logging
+import tempfile
+import threading
+import datetime
+from contextlib import suppress
+from typing import Callable, Dict, Optional, Tuple
+
+import requests
+
+from util.util import read_file
+from util.converters import keycodes_md_to_keycode_dict, generate_keycode_conversion_dict
+
+logger = logging.getLogger(__name__)
+
+KEYCODES_MD_PATH = 'keycodes.md'
+DEPRECATED_KEYCODES_PATH = 'deprecated_keycodes.txt'
+
+# Can be pointed at a local file (plain path or file://) or a local HTTP server for testing
+KEYCODES_MD_URL = os.environ.get('KEYCODES_MD_URL', "https://raw.githubusercontent.com/qmk/qmk_firmware/master/docs/keycodes.md")
+KEYCODES_MD_MAX_AGE = datetime.timedelta(weeks=104)
+
+
+def retrieve_keycodes_md(link: str = None, timeout: float = 30) -> str:
+    """Fetches keycodes.md from `link` (http(s) URL, file:// URL or a local path)."""
+    if not link:
+        link = KEYCODES_MD_URL
+    logger.info('retrieving keycodes.md from %s', link)
+    if link.startswith('http://') or link.startswith('https://'):
+        response = requests.get(link, timeout=timeout)
+        response.raise_for_status()
+        return response.text
+    if link.startswith('file://'):
+        link = link[len('file://'):]
+    return read_file(link)
+
+
+class KeycodesMdRefresher:
+    """Keeps the keycodes.md on disk up to date without blocking requests (stale-while-revalidate).
+
+    A stale file keeps being served while a single background thread fetches a new copy.
+    The new copy is written to a temporary file and atomically renamed over the old one,
+    so readers never see a partially written file. A `.lock` file next to `path` stops
+    several workers from fetching at the same time.
+    """
+    def __init__(self,
+                 path: str = KEYCODES_MD_PATH,
+                 source: str = None,
+                 max_age: datetime.timedelta = KEYCODES_MD_MAX_AGE,
+                 retry_interval: float = 3600,
+                 lock_timeout: float = 600,
+                 fetch: Callable[[str], str] = retrieve_keycodes_md):
+        self.path = path
+        self.source = source or KEYCODES_MD_URL
+        self.max_age = max_age
+        self.retry_interval = retry_interval  # seconds to wait before retrying a failed fetch
+        self.lock_timeout = lock_timeout  # seconds after which a leftover lock file is ignored
+        self.fetch = fetch
+        self._lock = threading.Lock()
+        self._last_failure = 0.
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def lock_path(self) -> str:
+        return self.path + '.lock'
+
+    def is_stale(self) -> bool:
+        try:
+            mtime = os.path.getmtime(self.path)
+        except FileNotFoundError:
+            return True
+        return datetime.datetime.fromtimestamp(mtime) < datetime.datetime.now() - self.max_age
+
+    def _acquire_file_lock(self) -> bool:
+        try:
+            fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # Ignore (and take over) locks left behind by a crashed worker
+            try:
+                if time.time() - os.path.getmtime(self.lock_path) < self.lock_timeout:
+                    return False
+                os.remove(self.lock_path)
+            except FileNotFoundError:
+                pass
+            return self._acquire_file_lock()
+        os.close(fd)
+        return True
+
+    def refresh(self) -> bool:
+        """Fetches and atomically replaces the keycodes.md file. Only one refresh runs at a time
+        (per process and across workers sharing the same directory). Returns whether the file was replaced.
+        """
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            if not self._acquire_file_lock():
+                return False
+            try:
+                content = self.fetch(self.source)
+                if not keycodes_md_to_keycode_dict(content):
+                    raise Exception(f'No keycodes found in {self.source}')
+
+                directory = os.path.dirname(os.path.abspath(self.path))
+                fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.keycodes-', suffix='.md')
+                try:
+                    with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                        file.write(content)
+                    os.replace(tmp_path, self.path)
+                except BaseException:
+                    os.remove(tmp_path)
+                    raise
+                return True
+            finally:
+                # The lock may already be gone (e.g. taken over as a leftover by another worker)
+                with suppress(FileNotFoundError):
+                    os.remove(self.lock_path)
+        except Exception as e:
+            logger.warning('failed to refresh %s: %s', self.path, e)
+            self._last_failure = time.monotonic()
+            return False
+        finally:
+            self._lock.release()
+
+    def refresh_in_background(self) -> bool:
+        """Starts a background refresh unless one is already running or a recent one failed."""
+        if self._lock.locked():
+            return False
+        if self._last_failure and time.monotonic() - self._last_failure < self.retry_interval:
+            return False
+        self.thread = threading.Thread(target=self.refresh, name='keycodes-md-refresh', daemon=True)
+        self.thread.start()
+        return True
+
+    def check(self):
+        """Makes sure a keycodes.md exists (blocking only if there is none at all),
+        and schedules a background refresh if it is stale."""
+        if not os.path.exists(self.path):
+            self.refresh()
+            if not os.path.exists(self.path):
+                # Another worker is fetching it, wait for it rather than failing the request
+                deadline = time.monotonic() + self.lock_timeout
+                while not os.path.exists(self.path) and os.path.exists(self.lock_path) and time.monotonic() < deadline:
+                    time.sleep(0.1)
+        elif self.is_stale():
+            self.refresh_in_background()
+
+
+class _CachedTable:
+    """A dict parsed from a file, kept until the file's mtime (or size) changes."""
+    def __init__(self, path: str, parser: Callable[[str], Dict[str, str]]):
+        self.path = path
+        self.parser = parser
+        self.signature: Optional[Tuple[int, int]] = None
+        self.table: Optional[Dict[str, str]] = None
+
+
+class KeycodeRegistry:
+    """Process-wide cache of the keycode tables used by `kbd_to_keymap()`.
+
+    Both `keycodes.md` and `deprecated_keycodes.txt` are parsed once and kept in memory.
+    Every lookup does a single `os.stat()` and only re-parses a file if it has changed on disk.
+    The returned dicts are shared, so callers must not mutate them.
+    If a `refresher` is given, keycodes.md is kept up to date in the background.
+    """
+    def __init__(self,
+                 keycodes_md_path: str = KEYCODES_MD_PATH,
+                 deprecated_keycodes_path: str = DEPRECATED_KEYCODES_PATH,
+                 refresher: Optional[KeycodesMdRefresher] = None):
+        self._lock = threading.Lock()
+        self._keycodes = _CachedTable(keycodes_md_path, keycodes_md_to_keycode_dict)
+        self._conversions = _CachedTable(deprecated_keycodes_path, generate_keycode_conversion_dict)
+        self.refresher = refresher
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    @property
+    def keycodes_md_path(self) -> str:
+        return self._keycodes.path
+
+    def _get(self, cached: _CachedTable) -> Dict[str, str]:
+        st = os.stat(cached.path)
+        signature = (st.st_mtime_ns, st.st_size)
+
+        with self._lock:
+            if cached.table is not None and cached.signature == signature:
+                self.hits += 1
+                return cached.table
+
+            if cached.table is None:
+                self.misses += 1
+            else:
+                self.reloads += 1
+
+            cached.table = cached.parser(read_file(cached.path))
+            cached.signature = signature
+            return cached.table
+
+    def keycode_dict(self) -> Dict[str, str]:
+        """Returns the `keycodes.md` long keycode -> alias dict."""
+        if self.refresher:
+            self.refresher.check()
+        return self._get(self._keycodes)
+
+    def conversion_dict(self) -> Dict[str, str]:
+        """Returns the deprecated keycode -> updated keycode dict."""
+        return self._get(self._conversions)
+
+    def signature(self) -> Tuple:
+        """Identifies the versions of the tables last returned, e.g. for caching results generated from them."""
+        with self._lock:
+            return (self._keycodes.signature, self._conversions.signature)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'reloads': self.reloads}
+
+
+# Shared by every request handled by this worker
+KEYCODES = KeycodeRegistry(refresher=KeycodesMdRefresher())
@@ -0,0 +1,168 @@
+"""Parser for KLE raw data (the text in KLE's "Raw data" tab).
+
+Raw data is the inside of the KLE json's outer list, written in KLE's relaxed JavaScript object syntax:
+`["Q","W"],\n[{w:2},"A"]` (unquoted keys, and JSON5-style single quoted strings, comments and trailing
+commas are accepted too). `parse_kle_raw()` reads it in a single pass straight into the rows that
+`deserialize()` takes, without rewriting it into a json string first.
+"""
+import re
+from operator import length_hint
+from json.decoder import scanstring
+from typing import Any, Dict, List, Union
+
+# Double/single quoted strings, punctuation, bare words (keys, numbers, true/false/null) and comments.
+# Anything else is a single character token (e.g. an unterminated quote), which is an error.
+_TOKEN_RE = re.compile(r'''"(?:[^"\\]|\\.)*"|[\[\]{},:]|[^\s\[\]{},:"'/]+|'(?:[^'\\]|\\.)*'|//[^\n]*|/\*.*?\*/|\S''', re.S)
+
+_ESCAPE_RE = re.compile(r'\\(?:u([0-9a-fA-F]{4})|x([0-9a-fA-F]{2})|(\r\n|.))', re.S)
+_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f', 'v': '\v', '0': '\0', '\n': '', '\r\n': '', '\r': ''}
+_CONSTANTS = {'true': True, 'false': False, 'null': None}
+# First characters of the tokens that aren't bare words
+_SPECIAL = frozenset('"\',:{}[]/')
+
+# What the parser expects next
+_VALUE, _AFTER_VALUE, _KEY, _COLON = range(4)
+_EXPECTED = {_VALUE: "a value", _AFTER_VALUE: "',' or a closing bracket", _KEY: "a key or '}'", _COLON: "':'"}
+
+
+def _unescape_match(match: re.Match) -> str:
+    code, byte, char = match.groups()
+    if code:
+        return chr(int(code, 16))
+    if byte:
+        return chr(int(byte, 16))
+    return _ESCAPES.get(char, char)
+
+
+def _unescape(token: str) -> str:
+    """Contents of a quoted string token"""
+    if '\\' not in token:
+        return token[1:-1]
+    if token[0] == '"':
+        try:
+            return scanstring(token, 1, False)[0]
+        except ValueError:
+            pass # JSON5 escapes like \' or \x41
+    # Surrogate pairs (e.g. emoji written as \ud83d\ude00) are joined back into one character
+    return _ESCAPE_RE.sub(_unescape_match, token[1:-1]).encode('utf-16', 'surrogatepass').decode('utf-16')
+
+
+def _unexpected(expect: int, token: str) -> str:
+    # A value (or bracket) right after a value is almost always a forgotten comma
+    if expect == _AFTER_VALUE:
+        return f"missing ',' before {token!r}"
+    return f"expected {_EXPECTED[expect]}, got {token!r}"
+
+
+def _error(text: str, tokens: list, remaining, message: str) -> ValueError:
+    # The position of the token is only looked up for errors, it isn't kept while parsing.
+    # `remaining` is the iterator over `tokens`, which is just past the token.
+    token_ndx = len(tokens) - length_hint(remaining) - 1
+    for ndx, match in enumerate(_TOKEN_RE.finditer(text)):
+        if ndx == token_ndx:
+            pos = match.start()
+            line = text.count('\n', 0, pos) + 1
+            column = pos - text.rfind('\n', 0, pos)
+            return ValueError(f"Invalid KLE raw data at line {line}, column {column}: {message}")
+    return ValueError(f"Invalid KLE raw data: {message}")
+
+
+def parse_kle_raw(text: str) -> List[Union[Dict[str, Any], List[Union[Dict[str, Any], str]]]]:
+    """Parses KLE raw data into a KLE json (list of rows, optionally starting with the metadata dict).
+    A whole KLE json (with the outer brackets) is accepted as well. Invalid raw data raises a ValueError."""
+    top: List[Any] = []
+    current: Union[list, dict] = top # the raw data itself is an implicit list
+    is_dict = False
+    key = None # key of the next value when `current` is a dict
+    stack = [] # (container, is_dict, key) of the lists/dicts `current` is in
+    expect = _VALUE
+
+    tokens = _TOKEN_RE.findall(text)
+    remaining = iter(tokens)
+    # Ordered by how often the tokens appear in KLE raw data (commas, keys/values, labels, ...)
+    for token in remaining:
+        char = token[0]
+        if char == ',':
+            if expect != _AFTER_VALUE:
+                raise _error(text, tokens, remaining, f"expected {_EXPECTED[expect]}, got ','")
+            expect = _KEY if is_dict else _VALUE
+            continue
+
+        if char not in _SPECIAL: # bare word
+            if expect == _KEY:
+                key = token
+                expect = _COLON
+                continue
+            if token in _CONSTANTS:
+                value = _CONSTANTS[token]
+            else:
+                try:
+                    if 'x' in token or 'X' in token:
+                        value = int(token, 16)
+                    elif '.' in token or 'e' in token or 'E' in token:
+                        value = float(token)
+                    else:
+                        value = int(token)
+                except ValueError:
+                    if expect == _AFTER_VALUE:
+                        raise _error(text, tokens, remaining, _unexpected(expect, token))
+                    raise _error(text, tokens, remaining, f"unexpected {token!r} (strings need quotes)")
+
+        elif char == '"' or char == "'":
+            if len(token) == 1:
+                raise _error(text, tokens, remaining, "unterminated string")
+            if expect == _KEY:
+                key = _unescape(token)
+                expect = _COLON
+                continue
+            value = _unescape(token)
+
+        elif char == ':':
+            if expect != _COLON:
+                raise _error(text, tokens, remaining, f"expected {_EXPECTED[expect]}, got ':'")
+            expect = _VALUE
+            continue
+
+        elif char == '{' or char == '[':
+            if expect != _VALUE:
+                raise _error(text, tokens, remaining, _unexpected(expect, char))
+            value = {} if char == '{' else []
+            if is_dict:
+                current[key] = value
+            else:
+                current.append(value)
+            stack.append((current, is_dict, key))
+            current = value
+            is_dict = char == '{'
+            expect = _KEY if is_dict else _VALUE
+            continue
+
+        elif char == '}' or char == ']':
+            # Also closes empty lists/dicts and ones with a trailing comma
+            if not stack or (char == '}') != is_dict or expect == _COLON or (expect == _VALUE and is_dict):
+                raise _error(text, tokens, remaining, f"expected {_EXPECTED[expect]}, got {char!r}")
+            current, is_dict, key = stack.pop()
+            expect = _AFTER_VALUE
+            continue
+
+        elif token[:2] == '//' or token[:2] == '/*':
+            continue
+
+        else:
+            raise _error(text, tokens, remaining, f"unexpected {token!r}")
+
+        if expect != _VALUE:
+            raise _error(text, tokens, remaining, _unexpected(expect, token))
+        if is_dict:
+            current[key] = value
+        else:
+            current.append(value)
+        expect = _AFTER_VALUE
+
+    if stack:
+        raise ValueError(f"Invalid KLE raw data: missing {'}' if is_dict else ']'} at the end")
+
+    # A whole KLE json was pasted (rows never contain lists)
+    if len(top) == 1 and type(top[0]) is list and any(type(item) is list for item in top[0]):
+        return top[0]
+    return top
@@ -1,6 +1,7 @@
 from collections import OrderedDict
-from copy import deepcopy
-from typing import List, Dict, Tuple, TypedDict
+from functools import cached_property
+from itertools import product
+from typing import Iterator, List, Dict, Tuple, Optional, TypedDict
 
 from util.serial import Keyboard, Key, serialize, sort_keys
 from util.util import min_x_y
@@ -10,6 +11,12 @@ def extract_ml_val_ndx(key: Key, ml_val_lbl_ndx: int = 3, ml_ndx_lbl_ndx: int =
     val_lbl = key.labels[ml_val_lbl_ndx]
     ndx_lbl = key.labels[ml_ndx_lbl_ndx]
 
+    # The parsed values are cached on the key along with the labels they were parsed from,
+    # so they are reparsed if the labels change
+    cached = key._ml_val_ndx
+    if cached is not None and cached[0] == val_lbl and cached[1] == ndx_lbl:
+        return cached[2]
+
     if not (val_lbl.isnumeric() and ndx_lbl.isnumeric()):
         if val_lbl.isnumeric():
             raise Exception(f"Key at ({key.x}, {key.y}) has a multilayout value of {val_lbl}, but is missing a valid multilayout index.")
@@ -20,6 +27,7 @@ def extract_ml_val_ndx(key: Key, ml_val_lbl_ndx: int = 3, ml_ndx_lbl_ndx: int =
 
     val = int(val_lbl)
     ndx = int(ndx_lbl)
+    key._ml_val_ndx = (val_lbl, ndx_lbl, (val, ndx))
     return val, ndx
 
 
@@ -27,6 +35,12 @@ def extract_row_col(key: Key, row_lbl_ndx: int = 9, col_lbl_ndx: int = 11) -> Tu
     row_lbl = key.labels[row_lbl_ndx]
     col_lbl = key.labels[col_lbl_ndx]
 
+    # The parsed values are cached on the key along with the labels they were parsed from,
+    # so they are reparsed if the labels change
+    cached = key._row_col
+    if cached is not None and cached[0] == row_lbl and cached[1] == col_lbl:
+        return cached[2]
+
     # Error keys without row and/or column labels
     # # if not (row_lbl and col_lbl): # this line is needed in the case that labels are None (no longer required since I changed the default label values to empty strings instead)
     # #     continue
@@ -40,6 +54,7 @@ def extract_row_col(key: Key, row_lbl_ndx: int = 9, col_lbl_ndx: int = 11) -> Tu
 
     row = int(row_lbl)
     col = int(col_lbl)
+    key._row_col = (row_lbl, col_lbl, (row, col))
     return row, col
 
 
@@ -54,6 +69,9 @@ def get_multilayout_keys(kbd: Keyboard) -> List[Key]:
 
 def generate_ml_dict(ml_keys: List[Key]) -> Dict:
     ml_dict = {}
+    # Keys already added, by multilayout index, value and position (equal keys are in the same place),
+    # so that checking for an equal key doesn't go through the whole option
+    added = {}
     for key in ml_keys:
         # Ignore VIAL Encoder keys
         if key.labels[4] == 'e':
@@ -70,8 +88,10 @@ def generate_ml_dict(ml_keys: List[Key]) -> Dict:
         if not ml_dict[ml_ndx].get(ml_val):
             ml_dict[ml_ndx][ml_val] = []
 
-        # Add key to dict if not in already
-        if not key in ml_dict[ml_ndx][ml_val]:
+        # Add key to dict if not in already (an equal key, e.g. a duplicated key in the KLE, counts)
+        same_place = added.setdefault((ml_ndx, ml_val, key.x, key.y), [])
+        if not key in same_place:
+            same_place.append(key)
             ml_dict[ml_ndx][ml_val].append(key)
     
     # Run a check to make sure all multilayouts are accounted for properly:
@@ -85,90 +105,112 @@ def generate_ml_dict(ml_keys: List[Key]) -> Dict:
 
     return ml_dict
 
-def get_alternate_layouts(kbd: Keyboard, layout_info: Dict[str, List[int]]) -> Dict[str, List[Key]]:
+
+class MultilayoutIndex:
+    """The multilayouts of a Keyboard, for building any of its layouts (see get_specific_layout()).
+    The multilayout keys and the offset of every option are worked out once, each layout is then made of
+    moved copies of the keyboard's keys (see Key.moved()), the keyboard itself isn't modified.
+    Neither should it be while the index is in use."""
+    def __init__(self, kbd: Keyboard):
+        ml_keys = get_multilayout_keys(kbd)
+        ml_key_ids = {id(k) for k in ml_keys}
+
+        # Non-multilayout keys, in every layout (ignoring VIAL Encoder keys)
+        self.fixed_keys = [key for key in kbd.keys if id(key) not in ml_key_ids and key.labels[4] != 'e']
+
+        # Generate a dict of all multilayouts
+        self.ml_dict = generate_ml_dict(ml_keys)
+
+        # (x, y) offset of each multilayout option that moves it in place of the 0th option,
+        # and the top left of each option once moved
+        self.offsets: Dict[int, Dict[int, Tuple[float, float]]] = {}
+        self.corners: Dict[int, Dict[int, Tuple[float, float]]] = {}
+        for ml_ndx, ml_options in self.ml_dict.items():
+            xmin, ymin = min_x_y(ml_options[0])
+            self.offsets[ml_ndx] = {}
+            self.corners[ml_ndx] = {}
+            for ml_val, keys in ml_options.items():
+                if ml_val > 0:
+                    x, y = min_x_y(keys)
+                    ml_x_offset, ml_y_offset = xmin - x, ymin - y
+                    self.corners[ml_ndx][ml_val] = (min(key.x + ml_x_offset for key in keys),
+                                                    min(key.y + ml_y_offset for key in keys))
+                else:
+                    ml_x_offset, ml_y_offset = 0., 0.
+                    self.corners[ml_ndx][ml_val] = (xmin, ymin)
+                self.offsets[ml_ndx][ml_val] = (ml_x_offset, ml_y_offset)
+
+        self.fixed_corner = min_x_y(self.fixed_keys) if self.fixed_keys else None
+
+    def layout(self, layout_idx: List[int]) -> List[Key]:
+        """The keys of a layout, see get_specific_layout()"""
+        # Validate that our layout idx list is properly formed
+        if len(layout_idx) != len(self.ml_dict.keys()):
+            raise Exception(f"Layout index list does not have the proper number of options selected")
+
+        # Validate that each selected index for each option exists
+        for option_idx, selected_idx in enumerate(layout_idx):
+            if selected_idx >= len(self.ml_dict[option_idx]):
+                raise Exception(f"Selected index {selected_idx} does not exist for option index {option_idx}")
+
+        # Top left of the layout, all the keys are aligned against it
+        corners = [self.corners[option_idx][selected_idx] for option_idx, selected_idx in enumerate(layout_idx)]
+        if self.fixed_corner:
+            corners.append(self.fixed_corner)
+        if not corners:
+            return []
+        x_offset = min(x for x, _ in corners)
+        y_offset = min(y for _, y in corners)
+
+        # Non-multilayout keys, then the keys of each selected option moved in place
+        layout_keys = [key.moved(key.x - x_offset, key.y - y_offset) for key in self.fixed_keys]
+        for option_idx, selected_idx in enumerate(layout_idx):
+            ml_x_offset, ml_y_offset = self.offsets[option_idx][selected_idx]
+            for key in self.ml_dict[option_idx][selected_idx]:
+                layout_key = key.moved(key.x + ml_x_offset - x_offset, key.y + ml_y_offset - y_offset)
+                # For rotated keys only
+                if key.rotation_angle:
+                    layout_key.rotation_x = key.rotation_x - ml_x_offset
+                    layout_key.rotation_y = key.rotation_y - ml_y_offset
+                layout_keys.append(layout_key)
+
+        sort_keys(layout_keys)  # sort keys (some multilayout keys may not be in the right order)
+
+        return layout_keys
+
+    def combinations(self) -> Iterator[List[int]]:
+        """Every layout index list (one option of each multilayout), generated lazily"""
+        options = [range(len(self.ml_dict[option_idx])) for option_idx in range(len(self.ml_dict))]
+        for layout_idx in product(*options):
+            yield list(layout_idx)
+
+    def layouts(self) -> Iterator[Tuple[List[int], List[Key]]]:
+        """(layout index list, keys) of every layout, generated lazily (there can be a lot of them)"""
+        for layout_idx in self.combinations():
+            yield layout_idx, self.layout(layout_idx)
+
+
+def get_alternate_layouts(kbd: Keyboard, layout_info: Dict[str, List[int]], ml_index: MultilayoutIndex = None) -> Dict[str, List[Key]]:
     """
     Returns a dict mapping a layout name to a list of keys
     Takes in a keyboard and a dict that maps names to a list of option indices
+    `ml_index` can be passed in to reuse the multilayout index of `kbd`
     """
+    if not ml_index:
+        ml_index = MultilayoutIndex(kbd)
     alt_layouts = {}
     for name, choices in layout_info.items():
-        resulting_keys = get_specific_layout(kbd, choices)
-        alt_layouts[name] = resulting_keys
+        alt_layouts[name] = ml_index.layout(choices)
     return alt_layouts
 
 
 def get_specific_layout(kbd: Keyboard, layout_idx: List[int]) -> List[Key]:
-    """Returns a Keyboard with the specified multilayout
+    """Returns the keys of the specified multilayout
     The layout_idx list should specify the index of each specified layout option
     Based on the configured input keyboard
+    Use a MultilayoutIndex to get several layouts of the same keyboard
     """
-    kbd = deepcopy(kbd)
-    ml_keys = get_multilayout_keys(kbd)
-
-    # We will return these keys for this layout
-    layout_keys = []
-    # Add non-multilayout keys to the list for now
-    for key in [k for k in kbd.keys if k not in ml_keys]:
-        # Ignore VIAL Encoder keys
-        if key.labels[4] == 'e':
-            continue
-        layout_keys.append(key)
-
-    # Generate a dict of all multilayouts
-    ml_dict = generate_ml_dict(ml_keys)
-
-    # Validate that our layout idx list is properly formed
-    if len(layout_idx) != len(ml_dict.keys()):
-        raise Exception(f"Layout index list does not have the proper number of options selected")
-
-    # Validate that each selected index for each option exists
-    for option_idx, selected_idx in enumerate(layout_idx):
-        if selected_idx >= len(ml_dict[option_idx]):
-            raise Exception(f"Selected index {selected_idx} does not exist for option index {option_idx}")
-
-    # Add each selected key to the layout
-    for option_idx, selected_idx in enumerate(layout_idx):
-        selected_keys = ml_dict[option_idx][selected_idx]
-        for selected_key in selected_keys:
-            if selected_idx > 0:
-                # Add an offsets dict if it doesn't exist
-                if not ml_dict[option_idx].get("offsets"):
-                    ml_dict[option_idx]["offsets"] = {}
-
-                # Calculate the appropriate offset for this ml_val if it hasn't been calculated yet
-                if not ml_dict[option_idx]["offsets"].get(selected_idx):
-                    # Calculate and set x and y offsets
-                    xmin, ymin = min_x_y(ml_dict[option_idx][0])
-                    x, y = min_x_y(ml_dict[option_idx][selected_idx])
-
-                    ml_x_offset = xmin - x
-                    ml_y_offset = ymin - y
-
-                    ml_dict[option_idx]["offsets"][selected_idx] = (ml_x_offset, ml_y_offset)
-                else:
-                    # Get the offset from ml_dict
-                    ml_x_offset, ml_y_offset = ml_dict[option_idx]["offsets"][selected_idx]
-
-                # Offset the x and y values
-                selected_key.x += ml_x_offset
-                selected_key.y += ml_y_offset
-
-                # For rotated keys only
-                if selected_key.rotation_angle:
-                    selected_key.rotation_x -= ml_x_offset
-                    selected_key.rotation_y -= ml_y_offset
-
-            # Add the key to the final list
-            layout_keys.append(selected_key)
-    # Offset all the remaining keys (align against the top left)
-    x_offset, y_offset = min_x_y(layout_keys)
-    for key in layout_keys:
-        key.x -= x_offset
-        key.y -= y_offset
-
-    sort_keys(layout_keys)  # sort keys (some multilayout keys may not be in the right order)
-
-    return layout_keys
+    return MultilayoutIndex(kbd).layout(layout_idx)
 
 
 
@@ -176,15 +218,18 @@ def get_layout_all(kbd: Keyboard) -> Keyboard:
     """Returns a Keyboard with all maximum multilayouts chosen.
     For each multilayout, choose the layout option with the most amount of keys.
     For any one multilayout, if all layout options have the same number of keys,
-    the 0th option will be defaulted to. Used for things like the info.json."""
-    kbd = deepcopy(kbd)
+    the 0th option will be defaulted to. Used for things like the info.json.
+    The keyboard isn't modified, the layout_all is made of moved copies of its keys (see Key.moved())
+    and shares its metadata, for reading only."""
+    kbd = Keyboard(kbd.meta, [key.moved(key.x, key.y) for key in kbd.keys])
     ml_keys = get_multilayout_keys(kbd)
+    ml_key_ids = {id(k) for k in ml_keys}
 
     # This list will replace kbd.keys later
     # It is a list with only the keys to be included in the info.json
     layout_all_keys = []
     # Add non-multilayout keys to the list for now
-    for key in [k for k in kbd.keys if k not in ml_keys]:
+    for key in [k for k in kbd.keys if id(k) not in ml_key_ids]:
         # Ignore VIAL Encoder keys
         if key.labels[4] == 'e':
             continue
@@ -194,21 +239,28 @@ def get_layout_all(kbd: Keyboard) -> Keyboard:
     # E.g. Used to test and figure out the multilayout value with the maximum amount of keys
     ml_dict = generate_ml_dict(ml_keys)
 
-    # Iterate over multilayout keys
-    for key in [k for k in kbd.keys if k in ml_keys]:
-        ml_ndx, ml_val = extract_ml_val_ndx(key)
+    # Multilayout index and value of every multilayout key, parsed once
+    ml_key_vals = [(key, *extract_ml_val_ndx(key)) for key in ml_keys]
 
-        # Get current list of amount of keys in all ml options
-        ml_val_length_list = [len(ml_dict[ml_ndx][i]) for i in ml_dict[ml_ndx].keys() if isinstance(i, int)]
+    # For each multilayout: the maximum amount of keys over all ml_val options,
+    # and whether all multilayout values/options have the same amount of keys
+    ml_max_lens = {}
+    ml_all_same_length = {}
+    for ml_ndx, ml_options in ml_dict.items():
+        ml_val_length_list = [len(ml_option_keys) for ml_option_keys in ml_options.values()]
+        ml_max_lens[ml_ndx] = max(ml_val_length_list)
+        ml_all_same_length[ml_ndx] = len(set(ml_val_length_list)) == 1
 
-        max_val_len = max(ml_val_length_list)  # Maximum amount of keys over all ml_val options
+    # Iterate over multilayout keys
+    for key, ml_ndx, ml_val in ml_key_vals:
+        max_val_len = ml_max_lens[ml_ndx]  # Maximum amount of keys over all ml_val options
         current_val_len = len(ml_dict[ml_ndx][ml_val])  # Amount of keys for current ml_val
 
         # Whether or not the current ml_val is the max layout
         current_is_max = max_val_len == current_val_len
 
         # If all multilayout values/options have the same amount of keys
-        all_same_length = len(set(ml_val_length_list)) == 1
+        all_same_length = ml_all_same_length[ml_ndx]
 
         # If the current multilayout value/option is the max one
         if not ml_dict[ml_ndx].get("max"):
@@ -264,12 +316,15 @@ def get_layout_all(kbd: Keyboard) -> Keyboard:
     # since that split multilayout will have more keys and will be picked by default.
     outliers = {}
 
-    for key in [k for k in kbd.keys if k in ml_keys]:
-        ml_ndx, ml_val = extract_ml_val_ndx(key)
+    # Matrix positions used by the max layout option of each multilayout
+    max_matrix_sets = {}
+    for ml_ndx in ml_dict.keys():
         max_val = ml_dict[ml_ndx]['max']
-        matrix_list = [(extract_row_col(key)) for key in ml_dict[ml_ndx][max_val]]
+        max_matrix_sets[ml_ndx] = {extract_row_col(key) for key in ml_dict[ml_ndx][max_val]}
+
+    for key, ml_ndx, ml_val in ml_key_vals:
         row, col = extract_row_col(key)
-        if (row, col) not in matrix_list:
+        if (row, col) not in max_matrix_sets[ml_ndx]:
             # print(key)
             if not outliers.get(ml_ndx):
                 outliers[ml_ndx] = {}
@@ -278,7 +333,6 @@ def get_layout_all(kbd: Keyboard) -> Keyboard:
             if not outliers[ml_ndx][ml_val].get('keys'):
                 outliers[ml_ndx][ml_val]['keys'] = []
             outliers[ml_ndx][ml_val]['keys'].append(key)
-            matrix_list.append((row, col))
 
     for ml_ndx in outliers.keys():
         max_val = ml_dict[ml_ndx]['max']
@@ -316,6 +370,103 @@ def get_layout_all(kbd: Keyboard) -> Keyboard:
     return kbd
 
 
+def count_encoders(keys: List[Key]) -> int:
+    """Returns the number of encoders, based on the encoder keys (Both VIA and VIAL)"""
+    encoders_num = 0
+    for key in keys:
+        # Toggle encoders if a key with encoders detected
+        if key.labels[4].startswith('e'):
+            if key.labels[4] == 'e': # VIAL
+                enc_val = int(key.labels[9])
+
+            if len(key.labels[4]) > 1 and key.labels[4][1].isnumeric(): # VIA
+                enc_val = int(key.labels[4][1])
+            encoders_num = max(encoders_num, enc_val+1)
+    return encoders_num
+
+
+def matrix_size(matrix: List[Tuple[int, int]]) -> Tuple[int, int]:
+    """Returns the total rows and cols of a list of matrix coordinates"""
+    rows = 0
+    cols = 0
+    for row, col in matrix:
+        rows = max(rows, row + 1)
+        cols = max(cols, col + 1)
+    return rows, cols
+
+
+class KeyboardAnalysis:
+    """The layout analysis of a Keyboard that the generators need.
+    Build it once with `analyze_keyboard()` and pass it to every generator,
+    so that the same board isn't analyzed again for every output file.
+    Everything is computed on first access (so generators that don't need
+    e.g. the layout_all don't pay for it, or fail on it) and then kept.
+    Generators only read from it, it must not be modified. Neither should the keyboard
+    while the analysis is in use."""
+    def __init__(self, kbd: Keyboard):
+        self.kbd = kbd
+
+    @cached_property
+    def matrix(self) -> List[Tuple[int, int]]:
+        """(row, col) of each key in kbd.keys"""
+        return [extract_row_col(key) for key in self.kbd.keys]
+
+    @cached_property
+    def ml_vals(self) -> List[Optional[Tuple[int, int]]]:
+        """(ml_ndx, ml_val) of each key in kbd.keys, None if the key doesn't have both multilayout labels"""
+        return [extract_ml_val_ndx(key) if key.labels[3] and key.labels[5] else None for key in self.kbd.keys]
+
+    @cached_property
+    def size(self) -> Tuple[int, int]:
+        """Total rows and cols"""
+        return matrix_size(self.matrix)
+
+    @property
+    def rows(self) -> int:
+        return self.size[0]
+
+    @property
+    def cols(self) -> int:
+        return self.size[1]
+
+    @cached_property
+    def encoders_num(self) -> int:
+        return count_encoders(self.kbd.keys)
+
+    @cached_property
+    def layout_all(self) -> Keyboard:
+        """See get_layout_all()"""
+        return get_layout_all(self.kbd)
+
+    @cached_property
+    def ml_index(self) -> MultilayoutIndex:
+        """For the alternate layouts, see MultilayoutIndex"""
+        return MultilayoutIndex(self.kbd)
+
+    @cached_property
+    def layout_all_matrix(self) -> List[Tuple[int, int]]:
+        """(row, col) of each key in layout_all.keys"""
+        return [extract_row_col(key) for key in self.layout_all.keys]
+
+    @cached_property
+    def layout_all_size(self) -> Tuple[int, int]:
+        """Total rows and cols of the layout_all"""
+        return matrix_size(self.layout_all_matrix)
+
+    @property
+    def layout_all_rows(self) -> int:
+        return self.layout_all_size[0]
+
+    @property
+    def layout_all_cols(self) -> int:
+        return self.layout_all_size[1]
+
+
+def analyze_keyboard(kbd: Keyboard) -> KeyboardAnalysis:
+    """Returns the (lazily computed) analysis of a Keyboard (matrix, multilayouts, encoders and the layout_all)"""
+    return KeyboardAnalysis(kbd)
+
+
 def convert_key_list_to_layout(keys: List[Key]) -> List[Key]:
     """Creates a layout array given a list of keys"""
     qmk_layout = []
@@ -0,0 +1,170 @@
+"""Streaming parser for KiCAD (s-expression) netlist files.
+
+Only the sections needed to find the matrix pins (`components` and `nets`) are kept,
+everything else (design, libparts, libraries) is skipped while reading.
+"""
+import codecs
+import re
+from dataclasses import dataclass, field as dcf
+from typing import IO, Callable, Dict, Iterable, Iterator, List, Optional, Set, Union
+
+CHUNK_SIZE = 1 << 16
+
+# Parentheses, quoted strings (with escapes) and bare atoms. The last alternative only matches a
+# string whose closing quote hasn't been read yet, and swallows the rest of the buffer.
+_TOKEN_RE = re.compile(r'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+|".*', re.DOTALL)
+_STRING_RE = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+_ESCAPE_RE = re.compile(r'\\(.)', re.DOTALL)
+
+
+@dataclass(slots=True)
+class NetlistComponent:
+    ref: str
+    value: str = ""
+    footprint: str = ""
+
+
+@dataclass(slots=True)
+class NetlistNode:
+    ref: str
+    pin: str = ""
+    pinfunction: str = ""
+    pintype: str = ""
+
+
+@dataclass
+class Netlist:
+    components: Dict[str, NetlistComponent] = dcf(default_factory=dict)  # by ref, in netlist order
+    nets: Dict[str, List[NetlistNode]] = dcf(default_factory=dict)  # by net name, in netlist order
+
+
+def read_netlist_chunks(source: Union[str, bytes, IO], chunk_size: int = CHUNK_SIZE) -> Iterator[str]:
+    """Yields the text of a netlist in chunks. `source` can be the text itself (str or bytes),
+    or a text/binary file object (e.g. an uploaded file), which is read incrementally."""
+    if isinstance(source, str):
+        for i in range(0, len(source), chunk_size):
+            yield source[i:i + chunk_size]
+        return
+
+    if isinstance(source, (bytes, bytearray)):
+        yield str(source, 'utf-8')
+        return
+
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        yield decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+def tokenize_netlist(chunks: Iterable[str]) -> Iterator[List[str]]:
+    """Yields the raw tokens of a netlist, one list per chunk: `'('`, `')'`, bare atoms and quoted
+    strings (still quoted). A token split across chunks is carried over to the next chunk."""
+    carry = ''
+    for chunk in chunks:
+        buf = carry + chunk
+        tokens = _TOKEN_RE.findall(buf)
+        carry = ''
+        if tokens and tokens[-1] != '(' and tokens[-1] != ')':
+            # The last token may continue in the next chunk. Only whitespace can follow it,
+            # so its last occurrence is where it starts.
+            last = tokens.pop()
+            carry = buf[buf.rfind(last):]
+        yield tokens
+
+    if carry:
+        tokens = _TOKEN_RE.findall(carry)
+        if tokens[-1][0] == '"' and not _STRING_RE.fullmatch(tokens[-1]):
+            raise Exception("Netlist has an unterminated string")
+        yield tokens
+
+
+def parse_sexpr(token_lists: Iterable[List[str]],
+                keep: Optional[Set[str]] = None,
+                on_item: Optional[Callable[[str, list], None]] = None) -> list:
+    """Iteratively builds the nested lists of an s-expression from `tokenize_netlist()` output and returns
+    the first top-level list. If `keep` is given, lists inside the top-level list whose head isn't in `keep`
+    are skipped without being built.
+    If `on_item` is given, it's called with the section head and the list for every item of a section
+    (e.g. `('components', ['comp', ...])`), which is then dropped from the tree to save memory."""
+    stack: List[list] = []
+    top = []
+    head = False  # next token is the head of a list
+    skip = 0  # depth inside a skipped list
+    for tokens in token_lists:
+        for token in tokens:
+            if skip:
+                if token == '(':
+                    skip += 1
+                elif token == ')':
+                    skip -= 1
+                continue
+
+            if token == '(':
+                new = []
+                top.append(new)
+                stack.append(top)
+                top = new
+                head = True
+            elif token == ')':
+                if not stack:
+                    raise Exception("Netlist has an unmatched ')'")
+                top = stack.pop()
+                if len(stack) == 2 and on_item is not None:
+                    on_item(top[0], top.pop())
+                elif not stack:
+                    return top[0]
+            else:
+                if token[0] == '"':
+                    token = token[1:-1]
+                    if '\\' in token:
+                        token = _ESCAPE_RE.sub(r'\1', token)
+                if head:
+                    head = False
+                    if keep is not None and token not in keep and len(stack) > 1:
+                        top = stack.pop()
+                        top.pop()
+                        skip = 1
+                        continue
+                top.append(token)
+
+    raise Exception("Netlist is incomplete (missing ')')")
+
+
+def _props(item: list) -> Dict[str, str]:
+    """Returns the `(name value)` properties of an s-expression list as a dict"""
+    return {prop[0]: prop[1] for prop in item if type(prop) is list and len(prop) >= 2 and type(prop[1]) is str}
+
+
+# Heads of the lists that `parse_netlist()` reads, everything else is skipped
+NETLIST_KEEP = {
+    'components', 'comp', 'ref', 'value', 'footprint',
+    'nets', 'net', 'code', 'name', 'node', 'pin', 'pinfunction', 'pintype',
+}
+
+
+def parse_netlist(source: Union[str, bytes, IO]) -> Netlist:
+    """Parses a KiCAD netlist (text, bytes or a file object) and indexes components by ref and nets by name.
+    Only the parts of the `components` and `nets` sections listed in `NETLIST_KEEP` are read into memory,
+    and every component/net is converted as soon as it has been read."""
+    netlist = Netlist()
+
+    def on_item(section: str, item: list):
+        if section == 'components' and item[0] == 'comp':
+            props = _props(item)
+            ref = props.get('ref', '')
+            netlist.components[ref] = NetlistComponent(ref, props.get('value', ''), props.get('footprint', ''))
+        elif section == 'nets' and item[0] == 'net':
+            nodes = []
+            for node in item:
+                if type(node) is list and node[0] == 'node':
+                    props = _props(node)
+                    nodes.append(NetlistNode(props.get('ref', ''), props.get('pin', ''), props.get('pinfunction', ''), props.get('pintype', '')))
+            netlist.nets[_props(item).get('name', '')] = nodes
+
+    parse_sexpr(tokenize_netlist(read_netlist_chunks(source)), NETLIST_KEEP, on_item)
+    return netlist
@@ -0,0 +1,296 @@
+"""Generation of the firmware files from a KLE as a pipeline of named stages.
+
+Every stage declares the stages it depends on (e.g. `info.json` needs the `keyboard`, its `analysis` and the
+`matrix_pins`), and only the stages needed for the requested files are run. Stages with a `key` are cached
+in a `ResultCache`, so on a cache hit the stages they depend on don't need to run at all.
+"""
+import io
+import json
+import time
+import logging
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from util.serial import Keyboard, deserialize, sort_keys, verify_roundtrip
+from util.util import gen_uid, MCU_DICT, MCU_PRESETS, extract_matrix_pins
+from util.converters import kbd_to_keymap, kbd_to_qmk_info, kbd_to_vial, kbd_to_layout_macro, kbd_to_main_config, layout_str_to_layout_dict
+from util.layouts import KeyboardAnalysis, analyze_keyboard
+from util.json_encoders import InfoJSONEncoder, KLEJSONEncoder
+from util.cache import ResultCache, RESULTS, cache_key, content_hash, stream_hash
+from util.timing import StageTimer
+
+logger = logging.getLogger(__name__)
+
+# Names of the generated files
+ARTIFACTS = ['info.json', 'vial.json', 'vial_config.h', 'config.h', 'keyboard.h', 'keymap.c']
+
+# Stands in for the VIAL_KEYBOARD_UID line of the cached VIAL config.h
+VIAL_UID_PLACEHOLDER = "/* VIAL_KEYBOARD_UID */"
+
+
+@dataclass
+class Stage:
+    name: str
+    # Called with the run and the results of `deps` (in order)
+    run: Callable[..., Any]
+    deps: Tuple[str, ...] = ()
+    # Returns everything the result depends on, for caching the result (not cached if None)
+    key: Optional[Callable[['PipelineRun'], Tuple]] = None
+
+
+class PipelineRun:
+    """One run of a `Pipeline`: its inputs, and the results of the stages that have been needed so far.
+    If a `timer` is given, the time each stage took is added to it (not counting the stages it depends on)."""
+    def __init__(self, pipeline: 'Pipeline', inputs: Dict[str, Any], cache: Optional[ResultCache] = None, timer: Optional[StageTimer] = None):
+        self.pipeline = pipeline
+        self.inputs = inputs
+        self.cache = cache
+        self.timer = timer
+        self.results: Dict[str, Any] = {}
+        self.executed: List[str] = [] # stages that actually ran (i.e. weren't cached), in order
+        self._nested: List[float] = [] # time spent in stages needed while running the current ones
+
+    def __getitem__(self, name: str) -> Any:
+        """Result of the stage `name`, running it (and the stages it depends on) if needed."""
+        if name in self.results:
+            return self.results[name]
+
+        stage = self.pipeline.stages[name]
+        key = None
+        key_inputs = stage.key(self) if self.cache is not None and stage.key is not None else None
+        if key_inputs is not None:
+            key = cache_key(name, *key_inputs)
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.results[name] = json.loads(cached)
+                return self.results[name]
+
+        args = [self[dep] for dep in stage.deps]
+        if self.timer is None:
+            result = stage.run(self, *args)
+        else:
+            start = time.perf_counter()
+            self._nested.append(0.)
+            try:
+                result = stage.run(self, *args)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.timer.add(name, elapsed - self._nested.pop())
+                if self._nested:
+                    self._nested[-1] += elapsed
+        self.executed.append(name)
+        if key is not None:
+            self.cache.put(key, json.dumps(result))
+        self.results[name] = result
+        return result
+
+
+class Pipeline:
+    def __init__(self, stages: Iterable[Stage]):
+        self.stages: Dict[str, Stage] = {}
+        for stage in stages:
+            for dep in stage.deps:
+                if dep not in self.stages:
+                    raise Exception(f"Stage {stage.name} depends on {dep}, which has to be added before it")
+            self.stages[stage.name] = stage
+
+    def required(self, outputs: Iterable[str]) -> List[str]:
+        """All the stages `outputs` depend on, in the order they would run (without caching)."""
+        order = []
+        def visit(name):
+            if name in order:
+                return
+            if name not in self.stages:
+                raise Exception(f"Unknown stage {name}")
+            for dep in self.stages[name].deps:
+                visit(dep)
+            order.append(name)
+        for name in outputs:
+            visit(name)
+        return order
+
+    def run(self, outputs: Iterable[str], cache: Optional[ResultCache] = None, timer: Optional[StageTimer] = None, **inputs) -> Dict[str, Any]:
+        """Runs the stages needed for `outputs` and returns their results."""
+        outputs = list(outputs)
+        self.required(outputs) # checks the names
+        run = PipelineRun(self, inputs, cache, timer)
+        return {name: run[name] for name in outputs}
+
+
+def read_options(data) -> Dict[str, Any]:
+    """Reads the generator options from the main page's form fields (`data` is the form, or the body of an API request).
+    Invalid options raise a ValueError."""
+    options = {
+        'board_name': data.get('board-name') or "Keyboard",
+        'maintainer': data.get('maintainer', ''),
+        'url': data.get('url', ''),
+        'lighting': data.get('lighting', ''),
+        'vendor_id': data.get('vendor-id', ''),
+        'product_id': data.get('product-id', ''),
+        'device_ver': data.get('device-ver', ''),
+        'manufacturer': data.get('manufacturer', ''),
+        'mcu_choice': data.get('mcu-preset') or 'None',
+        'layout_file': data.get('layout-file'),
+    }
+
+    # Parse alt layouts (a json string from the form, can also be an object in API requests)
+    alternate_layouts = data.get("layouts")
+    if isinstance(alternate_layouts, str):
+        alternate_layouts = json.loads(alternate_layouts) if alternate_layouts else {}
+    if alternate_layouts and not isinstance(alternate_layouts, dict):
+        raise ValueError(f"Alternate layouts must be an object of layout names to multilayout options, got {type(alternate_layouts).__name__}")
+    options['alt_layouts'] = alternate_layouts or {}
+
+    try:
+        options['layers'] = int(data.get('layers', 4))
+    except ValueError as e:
+        raise ValueError(f'Number of Layers needs to be an integer, {e}')
+
+    if options['mcu_choice'] not in MCU_DICT:
+        raise ValueError(f"Unknown MCU preset {options['mcu_choice']!r}, must be one of {MCU_PRESETS}")
+
+    return options
+
+
+# STAGES
+# Inputs: `kle` (KLE json, list of rows), `options` (see `read_options()`), `netlist` (file object, optional)
+# and `verify_roundtrip` (optional)
+
+def _keyboard(run: PipelineRun) -> Keyboard:
+    keyboard = deserialize(run.inputs['kle'])
+    # The generators expect the keys in KLE order
+    sort_keys(keyboard.keys)
+
+    # To test de/serialization, only in debug/verify mode
+    if run.inputs.get('verify_roundtrip'):
+        roundtrip = verify_roundtrip(keyboard)
+        if not roundtrip['equivalent']:
+            logger.warning("KLE de/serialization round trip does not give the same keyboard back!")
+    return keyboard
+
+def _mcu(run: PipelineRun) -> Dict[str, Any]:
+    return MCU_DICT[run.inputs['options']['mcu_choice']]
+
+def _matrix_key(run: PipelineRun) -> Optional[Tuple]:
+    netlist = run.inputs.get('netlist')
+    if not netlist or run['mcu']['mcu'] is None:
+        return None # nothing to cache
+    return (stream_hash(netlist), run['mcu'])
+
+def _matrix(run: PipelineRun, mcu_dict: Dict[str, Any]) -> List:
+    """The matrix pins from the netlist, and the warnings about them (cached together, so a cache hit still has the warnings)"""
+    netlist = run.inputs.get('netlist')
+    if not netlist:
+        return [{}, []]
+    if mcu_dict['mcu'] is None:
+        raise Exception("You need to choose a MCU preset to utilise the netlist function!")
+    warnings = []
+    try:
+        pins = extract_matrix_pins(netlist, mcu_dict['mcu'], mcu_dict['output_pin_pref'], mcu_dict['schem_pin_pref'], warnings=warnings)
+    except Exception as e:
+        raise Exception(f"Invalid netlist provided!, {e}")
+    return [pins, [f"Netlist: {warning}" for warning in warnings]]
+
+def _info_args(run: PipelineRun) -> Tuple:
+    options = run.inputs['options']
+    mcu_dict = run['mcu']
+    diode_dir = "COL2ROW"
+    return (options['board_name'], options['maintainer'], options['url'], options['vendor_id'], options['product_id'], options['device_ver'],
+            mcu_dict['mcu'], mcu_dict['bootloader'], mcu_dict['board'], run['matrix_pins'], diode_dir, options['manufacturer'], options['alt_layouts'])
+
+def _qmk_info(run: PipelineRun, keyboard: Keyboard, analysis: KeyboardAnalysis, *_) -> Dict[str, Any]:
+    # Generate a QMK info.json file used for QMK Configurator
+    return kbd_to_qmk_info(keyboard, *_info_args(run), analysis=analysis)
+
+def _vial_args(run: PipelineRun) -> Tuple:
+    options = run.inputs['options']
+    return (options['vendor_id'], options['product_id'], options['lighting'], options['board_name'])
+
+def _vial_kbd(run: PipelineRun, keyboard: Keyboard, analysis: KeyboardAnalysis) -> Tuple[Dict[str, Any], str]:
+    # Generate a VIAL json file used to identify a keyboard in VIAL. Same as via but with encoders and no required product/vendor ID
+    # Also generate a config.h file with a randomly generated UID (filled in later, so that it's not cached) and unlocking combo (if included)
+    return kbd_to_vial(keyboard, VIAL_UID_PLACEHOLDER, *_vial_args(run), analysis=analysis)
+
+def _keycodes_key(run: PipelineRun) -> Tuple:
+    from util.keycodes import KEYCODES
+    KEYCODES.keycode_dict() # makes sure the tables (and their signature) are up to date
+    return KEYCODES.signature()
+
+def _keycodes(run: PipelineRun) -> Tuple[Dict[str, str], Dict[str, str]]:
+    # Parsed tables are cached per worker, and only re-parsed when the files change.
+    # An old keycodes.md is still served while a new copy is fetched in the background.
+    from util.keycodes import KEYCODES
+    return KEYCODES.keycode_dict(), KEYCODES.conversion_dict()
+
+def _keymap_key(run: PipelineRun) -> Tuple:
+    options = run.inputs['options']
+    if options['layout_file']:
+        return (run['kle_hash'], options['layers'], options['layout_file'], _keycodes_key(run))
+    return (run['kle_hash'], options['layers'])
+
+def _keymap_c(run: PipelineRun, keyboard: Keyboard, analysis: KeyboardAnalysis) -> str:
+    options = run.inputs['options']
+    if options['layout_file']:
+        layout_dict = layout_str_to_layout_dict(options['layout_file'])
+        keycodes_dict, conversion_dict = run['keycodes']
+        return kbd_to_keymap(keyboard, options['layers'], 1, layout_dict, keycodes_dict, conversion_dict, analysis=analysis)
+    return kbd_to_keymap(keyboard, options['layers'], 1, analysis=analysis)
+
+
+PIPELINE = Pipeline([
+    # The KLE (ignoring formatting), part of the cache key of every file
+    Stage('kle_hash', lambda run: content_hash(run.inputs['kle'])),
+    Stage('keyboard', _keyboard),
+    # Layout analysis (matrix, multilayouts, layout_all, etc.), shared by all the generators
+    Stage('analysis', lambda run, keyboard: analyze_keyboard(keyboard), deps=('keyboard',)),
+    Stage('mcu', _mcu),
+    Stage('matrix', _matrix, deps=('mcu',), key=_matrix_key),
+    Stage('matrix_pins', lambda run, matrix: matrix[0], deps=('matrix',)),
+    # Problems the user should know about (e.g. matrix nets not wired to the MCU), see generate_files()
+    Stage('warnings', lambda run, matrix: matrix[1], deps=('matrix',)),
+    Stage('keycodes', _keycodes), # only needed by keymap.c with a layout file
+    # The converters, and the JSON encoding of their results (cached) as separate stages, to time them separately
+    Stage('qmk_info', _qmk_info, deps=('keyboard', 'analysis', 'mcu', 'matrix_pins')),
+    Stage('info.json', lambda run, qmk_info: json.dumps(qmk_info, indent=4, separators=(', ', ': '), sort_keys=False, cls=InfoJSONEncoder),
+          deps=('qmk_info',), key=lambda run: (run['kle_hash'], *_info_args(run))),
+    # VIAL json and config.h, generated together
+    Stage('vial_kbd', _vial_kbd, deps=('keyboard', 'analysis')),
+    Stage('vial', lambda run, vial_kbd: [json.dumps(vial_kbd[0], ensure_ascii=False, indent=2, cls=KLEJSONEncoder), vial_kbd[1]],
+          deps=('vial_kbd',), key=lambda run: (run['kle_hash'], *_vial_args(run))),
+    Stage('vial.json', lambda run, vial: vial[0], deps=('vial',)),
+    # Not cached, every run gets a new UID
+    Stage('vial_config.h', lambda run, vial: vial[1].replace(VIAL_UID_PLACEHOLDER, gen_uid()), deps=('vial',)),
+    Stage('config.h', lambda run, keyboard: kbd_to_main_config(keyboard, run.inputs['options']['layers']), deps=('keyboard',),
+          key=lambda run: (run['kle_hash'], run.inputs['options']['layers'])),
+    Stage('keyboard.h', lambda run, keyboard, analysis: kbd_to_layout_macro(keyboard, analysis=analysis), deps=('keyboard', 'analysis'),
+          key=lambda run: (run['kle_hash'],)),
+    Stage('keymap.c', _keymap_c, deps=('keyboard', 'analysis'), key=_keymap_key),
+])
+
+
+def generate_files(kle: list,
+                   options: Dict[str, Any],
+                   netlist = None,
+                   artifacts: Iterable[str] = ARTIFACTS,
+                   cache: Optional[ResultCache] = RESULTS,
+                   verify_roundtrip: bool = False,
+                   timer: Optional[StageTimer] = None,
+                   warnings: Optional[List[str]] = None) -> Dict[str, str]:
+    """Generates the requested `artifacts` (see `ARTIFACTS`) from a KLE json (list of rows) and the `read_options()` options.
+    `netlist` is an optional KiCAD netlist file object (or string).
+    Only the stages needed for `artifacts` are run, and the files are cached separately in `cache`, keyed by
+    the KLE and only the options each file depends on (e.g. changing only the maintainer only regenerates info.json).
+    The time each stage takes is added to `timer` (if given).
+    Warnings about the inputs that the files depend on (e.g. matrix nets that aren't wired to the MCU, left as `X`
+    in info.json) are appended to `warnings` (if given).
+    """
+    if isinstance(netlist, str):
+        netlist = io.BytesIO(netlist.encode('utf-8'))
+    outputs = list(artifacts)
+    with_warnings = warnings is not None and 'matrix' in PIPELINE.required(outputs)
+    if with_warnings:
+        outputs.append('warnings')
+    files = PIPELINE.run(outputs, cache, timer, kle=kle, options=options, netlist=netlist, verify_roundtrip=verify_roundtrip)
+    if with_warnings:
+        warnings.extend(files.pop('warnings'))
+    return files
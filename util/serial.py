@@ -1,10 +1,9 @@
 import json
-from copy import deepcopy
 
 from dataclasses import dataclass, field as dcf
 from typing import Any, Optional, List, Dict, Callable
 
-@dataclass
+@dataclass(slots=True)
 class KeyDefault:
     text_color: str = "#000000"
     text_size: int = 3
@@ -17,7 +16,8 @@ def _default_factory_list_factory(s: int) -> Callable:
 def _dcf_list() -> List:
     return dcf(default_factory=list)
 
-@dataclass
+# Slotted (no per-key __dict__), so no attributes other than the fields below can be set on a key
+@dataclass(slots=True)
 class Key:
     color: str = "#cccccc"
     labels: List[str] = _dcf_list()
@@ -43,8 +43,49 @@ class Key:
     sm: str = ""  # switch mount
     sb: str = ""  # switch brand
     st: str = ""  # switch type
+    # Caches of the parsed matrix/multilayout labels, see util.layouts.extract_row_col()
+    _row_col: Optional[tuple] = dcf(default=None, init=False, repr=False, compare=False)
+    _ml_val_ndx: Optional[tuple] = dcf(default=None, init=False, repr=False, compare=False)
+
+    def clone(self) -> 'Key':
+        """Returns a copy of the key that shares no mutable state with it.
+        Much faster than `deepcopy()`, since only the lists and `default` need copying.
+        """
+        new_key = Key(self.color, self.labels.copy(), self.text_color.copy(), self.text_size.copy(),
+                      KeyDefault(self.default.text_color, self.default.text_size),
+                      self.x, self.y, self.width, self.height, self.x2, self.y2, self.width2, self.height2,
+                      self.rotation_x, self.rotation_y, self.rotation_angle,
+                      self.decal, self.ghost, self.stepped, self.nub,
+                      self.profile, self.sm, self.sb, self.st)
+        new_key._row_col = self._row_col
+        new_key._ml_val_ndx = self._ml_val_ndx
+        return new_key
+
+    def with_labels(self, labels: List[str]) -> 'Key':
+        """Returns a copy of the key with other `labels`, for reading only (e.g. to serialize it):
+        its text colors/sizes and `default` are shared with this key, not copied."""
+        return Key(self.color, labels, self.text_color, self.text_size, self.default,
+                   self.x, self.y, self.width, self.height, self.x2, self.y2, self.width2, self.height2,
+                   self.rotation_x, self.rotation_y, self.rotation_angle,
+                   self.decal, self.ghost, self.stepped, self.nub,
+                   self.profile, self.sm, self.sb, self.st)
+
+    def moved(self, x: float, y: float) -> 'Key':
+        """Returns a copy of the key at (`x`, `y`), for reading only (e.g. in a layout):
+        everything else, including its labels, is shared with this key."""
+        new_key = self.with_labels(self.labels)
+        new_key.x = x
+        new_key.y = y
+        new_key._row_col = self._row_col
+        new_key._ml_val_ndx = self._ml_val_ndx
+        return new_key
 
 class TempKey:
+    """The labels of a key reordered for an alignment, see reorder_labels().
+    The labels and text colors are fixed-size (12 slots) arrays written by index. The text sizes are too,
+    until they're cut down to the last one that's set (they're written out as `fa`)."""
+    __slots__ = ('align', 'labels', 'text_color', 'text_size')
+
     def __init__(self, align:int):
         self.align = align
         self.labels: list = ["", ] * 12
@@ -70,7 +111,7 @@ class KeyboardMetadata:
     plate: bool = False
     pcb: bool = False
 
-@dataclass
+@dataclass(slots=True)
 class Keyboard:
     meta: KeyboardMetadata = dcf(default_factory=KeyboardMetadata)
     keys: List[Key] = _dcf_list()
@@ -141,47 +182,81 @@ DISALLOWED_ALIGNMENT_FOR_LABELS = [
     [4,5,6,7]		#11
 ]
 
-def sort_keys(keys: List[Key]) -> List[Key]:
-    keys.sort(key=lambda k: ((k.rotation_angle + 360) % 360, k.rotation_x, k.rotation_y, k.y, k.x))
+# Lookup tables derived from the two tables above, so that serializing a key doesn't have to search them.
+# Inverse of LABEL_MAP: for each alignment, normalized position -> serialized position (-1 if it can't be shown)
+LABEL_MAP_INV = [[row.index(i) if i in row else -1 for i in range(12)] for row in LABEL_MAP]
+# For each alignment, the (normalized, serialized) position pairs of the labels that can be shown
+LABEL_MAP_PAIRS = [[(i, ndx) for i, ndx in enumerate(inv) if ndx >= 0] for inv in LABEL_MAP_INV]
 
-def reorder_labels(key: Key, current: Key) -> TempKey:
-    # Possible alignment flags in order of preference (this is fairly
-    # arbitrary, but hoped to reduce raw data size).
-    align = [7, 5, 6, 4, 3, 1, 2, 0]
+# Possible alignment flags in order of preference (this is fairly
+# arbitrary, but hoped to reduce raw data size).
+ALIGN_PREFERENCE = [7, 5, 6, 4, 3, 1, 2, 0]
+# DISALLOWED_ALIGNMENT_FOR_LABELS as bitmasks (bit n set = alignment n not allowed)
+DISALLOWED_ALIGNMENT_MASKS = [sum(1 << a for a in disallowed) for disallowed in DISALLOWED_ALIGNMENT_FOR_LABELS]
+# Preferred alignment for every combination of disallowed alignments (0 is always allowed)
+PREFERRED_ALIGN = [next((a for a in ALIGN_PREFERENCE if not mask >> a & 1), 0) for mask in range(1 << 8)]
+
+def _kle_order(key: Key) -> tuple:
+    return ((key.rotation_angle + 360) % 360, key.rotation_x, key.rotation_y, key.y, key.x)
+
+def sort_keys(keys: List[Key]) -> None:
+    """Sorts the keys into KLE order, in place"""
+    keys.sort(key=_kle_order)
 
+def sorted_keys(keys: List[Key]) -> List[Key]:
+    """The keys in KLE order (see sort_keys()), as a new list"""
+    return sorted(keys, key=_kle_order)
+
+def reorder_labels(key: Key, current: Key) -> TempKey:
     # remove impossible flag combinations
-    for i in range(len(key.labels)):
-        if key.labels[i]:
-            align = [a for a in align if a not in DISALLOWED_ALIGNMENT_FOR_LABELS[i]]
+    labels = key.labels
+    mask = 0
+    for i, label in enumerate(labels):
+        if label:
+            mask |= DISALLOWED_ALIGNMENT_MASKS[i]
 
     # For the chosen alignment, generate the label array in the correct order
-    ret = TempKey(align[0])
-    for i in range(0, 12):
-        if i in LABEL_MAP[ret.align]:
-            ndx = (LABEL_MAP[ret.align]).index(i)
-        else:
-            ndx = -1
-        if ndx >= 0:
-            if get_ndx(key.labels, i):
-                set_ndx(ret.labels, ndx, key.labels[i])
-            if get_ndx(key.text_color, i):
-                set_ndx(ret.text_color, ndx, key.text_color[i])
-            if get_ndx(key.text_size, i):
-                set_ndx(ret.text_size, ndx, key.text_size[i])
+    ret = TempKey(PREFERRED_ALIGN[mask])
+    ret_labels = ret.labels
+    ret_text_color = ret.text_color
+    text_color = key.text_color
+    text_size = key.text_size
+    num_labels, num_text_colors, num_text_sizes = len(labels), len(text_color), len(text_size)
+    ret_text_size = [None, ] * 12
+    text_size_len = 0
+    for i, ndx in LABEL_MAP_PAIRS[ret.align]:
+        if i < num_labels and labels[i]:
+            ret_labels[ndx] = labels[i]
+        if i < num_text_colors and text_color[i]:
+            ret_text_color[ndx] = text_color[i]
+        if i < num_text_sizes and text_size[i]:
+            ret_text_size[ndx] = text_size[i]
+            if ndx >= text_size_len:
+                text_size_len = ndx + 1
+    # Only as long as needed for the last text size (this is written out as 'fa')
+    del ret_text_size[text_size_len:]
+
     # Clean up
-    for i in range(len(ret.text_size)):
-        if not ret.labels[i]:
-            set_ndx(ret.text_size, i, get_ndx(current.text_size, i))
-        if not ret.text_size[i] or ret.text_size[i] == key.default.text_size:
-            set_ndx(ret.text_size, i, 0)
+    current_text_size = current.text_size
+    default_text_size = key.default.text_size
+    for i in range(text_size_len):
+        if not ret_labels[i]:
+            ret_text_size[i] = current_text_size[i] if i < len(current_text_size) else None
+        if not ret_text_size[i] or ret_text_size[i] == default_text_size:
+            ret_text_size[i] = 0
+    ret.text_size = ret_text_size
     return ret
 
 def compare_text_sizes(current: Key, key: Key, labels: List[str]):
     if type(current) == int:
         current = [current]
+    num_current, num_key = len(current), len(key)
     for i in range(12):
-        if labels[i] and (bool(get_ndx(current, i)) != bool(get_ndx(key, i)) or (get_ndx(current, i) and get_ndx(current, i) != get_ndx(key, i))):
-            return False
+        if labels[i]:
+            a = current[i] if i < num_current else None
+            b = key[i] if i < num_key else None
+            if bool(a) != bool(b) or (a and a != b):
+                return False
     return True
 
 def serialize_prop(props, nname, val, defval):
@@ -193,9 +268,9 @@ def serialize(keyboard: Keyboard) -> List[List[Key]]:
     keys = keyboard.keys
     rows: list[List[Key]] = []
     row: List[Key] = []
-    current = deepcopy(Key())
+    current = Key()
     current.text_color = current.default.text_color
-    current.align = 4
+    current_align = 4
     cluster = {'r': 0, 'rx': 0, 'ry': 0}
 
     # Serialize metadata
@@ -209,9 +284,8 @@ def serialize(keyboard: Keyboard) -> List[List[Key]]:
     new_row = True
     current.y -= 1  # will be incremented on first row
 
-    # Serialize row/key-data
-    sort_keys(keys)
-    for key in keys:
+    # Serialize row/key-data (in KLE order, the keyboard's keys are left as they are)
+    for key in sorted_keys(keys):
         props: dict = {}
         ordered: TempKey = reorder_labels(key, current)
 
@@ -248,18 +322,14 @@ def serialize(keyboard: Keyboard) -> List[List[Key]]:
         current.color = serialize_prop(props, "c", key.color, current.color)
         if not ordered.text_color[0]:
             ordered.text_color[0] = key.default.text_color
-        else:
-            for i in range(2, 12):
-                if not ordered.text_color[i] and ordered.text_color[i] is not ordered.text_color[0]:
-                    ordered.text_color[i] is not key.default.text_color
-        
+
         current.text_color = serialize_prop(props, "t", "\n".join(ordered.text_color).rstrip(), current.text_color)
         current.ghost = serialize_prop(props, "g", key.ghost, current.ghost)
         current.profile = serialize_prop(props, "p", key.profile, current.profile)
         current.sm = serialize_prop(props, "sm", key.sm, current.sm)
         current.sb = serialize_prop(props, "sb", key.sb, current.sb)
         current.st = serialize_prop(props, "st", key.st, current.st)
-        current.align = serialize_prop(props, "a", ordered.align, current.align)
+        current_align = serialize_prop(props, "a", ordered.align, current_align)
         current.default.text_size = serialize_prop(props, "f", key.default.text_size, current.default.text_size)
         if props.get('f'):
             current.text_size = []
@@ -272,22 +342,31 @@ def serialize(keyboard: Keyboard) -> List[List[Key]]:
                     optimizeF2 = optimizeF2 and (ordered.text_size[i] == ordered.text_size[1])
                 if optimizeF2:
                     f2 = ordered.text_size[1]
-                    current.f2 = serialize_prop(props, "f2", f2, -1)
+                    serialize_prop(props, "f2", f2, -1)
                     current.text_size = [0,f2,f2,f2,f2,f2,f2,f2,f2,f2,f2,f2]
                 else:
-                    current.f2 = None
                     current.text_size = serialize_prop(props, "fa", ordered.text_size, [])
         
-        serialize_prop(props, "w", key.width, 1)
-        serialize_prop(props, "h", key.height, 1)
-        serialize_prop(props, "w2", key.width2, key.width)
-        serialize_prop(props, "h2", key.height2, key.height)
-        serialize_prop(props, "x2", key.x2, 0)
-        serialize_prop(props, "y2", key.y2, 0)
-        serialize_prop(props, "n", key.nub or False, False)
-        serialize_prop(props, "l", key.stepped or False, False)
-        serialize_prop(props, "d", key.decal or False, False)
-        if not is_empty_object(props):
+        # Same as serialize_prop() with constant defaults
+        if key.width != 1:
+            props["w"] = key.width
+        if key.height != 1:
+            props["h"] = key.height
+        if key.width2 != key.width:
+            props["w2"] = key.width2
+        if key.height2 != key.height:
+            props["h2"] = key.height2
+        if key.x2 != 0:
+            props["x2"] = key.x2
+        if key.y2 != 0:
+            props["y2"] = key.y2
+        if key.nub:
+            props["n"] = key.nub
+        if key.stepped:
+            props["l"] = key.stepped
+        if key.decal:
+            props["d"] = key.decal
+        if props:
             row.append(props)
         current.labels = ordered.labels
         row.append('\n'.join(ordered.labels).rstrip())
@@ -315,8 +394,8 @@ def reorder_labels_in(labels, align, filler=None, skipdefault=False):
 
 def deserialize(rows: List[Dict | List[Dict | str]]) -> Keyboard: #change dict to kle dict TypedDict
     # Initialize with defaults
-    current = deepcopy(Key())
-    meta = deepcopy(KeyboardMetadata())
+    current = Key()
+    meta = KeyboardMetadata()
     keys: List[Key] = []
     cluster = { "x": 0, "y": 0 }
     align = 4
@@ -324,7 +403,7 @@ def deserialize(rows: List[Dict | List[Dict | str]]) -> Keyboard: #change dict t
         if isinstance(rows_r, list):
             for k, item in enumerate(rows_r):
                 if isinstance(item, str):
-                    new_key = deepcopy(current)
+                    new_key = current.clone()
                     new_key.width2 = new_key.width2 if new_key.width2 != 0 else current.width
                     new_key.height2 = new_key.height2 if new_key.height2 != 0 else current.height
                     new_key.labels = reorder_labels_in(item.split("\n"), align, "")
@@ -374,7 +453,7 @@ def deserialize(rows: List[Dict | List[Dict | str]]) -> Keyboard: #change dict t
                         for i in range(1, 12):
                             set_ndx(current.text_size, i, item.get('f2'))
                     if item.get('fa'):
-                        current.text_size = item.get('fa')
+                        current.text_size = list(item['fa'])  # copied, 'f2' on a later key changes it in place
                     if item.get('p'):
                         current.profile = item.get('p')
                     if item.get('c'):
@@ -424,3 +503,17 @@ def deserialize(rows: List[Dict | List[Dict | str]]) -> Keyboard: #change dict t
         current.x = current.rotation_x
 
     return Keyboard(meta, keys)
+
+def verify_roundtrip(keyboard: Keyboard, rows: List[Dict | List[Dict | str]] = None) -> Dict[str, Any]:
+    """Checks that `keyboard` survives a serialize/deserialize round trip.
+    `equivalent` is whether deserializing the serialized KLE gives the same keyboard back,
+    `identical` whether the serialized KLE is the same as `rows` (the KLE `keyboard` was deserialized from), if given.
+    """
+    # Round trip through json once, so that it compares like an uploaded file would
+    serialized = json.loads(json.dumps(serialize(keyboard)))
+    reserialized = deserialize(serialized)
+    return {
+        'equivalent': reserialized.meta == keyboard.meta and reserialized.keys == sorted_keys(keyboard.keys),
+        'identical': serialized == rows if rows is not None else None,
+        'serialized': serialized,
+    }
@@ -0,0 +1,92 @@
+"""Lightweight per-stage timing of requests (and batch conversions).
+
+A `StageTimer` collects how long each stage of one request took (e.g. `keyboard`, `info.json`, `render`),
+which is sent back in a `Server-Timing` header and logged. `StageStats` keeps the durations of
+the last requests to report rolling percentiles per stage.
+"""
+import os
+import re
+import cProfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterator, Sequence
+
+STAGE_STATS_WINDOW = int(os.environ.get('STAGE_STATS_WINDOW', 1000))
+
+# Server-Timing metric names must be tokens
+_TOKEN_RE = re.compile(r"[^!#$%&'*+\-.^_`|~0-9A-Za-z]")
+
+
+class StageTimer:
+    """Durations (in seconds) of the stages of one request, in the order they first ran.
+    A stage that runs several times is summed."""
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.) + seconds
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def total(self) -> float:
+        return time.perf_counter() - self.start
+
+    def server_timing(self, total: float = None) -> str:
+        """Value of a `Server-Timing` header, e.g. `keyboard;dur=3.1, info.json;dur=8.0, total;dur=14.2`"""
+        metrics = [f"{_TOKEN_RE.sub('_', name)};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()]
+        metrics.append(f"total;dur={(self.total() if total is None else total) * 1000:.1f}")
+        return ', '.join(metrics)
+
+
+class StageStats:
+    """Rolling window of the last `window` durations of every stage, for percentiles."""
+    def __init__(self, window: int = STAGE_STATS_WINDOW):
+        self.window = window
+        self._durations: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, stages: Dict[str, float]):
+        with self._lock:
+            for name, seconds in stages.items():
+                durations = self._durations.get(name)
+                if durations is None:
+                    durations = self._durations[name] = deque(maxlen=self.window)
+                durations.append(seconds)
+
+    def percentiles(self, percents: Sequence[int] = (50, 90, 99)) -> Dict[str, Dict[str, float]]:
+        """{stage: {'count': n, 'p50': ms, 'p90': ms, 'p99': ms}} over the window (nearest-rank percentiles)."""
+        with self._lock:
+            snapshot = {name: sorted(durations) for name, durations in self._durations.items()}
+        result = {}
+        for name, durations in snapshot.items():
+            stats = {'count': len(durations)}
+            for percent in percents:
+                rank = max(0, -(-percent * len(durations) // 100) - 1)
+                stats[f'p{percent}'] = round(durations[rank] * 1000, 2)
+            result[name] = stats
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._durations.clear()
+
+
+def save_profile(profile: cProfile.Profile, directory: str, name: str) -> str:
+    """Dumps a profile to `directory/<time>-<name>.prof` (open it with pstats or snakeviz) and returns the path."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{_TOKEN_RE.sub('_', name)}.prof")
+    profile.dump_stats(path)
+    return path
+
+
+# Shared by every request handled by this worker
+STAGE_STATS = StageStats()
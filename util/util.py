@@ -1,10 +1,11 @@
 from functools import cmp_to_key
 from dataclasses import dataclass, field as dcf
-from typing import Tuple, Optional, Dict, List, Callable
+from typing import IO, Tuple, Optional, Dict, List, Callable
 import secrets
 import re
 
 from util.serial import Key
+from util.netlist import Netlist, parse_netlist, parse_sexpr, tokenize_netlist, read_netlist_chunks
 
 MCU_PRESETS = ['None', 'RP2040', '32U4', 'STM32']
 
@@ -84,72 +85,87 @@ def gen_uid() -> str: # from vial-qmk/util/vial_generate_keyboard_uid.py
     )
 
 # Code for interpreting KiCAD netlist file
-def make_tree(data:str):
-    items = re.findall(r"\(|\)|(?<=\").*?(?=\")|(?<=\()\w+", data)
-
-    def req(index):
-        result = []
-        item = items[index]
-        while item != ")":
-            if item == "(":
-                subtree, index = req(index + 1)
-                result.append(subtree)
-            else:
-                result.append(item)
-            index += 1
-            item = items[index]
-        return result, index
-
-    return req(1)[0]
-
-def extract_matrix_pins(netlist: str,
+def make_tree(data: str | bytes | IO) -> list:
+    """Parses a whole KiCAD netlist into nested lists (without recursion). `extract_matrix_pins()` uses
+    `parse_netlist()` instead, which only keeps the components and nets."""
+    return parse_sexpr(tokenize_netlist(read_netlist_chunks(data)))
+
+# Pin name regexes for the schematic pin prefixes of the presets, e.g. `GPIO12` -> `12`
+MCU_PIN_RES = {d['schem_pin_pref']: re.compile(re.escape(d['schem_pin_pref']) + r"([A-Za-z0-9]+)")
+               for d in MCU_DICT.values() if d['schem_pin_pref'] is not None}
+
+# Matrix net names, e.g. `COL0`, `/ROW12` or `/Left half/COL_3` (any hierarchical sheet path is ignored)
+MATRIX_NET_RE = re.compile(r"(col|row)\D*?(\d+)$", re.IGNORECASE)
+
+def extract_matrix_pins(netlist: str | bytes | IO | Netlist,
                         mcu: str = "RP2040",
                         output_pin_prefix: str = "GP",
-                        schem_pin_prefix: str = "GPIO"
-                        ) -> Dict[str, List[str | int]]:
-    """Takes a KiCAD netlist file as a string (`netlist`) and spits out a dict with column and row pins in order.
+                        schem_pin_prefix: str = "GPIO",
+                        mcu_ref: Optional[str] = None,
+                        warnings: Optional[List[str]] = None
+                        ) -> Dict[str, List[str]]:
+    """Takes a KiCAD netlist file as a string, bytes or a file object (`netlist`) and spits out a dict with column and row pins in order.
+    An already parsed `Netlist` can be passed as well.
     `mcu` is used to search for the MCU component, based on component values.
     `output_pin_prefix` is what the output pins should start with (e.g. `"GP"` for RP2040, and empty (`""`) for 32U4).
     `schem_pin_prefix` is what the pins on the MCU symbol should start with (e.g. `"GPIO"` for RP2040 symbol from Sleep-Lib,
     `"P"` for the KiCAD default 32u4 symbol)
+
+    Pins are ordered by the number in the net names (`COL0`, `COL1`, ... `COL10`), not by the order of the nets in the netlist.
+    If several components match `mcu` (e.g. one MCU per half), the one wired to the most matrix nets is used, unless `mcu_ref`
+    (e.g. `"U2"`) is given. Matrix nets that aren't wired to that MCU (e.g. ones on an IO expander) are left as `"X"`.
+    Both are reported as messages appended to `warnings` (if given).
     """
-    tree = make_tree(netlist)
-    matrix_pins = {'cols': [], 'rows': []}
-    mcu_comp = '' # MCU Component
-    mcu_ref = '' # Component reference e.g. U2
-
-    for comp in tree[3]:
-        for prop in comp:
-            if mcu.lower().startswith("stm32"):
-                testcase = "stm32f"
-            else:
-                testcase = mcu.lower()
-            if prop[0] == "value" and prop[1].lower().startswith(testcase):
-                mcu_comp = comp
-
-    if not mcu_comp:
+    if not isinstance(netlist, Netlist):
+        netlist = parse_netlist(netlist)
+
+    if mcu.lower().startswith("stm32"):
+        testcase = "stm32f"
+    else:
+        testcase = mcu.lower()
+
+    if mcu_ref:
+        if mcu_ref not in netlist.components:
+            raise Exception(f"MCU Reference {mcu_ref} not found in netlist!")
+        mcu_refs = {mcu_ref}
+    else:
+        mcu_refs = {ref for ref, comp in netlist.components.items() if comp.value.lower().startswith(testcase)}
+
+    if not mcu_refs:
         raise Exception(f"{mcu} MCU not found in netlist!")
-
-    for prop in mcu_comp:
-        if prop[0] == "ref":
-            mcu_ref = prop[1]
-
-    if not mcu_ref:
+    if '' in mcu_refs:
         raise Exception(f"MCU Reference (eg. U2) not found in netlist!")
 
-    # Might be an issue: works on the presumption that the nets are ordered in a certain way: ie col0, col1, col2... row0, row1, row2...
-    # (it seems that KiCAD orders them this way, but I'm not sure if it's guaranteed)
-    for net in tree[6]:
-        for prop in net:
-            if prop[0] == "name" and prop[1].lower().startswith("col"):
-                for subprop in net:
-                    if subprop[0] == "node" and subprop[1][1] == mcu_ref:
-                        pin = '%s%s' % (output_pin_prefix, re.findall(schem_pin_prefix+r"([A-Za-z0-9]+)", subprop[3][1])[0])
-                        matrix_pins["cols"].append(pin)
-            elif prop[0] == "name" and prop[1].lower().startswith("row"):
-                for subprop in net:
-                    if subprop[0] == "node" and subprop[1][1] == mcu_ref:
-                        pin = '%s%s' % (output_pin_prefix, re.findall(schem_pin_prefix+r"([A-Za-z0-9]+)", subprop[3][1])[0])
-                        matrix_pins["rows"].append(pin)
+    # Single pass over the matrix nets: MCU ref -> (cols/rows, net number) -> node
+    wired = {ref: {} for ref in mcu_refs}
+    sizes = {'cols': 0, 'rows': 0}
+    for name, nodes in netlist.nets.items():
+        match = MATRIX_NET_RE.match(name.rsplit('/', 1)[-1])
+        if not match:
+            continue
+        key = kind, num = ("cols" if match.group(1).lower() == "col" else "rows", int(match.group(2)))
+        sizes[kind] = max(sizes[kind], num + 1)
+        for node in nodes:
+            if node.ref in wired:
+                wired[node.ref].setdefault(key, (name, node))
+
+    # Most connected MCU, first in the netlist on ties
+    order = {ref: i for i, ref in enumerate(netlist.components) if ref in wired}
+    mcu_ref = max(wired, key=lambda ref: (len(wired[ref]), -order[ref]))
+    if len(mcu_refs) > 1 and warnings is not None:
+        warnings.append(f"Multiple {mcu} MCUs in netlist ({', '.join(sorted(mcu_refs))}), using {mcu_ref}")
+
+    pin_re = MCU_PIN_RES.get(schem_pin_prefix) or re.compile(re.escape(schem_pin_prefix) + r"([A-Za-z0-9]+)")
+    matrix_pins = {kind: ['X'] * size for kind, size in sizes.items()}
+    for (kind, num), (name, node) in wired[mcu_ref].items():
+        match = pin_re.search(node.pinfunction)
+        if not match:
+            raise Exception(f"Pin {node.pin} of {mcu_ref} (net {name}) does not look like a {schem_pin_prefix}<n> pin!")
+        matrix_pins[kind][num] = '%s%s' % (output_pin_prefix, match.group(1))
+
+    for kind in ('cols', 'rows'):
+        missing = [str(i) for i, pin in enumerate(matrix_pins[kind]) if pin == 'X']
+        if missing and warnings is not None:
+            warnings.append(f"{kind} {', '.join(missing)} not wired to {mcu_ref} (IO expander?), left as X")
 
     return matrix_pins